@@ -0,0 +1,134 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Microbenchmark of the table-driven BasicTokenizer character passes against per-character unicodedata calls."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import time
+
+from pytorch_pretrained_bert.tokenization import (BasicTokenizer, _get_char_class_patterns,
+                                                  _is_control, _is_punctuation, _is_whitespace)
+
+SAMPLE_TEXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "samples", "sample_text.txt")
+
+
+def reference_clean_text(text):
+    output = []
+    for char in text:
+        cp = ord(char)
+        if cp == 0 or cp == 0xfffd or _is_control(char):
+            continue
+        if _is_whitespace(char):
+            output.append(" ")
+        else:
+            output.append(char)
+    return "".join(output)
+
+
+def reference_is_chinese_char(cp):
+    return ((cp >= 0x4E00 and cp <= 0x9FFF) or
+            (cp >= 0x3400 and cp <= 0x4DBF) or
+            (cp >= 0x20000 and cp <= 0x2A6DF) or
+            (cp >= 0x2A700 and cp <= 0x2B73F) or
+            (cp >= 0x2B740 and cp <= 0x2B81F) or
+            (cp >= 0x2B820 and cp <= 0x2CEAF) or
+            (cp >= 0xF900 and cp <= 0xFAFF) or
+            (cp >= 0x2F800 and cp <= 0x2FA1F))
+
+
+def reference_tokenize_chinese_chars(text):
+    output = []
+    for char in text:
+        if reference_is_chinese_char(ord(char)):
+            output.append(" ")
+            output.append(char)
+            output.append(" ")
+        else:
+            output.append(char)
+    return "".join(output)
+
+
+def reference_split_on_punc(text):
+    output = []
+    start_new_word = True
+    for char in text:
+        if _is_punctuation(char):
+            output.append([char])
+            start_new_word = True
+        else:
+            if start_new_word:
+                output.append([])
+            start_new_word = False
+            output[-1].append(char)
+    return ["".join(x) for x in output]
+
+
+def synthetic_chinese_text(rng, num_chars):
+    chars = [chr(rng.randint(0x4E00, 0x9FA5)) for _ in range(num_chars)]
+    for i in range(0, num_chars, 15):
+        chars[i] = rng.choice(u"，。、；：？！“”")
+    return "".join(chars)
+
+
+def best_time(fn, texts, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", default=SAMPLE_TEXT, type=str)
+    parser.add_argument("--repeats", default=5, type=int)
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    with open(args.input_file, "r", encoding="utf-8") as reader:
+        english = [line for line in reader.read().splitlines() if line.strip()]
+    chinese = [synthetic_chinese_text(rng, len(line)) for line in english]
+    mixed = [a + u" " + b for a, b in zip(english, chinese)]
+
+    tokenizer = BasicTokenizer()
+    # Build the character class table outside of the timed region.
+    _get_char_class_patterns()
+
+    passes = [
+        ("_clean_text", reference_clean_text, tokenizer._clean_text),
+        ("_tokenize_chinese_chars", reference_tokenize_chinese_chars, tokenizer._tokenize_chinese_chars),
+        ("_run_split_on_punc", reference_split_on_punc, tokenizer._run_split_on_punc),
+    ]
+    for workload, texts in [("english", english), ("chinese", chinese), ("mixed", mixed)]:
+        num_chars = sum(len(text) for text in texts)
+        for name, reference_fn, table_fn in passes:
+            for text in texts:
+                assert reference_fn(text) == table_fn(text), text
+            reference_time = best_time(reference_fn, texts, args.repeats)
+            table_time = best_time(table_fn, texts, args.repeats)
+            print("{:8s} {:24s} unicodedata: {:9.0f} chars/sec  table: {:9.0f} chars/sec  speedup: {:.2f}x".format(
+                workload, name, num_chars / reference_time, num_chars / table_time, reference_time / table_time))
+
+
+if __name__ == "__main__":
+    main()
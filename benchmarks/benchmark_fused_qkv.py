@@ -0,0 +1,74 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Inference latency of BertModel with separate and fused query/key/value projections."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import torch
+
+from pytorch_pretrained_bert.modeling import BertConfig, BertModel
+
+
+def best_time(fn, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--seq_length", default=128, type=int)
+    parser.add_argument("--num_hidden_layers", default=12, type=int)
+    parser.add_argument("--hidden_size", default=768, type=int)
+    parser.add_argument("--repeats", default=10, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    config = BertConfig(30522, hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                        num_attention_heads=args.hidden_size // 64, intermediate_size=4 * args.hidden_size)
+    model = BertModel(config).eval()
+    input_ids = torch.randint(0, config.vocab_size, (args.batch_size, args.seq_length), dtype=torch.long)
+
+    def run():
+        with torch.no_grad():
+            return model(input_ids, output_all_encoded_layers=False)[0]
+
+    expected = run()
+    separate_time = best_time(run, args.repeats)
+    model.set_fuse_qkv(True)
+    assert torch.allclose(run(), expected, atol=1e-5)
+    fused_time = best_time(run, args.repeats)
+
+    print("batch size: {}, sequence length: {}, layers: {}, threads: {}".format(
+        args.batch_size, args.seq_length, args.num_hidden_layers, torch.get_num_threads()))
+    print("separate q/k/v: {:.2f} ms/layer".format(1000 * separate_time / args.num_hidden_layers))
+    print("fused qkv:      {:.2f} ms/layer".format(1000 * fused_time / args.num_hidden_layers))
+    print("speedup: {:.2f}x".format(separate_time / fused_time))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Latency of a BertLayer with and without the fused feed-forward and output sublayers (`fused_sublayers`)."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import torch
+
+from pytorch_pretrained_bert.modeling import BertConfig, BertLayer
+
+
+def best_time(fn, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--seq_length", default=128, type=int)
+    parser.add_argument("--hidden_size", default=768, type=int)
+    parser.add_argument("--repeats", default=20, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    parser.add_argument("--backward", action='store_true', help="Time the forward and backward passes in training mode.")
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    layers = {}
+    for fused in [False, True]:
+        config = BertConfig(30522, hidden_size=args.hidden_size, num_attention_heads=args.hidden_size // 64,
+                            intermediate_size=4 * args.hidden_size, fused_sublayers=fused)
+        layers[fused] = BertLayer(config)
+    layers[True].load_state_dict(layers[False].state_dict())
+    hidden_states = torch.randn(args.batch_size, args.seq_length, args.hidden_size)
+    attention_mask = torch.zeros(args.batch_size, 1, 1, args.seq_length)
+
+    times = {}
+    for fused, layer in layers.items():
+        def run():
+            if args.backward:
+                layer(hidden_states, attention_mask).sum().backward()
+            else:
+                with torch.no_grad():
+                    return layer(hidden_states, attention_mask)
+
+        layer.train(args.backward)
+        run()
+        times[fused] = best_time(run, args.repeats)
+    with torch.no_grad():
+        expected = layers[False].eval()(hidden_states, attention_mask)
+        assert torch.allclose(layers[True].eval()(hidden_states, attention_mask), expected, atol=1e-5)
+
+    print("batch size: {}, sequence length: {}, hidden size: {}, threads: {}, {}".format(
+        args.batch_size, args.seq_length, args.hidden_size, torch.get_num_threads(),
+        "forward + backward" if args.backward else "forward"))
+    print("unfused sublayers: {:.2f} ms/layer".format(1000 * times[False]))
+    print("fused sublayers:   {:.2f} ms/layer".format(1000 * times[True]))
+    print("speedup: {:.2f}x".format(times[False] / times[True]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Peak memory of a BertModel forward pass at inference, depending on the layers it returns.
+
+On CUDA the peak is read from the caching allocator. On CPU it is the peak resident set size
+of the process above its size before the forward pass, which needs Linux (/proc/self/clear_refs)
+and glibc (large tensors are allocated with mmap, so that freeing them gives the memory back).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import ctypes
+import gc
+
+import torch
+
+from pytorch_pretrained_bert.modeling import BertConfig, BertModel
+
+
+def _read_status_kb(field):
+    with open("/proc/self/status") as reader:
+        for line in reader:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    raise RuntimeError("{} not found in /proc/self/status".format(field))
+
+
+_M_MMAP_THRESHOLD = -3
+
+
+def use_mmap_for_large_allocations(threshold=1 << 16):
+    """Makes glibc malloc serve (and give back) allocations of at least `threshold` bytes with mmap."""
+    libc = ctypes.CDLL("libc.so.6")
+    if not libc.mallopt(_M_MMAP_THRESHOLD, threshold):
+        raise RuntimeError("mallopt(M_MMAP_THRESHOLD) failed")
+
+
+def peak_memory_mb(fn, device):
+    """Returns the peak memory allocated while running `fn()` above the memory in use before, in MB."""
+    gc.collect()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        before = torch.cuda.memory_allocated(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        torch.cuda.synchronize(device)
+        return (torch.cuda.max_memory_allocated(device) - before) / 2 ** 20
+    before = _read_status_kb("VmRSS")
+    # Resets the peak resident set size (VmHWM) to the current one.
+    with open("/proc/self/clear_refs", "w") as writer:
+        writer.write("5")
+    fn()
+    return (_read_status_kb("VmHWM") - before) / 2 ** 10
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--seq_length", default=128, type=int)
+    parser.add_argument("--num_hidden_layers", default=12, type=int)
+    parser.add_argument("--hidden_size", default=768, type=int)
+    parser.add_argument("--layers", default="-1,-2,-3,-4", type=str,
+                        help="Layers returned in the output_layers mode, as in extract_features.py.")
+    parser.add_argument("--no_cuda", action='store_true')
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    if device.type == "cpu":
+        use_mmap_for_large_allocations()
+    config = BertConfig(30522, hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                        num_attention_heads=args.hidden_size // 64, intermediate_size=4 * args.hidden_size)
+    model = BertModel(config).to(device).eval()
+    input_ids = torch.randint(0, config.vocab_size, (args.batch_size, args.seq_length), dtype=torch.long,
+                              device=device)
+    layer_indexes = [int(x) for x in args.layers.split(",")]
+    modes = [
+        ("all layers, autograd", False, {}),
+        ("all layers", True, {}),
+        ("last layer", True, {"output_all_encoded_layers": False}),
+        ("output_layers={}".format(args.layers), True, {"output_layers": layer_indexes}),
+    ]
+
+    # Warm up the allocator and the kernels, so that the measures only hold the activations.
+    with torch.no_grad():
+        model(input_ids, output_all_encoded_layers=False)
+
+    activation_mb = args.batch_size * args.seq_length * args.hidden_size * 4 / 2 ** 20
+    print("device: {}, batch size: {}, sequence length: {}, layers: {}, one activation: {:.1f} MB".format(
+        device, args.batch_size, args.seq_length, args.num_hidden_layers, activation_mb))
+    for name, no_grad, kwargs in modes:
+        def run():
+            with torch.set_grad_enabled(not no_grad):
+                outputs = model(input_ids, **kwargs)
+            del outputs
+        print("{:32s} {:8.1f} MB".format(name, peak_memory_mb(run, device)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Parity and speed of BertLayerNorm against the previous pure-Python TF-style layer norm."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import torch
+
+from pytorch_pretrained_bert.modeling import BertLayerNorm
+
+
+def python_layer_norm(x, weight, bias, eps):
+    """The previous fallback: TF-style layer norm (epsilon inside the square root) as separate tensor ops."""
+    u = x.mean(-1, keepdim=True)
+    s = (x - u).pow(2).mean(-1, keepdim=True)
+    x = (x - u) / torch.sqrt(s + eps)
+    return weight * x + bias
+
+
+def best_time(fn, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", default=32, type=int)
+    parser.add_argument("--seq_length", default=128, type=int)
+    parser.add_argument("--hidden_size", default=768, type=int)
+    parser.add_argument("--repeats", default=20, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    layer_norm = BertLayerNorm(args.hidden_size)
+    with torch.no_grad():
+        layer_norm.weight.normal_(1.0, 0.1)
+        layer_norm.bias.normal_(0.0, 0.1)
+    x = torch.randn(args.batch_size, args.seq_length, args.hidden_size) * 3.0 + 1.0
+
+    def reference():
+        return python_layer_norm(x, layer_norm.weight, layer_norm.bias, layer_norm.variance_epsilon)
+
+    def fused():
+        return layer_norm(x)
+
+    with torch.no_grad():
+        max_diff = (fused() - reference()).abs().max().item()
+        # The epsilon only matters for rows of variance close to it (checked in float64, where
+        # rounding does not hide it).
+        layer_norm_64 = BertLayerNorm(args.hidden_size).double()
+        layer_norm_64.load_state_dict(layer_norm.state_dict())
+        x_flat = 0.5 + torch.randn(4, args.hidden_size, dtype=torch.float64) * 1e-6
+        eps_diff = (layer_norm_64(x_flat) - python_layer_norm(x_flat, layer_norm_64.weight, layer_norm_64.bias,
+                                                              layer_norm_64.variance_epsilon)).abs().max().item()
+        reference_time = best_time(reference, args.repeats)
+        fused_time = best_time(fused, args.repeats)
+
+    x.requires_grad_(True)
+
+    def reference_backward():
+        reference().sum().backward()
+
+    def fused_backward():
+        fused().sum().backward()
+
+    reference_grad_time = best_time(reference_backward, args.repeats)
+    fused_grad_time = best_time(fused_backward, args.repeats)
+
+    print("shape: {}, threads: {}".format(list(x.size()), torch.get_num_threads()))
+    print("max abs difference: {:.2e} (rows of variance ~eps, float64: {:.2e})".format(max_diff, eps_diff))
+    print("forward:            python {:.3f} ms, fused {:.3f} ms, speedup {:.2f}x".format(
+        1000 * reference_time, 1000 * fused_time, reference_time / fused_time))
+    print("forward + backward: python {:.3f} ms, fused {:.3f} ms, speedup {:.2f}x".format(
+        1000 * reference_grad_time, 1000 * fused_grad_time, reference_grad_time / fused_grad_time))
+
+
+if __name__ == "__main__":
+    main()
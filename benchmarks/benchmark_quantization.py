@@ -0,0 +1,156 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Accuracy and CPU latency of BertForSequenceClassification in fp32 and with dynamic int8 quantization.
+
+With a model fine-tuned by examples/run_classifier.py, evaluates both versions on the dev set
+of its task:
+
+    python benchmarks/benchmark_quantization.py --bert_model $OUTPUT_DIR --task_name mrpc \
+        --data_dir $GLUE_DIR/MRPC --do_lower_case
+
+Without --data_dir, runs a randomly initialized BERT-base on random inputs and reports the
+latency and how often both versions predict the same label.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import copy
+import json
+import os
+import sys
+import tempfile
+import time
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "examples"))
+
+from pytorch_pretrained_bert.modeling import BertConfig, BertForSequenceClassification  # noqa: E402
+from pytorch_pretrained_bert.tokenization import BertTokenizer  # noqa: E402
+
+
+def load_task(args):
+    """Returns the dev set of the task as (input_ids, input_mask, segment_ids, label_ids) tensors and num_labels."""
+    import run_classifier
+    processors = {
+        "cola": run_classifier.ColaProcessor,
+        "mnli": run_classifier.MnliProcessor,
+        "mrpc": run_classifier.MrpcProcessor,
+        "sst-2": run_classifier.Sst2Processor,
+        "ques_cate": run_classifier.QuescateProcessor,
+    }
+    processor = processors[args.task_name.lower()]()
+    label_list = processor.get_labels()
+    examples = processor.get_dev_examples(args.data_dir)
+    if args.max_examples:
+        examples = examples[:args.max_examples]
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    features = run_classifier.convert_examples_to_features(examples, label_list, args.max_seq_length, tokenizer)
+    tensors = [torch.tensor([getattr(f, name) for f in features], dtype=torch.long)
+               for name in ["input_ids", "input_mask", "segment_ids", "label_id"]]
+    return tensors, len(label_list)
+
+
+def random_task(args):
+    num_examples = args.max_examples or 256
+    input_ids = torch.randint(0, 30522, (num_examples, args.max_seq_length), dtype=torch.long)
+    lengths = torch.randint(8, args.max_seq_length + 1, (num_examples, 1))
+    input_mask = (torch.arange(args.max_seq_length).unsqueeze(0) < lengths).long()
+    return [input_ids * input_mask, input_mask, torch.zeros_like(input_ids), None], 2
+
+
+def evaluate(model, tensors, batch_size):
+    """Returns the predicted labels and the total time spent in the model."""
+    input_ids, input_mask, segment_ids, _ = tensors
+    predictions = []
+    elapsed = 0.0
+    with torch.no_grad():
+        for start in range(0, input_ids.size(0), batch_size):
+            batch = [t[start:start + batch_size] for t in (input_ids, segment_ids, input_mask)]
+            begin = time.perf_counter()
+            logits = model(*batch)
+            elapsed += time.perf_counter() - begin
+            predictions.append(logits.argmax(-1))
+    return torch.cat(predictions), elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bert_model", default=None, type=str,
+                        help="A fine-tuned classifier (output_dir of run_classifier.py). Random if omitted.")
+    parser.add_argument("--task_name", default=None, type=str)
+    parser.add_argument("--data_dir", default=None, type=str)
+    parser.add_argument("--do_lower_case", action='store_true')
+    parser.add_argument("--max_seq_length", default=128, type=int)
+    parser.add_argument("--max_examples", default=None, type=int)
+    parser.add_argument("--batch_size", default=8, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    parser.add_argument("--output_file", default=None, type=str, help="Where to write the report as JSON.")
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    if args.data_dir is not None:
+        tensors, num_labels = load_task(args)
+        model = BertForSequenceClassification.from_pretrained(args.bert_model, num_labels=num_labels)
+    else:
+        tensors, num_labels = random_task(args)
+        model = BertForSequenceClassification(BertConfig(30522), num_labels=num_labels)
+    model.eval()
+    quantized_model = copy.deepcopy(model).quantize()
+
+    def checkpoint_mb(m):
+        # The packed int8 weights are not plain tensors in the state dict, so measure the saved file.
+        with tempfile.NamedTemporaryFile(suffix=".bin") as checkpoint:
+            torch.save(m.state_dict(), checkpoint.name)
+            return os.path.getsize(checkpoint.name) / 2 ** 20
+
+    # Warm up both models.
+    warmup = [t[:args.batch_size] if t is not None else None for t in tensors]
+    evaluate(model, warmup, args.batch_size)
+    evaluate(quantized_model, warmup, args.batch_size)
+
+    report = {"num_examples": tensors[0].size(0), "batch_size": args.batch_size,
+              "max_seq_length": args.max_seq_length, "num_threads": torch.get_num_threads()}
+    fp32_predictions, fp32_time = evaluate(model, tensors, args.batch_size)
+    int8_predictions, int8_time = evaluate(quantized_model, tensors, args.batch_size)
+    labels = tensors[3]
+    for name, predictions, elapsed, m in [("fp32", fp32_predictions, fp32_time, model),
+                                          ("int8", int8_predictions, int8_time, quantized_model)]:
+        report[name] = {
+            "seconds": elapsed,
+            "ms_per_example": 1000 * elapsed / tensors[0].size(0),
+            "checkpoint_mb": checkpoint_mb(m),
+        }
+        if labels is not None:
+            report[name]["accuracy"] = (predictions == labels).float().mean().item()
+    report["agreement"] = (fp32_predictions == int8_predictions).float().mean().item()
+    report["speedup"] = fp32_time / int8_time
+
+    for name in ["fp32", "int8"]:
+        print("{}: {:.2f} ms/example, checkpoint {:.1f} MB{}".format(
+            name, report[name]["ms_per_example"], report[name]["checkpoint_mb"],
+            ", accuracy {:.4f}".format(report[name]["accuracy"]) if "accuracy" in report[name] else ""))
+    print("speedup: {:.2f}x, same prediction for {:.2%} of the examples".format(report["speedup"], report["agreement"]))
+    if args.output_file is not None:
+        with open(args.output_file, "w") as writer:
+            json.dump(report, writer, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Throughput benchmark of BasicTokenizer, WordpieceTokenizer and BertTokenizer.
+
+Writes the results as JSON with --output_file, and with --baseline_file compares them
+against a previous run, exiting with a non-zero status if a benchmark got slower than
+--tolerance allows:
+
+    python benchmarks/benchmark_tokenizers.py --output_file baseline.json
+    # ... change the tokenizer ...
+    python benchmarks/benchmark_tokenizers.py --baseline_file baseline.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+from benchmark_char_classes import synthetic_chinese_text
+from benchmark_wordpiece import build_synthetic_vocab
+
+from pytorch_pretrained_bert import __version__
+from pytorch_pretrained_bert.tokenization import BasicTokenizer, BertTokenizer, WordpieceTokenizer
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "samples")
+
+
+def build_workloads(rng, scale):
+    """Returns a dict of workload name -> list of texts."""
+    english = []
+    for name in ["sample_text.txt", "input.txt"]:
+        with open(os.path.join(SAMPLES_DIR, name), "r", encoding="utf-8") as reader:
+            english.extend(line.replace(" ||| ", " ") for line in reader.read().splitlines() if line.strip())
+    english = english * scale
+    chinese = [synthetic_chinese_text(rng, len(line)) for line in english]
+    mixed = [a + u" " + b for a, b in zip(english, chinese)]
+    long_words = []
+    for line in english:
+        words = line.split()
+        long_words.append(u" ".join(u"".join(words[i:i + 6]) for i in range(0, len(words), 6)))
+    return {"english": english, "chinese": chinese, "mixed": mixed, "long_words": long_words}
+
+
+def best_time(fn, texts, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for text in texts:
+            fn(text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def run_benchmarks(workloads, vocab_file, do_lower_case, repeats):
+    basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case)
+    bert_tokenizer = BertTokenizer(vocab_file, do_lower_case=do_lower_case)
+    uncached_bert_tokenizer = BertTokenizer(vocab_file, do_lower_case=do_lower_case, word_cache_size=0)
+    wordpiece_tokenizer = WordpieceTokenizer(vocab=bert_tokenizer.vocab)
+
+    def bert_tokenize(text):
+        return bert_tokenizer.tokenize(text)
+
+    def bert_tokenize_cold(text):
+        return uncached_bert_tokenizer.tokenize(text)
+
+    results = {}
+    for workload, texts in sorted(workloads.items()):
+        # The wordpiece tokenizer is fed the output of the basic tokenizer, as in BertTokenizer.
+        words = [u" ".join(basic_tokenizer.tokenize(text)) for text in texts]
+        benchmarks = [
+            ("basic", basic_tokenizer.tokenize, texts),
+            ("wordpiece", wordpiece_tokenizer.tokenize, words),
+            ("bert", bert_tokenize, texts),
+            ("bert_no_cache", bert_tokenize_cold, texts),
+        ]
+        for name, fn, inputs in benchmarks:
+            num_chars = sum(len(text) for text in inputs)
+            num_tokens = sum(len(fn(text)) for text in inputs)
+            seconds = best_time(fn, inputs, repeats)
+            results["{}/{}".format(name, workload)] = {
+                "seconds": seconds,
+                "chars": num_chars,
+                "tokens": num_tokens,
+                "chars_per_sec": num_chars / seconds,
+                "tokens_per_sec": num_tokens / seconds,
+            }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Prints the change of each benchmark against `baseline` and returns the names of the regressions."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            print("{:28s} new".format(name))
+            continue
+        ratio = results[name]["chars_per_sec"] / baseline[name]["chars_per_sec"]
+        regressed = ratio < 1.0 - tolerance
+        if regressed:
+            regressions.append(name)
+        print("{:28s} {:+7.1%}{}".format(name, ratio - 1.0, "  REGRESSION" if regressed else ""))
+    for name in sorted(set(baseline) - set(results)):
+        print("{:28s} missing from this run".format(name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_file", default=None, type=str,
+                        help="Vocabulary file. A synthetic vocab is built from the workloads if omitted.")
+    parser.add_argument("--do_lower_case", action='store_true')
+    parser.add_argument("--repeats", default=5, type=int)
+    parser.add_argument("--scale", default=10, type=int,
+                        help="Number of times the sample texts are replicated.")
+    parser.add_argument("--seed", default=42, type=int)
+    parser.add_argument("--output_file", default=None, type=str,
+                        help="Where to write the results as JSON.")
+    parser.add_argument("--baseline_file", default=None, type=str,
+                        help="Results of a previous run to compare against.")
+    parser.add_argument("--tolerance", default=0.1, type=float,
+                        help="Relative slowdown (in chars/sec) above which a benchmark is a regression.")
+    args = parser.parse_args()
+
+    workloads = build_workloads(random.Random(args.seed), args.scale)
+
+    vocab_file = args.vocab_file
+    if vocab_file is None:
+        basic_tokenizer = BasicTokenizer(do_lower_case=args.do_lower_case)
+        words = set(word for texts in workloads.values() for text in texts for word in basic_tokenizer.tokenize(text))
+        with tempfile.NamedTemporaryFile("w", encoding="utf-8", suffix=".txt", delete=False) as writer:
+            writer.write("".join(token + "\n" for token in build_synthetic_vocab(words)))
+            vocab_file = writer.name
+    try:
+        results = run_benchmarks(workloads, vocab_file, args.do_lower_case, args.repeats)
+    finally:
+        if args.vocab_file is None:
+            os.remove(vocab_file)
+
+    for name in sorted(results):
+        print("{:28s} {:10.0f} chars/sec {:10.0f} tokens/sec".format(
+            name, results[name]["chars_per_sec"], results[name]["tokens_per_sec"]))
+
+    if args.output_file is not None:
+        with open(args.output_file, "w", encoding="utf-8") as writer:
+            json.dump({
+                "metadata": {
+                    "pytorch_pretrained_bert": __version__,
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "vocab_file": args.vocab_file,
+                    "do_lower_case": args.do_lower_case,
+                    "repeats": args.repeats,
+                    "scale": args.scale,
+                    "seed": args.seed,
+                },
+                "results": results,
+            }, writer, indent=2, sort_keys=True)
+
+    if args.baseline_file is not None:
+        with open(args.baseline_file, "r", encoding="utf-8") as reader:
+            baseline = json.load(reader)["results"]
+        print("\nCompared to {} (tolerance {:.0%}):".format(args.baseline_file, args.tolerance))
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print("{} regression(s): {}".format(len(regressions), ", ".join(regressions)))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
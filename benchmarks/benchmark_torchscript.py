@@ -0,0 +1,91 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Per-call latency of a task model in eager mode and exported to TorchScript (see pytorch_pretrained_bert/export.py).
+
+Small batches of short sequences, as in online serving, are where the Python overhead of the
+eager model weighs the most.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import time
+
+import torch
+
+from pytorch_pretrained_bert.export import InferenceOutputs, example_inputs, export_torchscript
+from pytorch_pretrained_bert.modeling import (BertConfig, BertModel, BertForSequenceClassification,
+                                              BertForQuestionAnswering, BertForTokenClassification)
+
+MODEL_CLASSES = {
+    "bert": BertModel,
+    "sequence_classification": BertForSequenceClassification,
+    "question_answering": BertForQuestionAnswering,
+    "token_classification": BertForTokenClassification,
+}
+
+
+def best_time(fn, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="sequence_classification", choices=sorted(MODEL_CLASSES))
+    parser.add_argument("--batch_size", default=1, type=int)
+    parser.add_argument("--seq_length", default=32, type=int)
+    parser.add_argument("--num_hidden_layers", default=12, type=int)
+    parser.add_argument("--hidden_size", default=768, type=int)
+    parser.add_argument("--repeats", default=50, type=int)
+    parser.add_argument("--num_threads", default=None, type=int)
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    config = BertConfig(30522, hidden_size=args.hidden_size, num_hidden_layers=args.num_hidden_layers,
+                        num_attention_heads=args.hidden_size // 64, intermediate_size=4 * args.hidden_size)
+    model = MODEL_CLASSES[args.model](config).eval()
+    inputs = example_inputs(model, batch_size=args.batch_size, seq_length=args.seq_length)
+    eager = InferenceOutputs(model).eval()
+    scripted = export_torchscript(model, inputs=inputs)
+
+    times = {}
+    for name, module in [("eager", eager), ("torchscript", scripted)]:
+        def run():
+            with torch.no_grad():
+                return module(*inputs)
+
+        # The first calls of a TorchScript module profile and optimize its graph.
+        for _ in range(3):
+            run()
+        times[name] = best_time(run, args.repeats)
+
+    print("model: {}, batch size: {}, sequence length: {}, layers: {}, threads: {}".format(
+        args.model, args.batch_size, args.seq_length, args.num_hidden_layers, torch.get_num_threads()))
+    print("eager:       {:.2f} ms/call".format(1000 * times["eager"]))
+    print("torchscript: {:.2f} ms/call".format(1000 * times["torchscript"]))
+    print("speedup: {:.2f}x".format(times["eager"] / times["torchscript"]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark the trie-backed WordpieceTokenizer against the original substring lookup."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import collections
+import os
+import time
+
+from pytorch_pretrained_bert.tokenization import (BasicTokenizer, WordpieceTokenizer,
+                                                  load_vocab, whitespace_tokenize)
+
+SAMPLE_TEXT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "samples", "sample_text.txt")
+
+
+def greedy_wordpiece_tokenize(vocab, text, unk_token="[UNK]", max_input_chars_per_word=100):
+    """The original WordpieceTokenizer.tokenize, kept here as the reference implementation."""
+    output_tokens = []
+    for token in whitespace_tokenize(text):
+        chars = list(token)
+        if len(chars) > max_input_chars_per_word:
+            output_tokens.append(unk_token)
+            continue
+
+        is_bad = False
+        start = 0
+        sub_tokens = []
+        while start < len(chars):
+            end = len(chars)
+            cur_substr = None
+            while start < end:
+                substr = "".join(chars[start:end])
+                if start > 0:
+                    substr = "##" + substr
+                if substr in vocab:
+                    cur_substr = substr
+                    break
+                end -= 1
+            if cur_substr is None:
+                is_bad = True
+                break
+            sub_tokens.append(cur_substr)
+            start = end
+
+        if is_bad:
+            output_tokens.append(unk_token)
+        else:
+            output_tokens.extend(sub_tokens)
+    return output_tokens
+
+
+def build_synthetic_vocab(words, max_piece_len=6):
+    """Builds a small wordpiece vocab (all chars plus frequent word prefixes and suffixes)."""
+    counts = collections.Counter()
+    for word in words:
+        for char in word:
+            counts[char] += 1
+            counts["##" + char] += 1
+        for i in range(2, min(len(word), max_piece_len) + 1):
+            counts[word[:i]] += 1
+            counts["##" + word[-i:]] += 1
+    vocab = collections.OrderedDict()
+    for token in ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]"]:
+        vocab[token] = len(vocab)
+    for token, _ in counts.most_common():
+        vocab[token] = len(vocab)
+    return vocab
+
+
+def time_fn(fn, words, repeats):
+    best = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for word in words:
+            fn(word)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--vocab_file", default=None, type=str,
+                        help="Vocabulary file. A synthetic vocab is built from the sample text if omitted.")
+    parser.add_argument("--input_file", default=SAMPLE_TEXT, type=str)
+    parser.add_argument("--do_lower_case", action='store_true')
+    parser.add_argument("--repeats", default=5, type=int)
+    parser.add_argument("--scale", default=20, type=int,
+                        help="Number of times the input words are replicated.")
+    args = parser.parse_args()
+
+    with open(args.input_file, "r", encoding="utf-8") as reader:
+        text = reader.read()
+    words = BasicTokenizer(do_lower_case=args.do_lower_case).tokenize(text) * args.scale
+    # Long, partly unknown words exercise the quadratic worst case of the original lookup.
+    words += ["".join(words[i:i + 8]) for i in range(0, len(words), 8)]
+
+    vocab = load_vocab(args.vocab_file) if args.vocab_file else build_synthetic_vocab(set(words))
+    tokenizer = WordpieceTokenizer(vocab=vocab)
+
+    for word in words:
+        assert tokenizer.tokenize(word) == greedy_wordpiece_tokenize(vocab, word), word
+
+    greedy_time = time_fn(lambda word: greedy_wordpiece_tokenize(vocab, word), words, args.repeats)
+    trie_time = time_fn(tokenizer.tokenize, words, args.repeats)
+    print("words: {}, vocab size: {}".format(len(words), len(vocab)))
+    print("greedy lookup: {:.4f}s ({:.0f} words/sec)".format(greedy_time, len(words) / greedy_time))
+    print("trie lookup:   {:.4f}s ({:.0f} words/sec)".format(trie_time, len(words) / trie_time))
+    print("speedup: {:.2f}x".format(greedy_time / trie_time))
+
+
+if __name__ == "__main__":
+    main()
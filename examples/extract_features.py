@@ -264,8 +264,11 @@ def main():
             input_ids = input_ids.to(device)
             input_mask = input_mask.to(device)
 
-            all_encoder_layers, _ = model(input_ids, token_type_ids=None, attention_mask=input_mask)
-            all_encoder_layers = all_encoder_layers
+            # Only the requested layers are kept, and the layers above the deepest one are not run.
+            with torch.no_grad():
+                encoded_layers, _ = model(input_ids, token_type_ids=None, attention_mask=input_mask,
+                                          output_layers=layer_indexes)
+            encoded_layers = [layer.cpu().numpy() for layer in encoded_layers]
 
             for b, example_index in enumerate(example_indices):
                 feature = features[example_index.item()]
@@ -277,8 +280,7 @@ def main():
                 for (i, token) in enumerate(feature.tokens):
                     all_layers = []
                     for (j, layer_index) in enumerate(layer_indexes):
-                        layer_output = all_encoder_layers[int(layer_index)].detach().cpu().numpy()
-                        layer_output = layer_output[b]
+                        layer_output = encoded_layers[j][b]
                         layers = collections.OrderedDict()
                         layers["index"] = layer_index
                         layers["values"] = [
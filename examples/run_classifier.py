@@ -31,7 +31,10 @@ from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
+from pytorch_pretrained_bert.batching import (BucketBatchSampler, DistributedBucketBatchSampler,
+                                              TrimPaddingCollate, lengths_from_input_mask)
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from pytorch_pretrained_bert.feature_cache import FeatureCache, feature_cache_key, features_to_arrays
 from pytorch_pretrained_bert.modeling import BertForSequenceClassification, BertConfig, WEIGHTS_NAME, CONFIG_NAME
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from pytorch_pretrained_bert.optimization import BertAdam, warmup_linear
@@ -75,6 +78,13 @@ class InputFeatures(object):
 class DataProcessor(object):
     """Base class for data converters for sequence classification data sets."""
 
+    # The file of each split in the data directory.
+    split_files = {"train": "train.tsv", "dev": "dev.tsv"}
+
+    def get_split_file(self, data_dir, split):
+        """Gets the path of the file read for `split` ("train", "dev" or "test")."""
+        return os.path.join(data_dir, self.split_files[split])
+
     def get_train_examples(self, data_dir):
         """Gets a collection of `InputExample`s for the train set."""
         raise NotImplementedError()
@@ -105,14 +115,14 @@ class MrpcProcessor(DataProcessor):
 
     def get_train_examples(self, data_dir):
         """See base class."""
-        logger.info("LOOKING AT {}".format(os.path.join(data_dir, "train.tsv")))
+        logger.info("LOOKING AT {}".format(self.get_split_file(data_dir, "train")))
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+            self._read_tsv(self.get_split_file(data_dir, "train")), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+            self._read_tsv(self.get_split_file(data_dir, "dev")), "dev")
 
     def get_labels(self):
         """See base class."""
@@ -136,15 +146,17 @@ class MrpcProcessor(DataProcessor):
 class MnliProcessor(DataProcessor):
     """Processor for the MultiNLI data set (GLUE version)."""
 
+    split_files = {"train": "train.tsv", "dev": "dev_matched.tsv"}
+
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+            self._read_tsv(self.get_split_file(data_dir, "train")), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "dev_matched.tsv")),
+            self._read_tsv(self.get_split_file(data_dir, "dev")),
             "dev_matched")
 
     def get_labels(self):
@@ -172,12 +184,12 @@ class ColaProcessor(DataProcessor):
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+            self._read_tsv(self.get_split_file(data_dir, "train")), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+            self._read_tsv(self.get_split_file(data_dir, "dev")), "dev")
 
     def get_labels(self):
         """See base class."""
@@ -201,12 +213,12 @@ class Sst2Processor(DataProcessor):
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "train.tsv")), "train")
+            self._read_tsv(self.get_split_file(data_dir, "train")), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "dev.tsv")), "dev")
+            self._read_tsv(self.get_split_file(data_dir, "dev")), "dev")
 
     def get_labels(self):
         """See base class."""
@@ -229,19 +241,22 @@ class Sst2Processor(DataProcessor):
 class QuescateProcessor(DataProcessor):
     """Processor for the Multi-category (yes, no, depends) data set. Question classification."""
 
+    split_files = {"train": "search.train.yesno.csv", "dev": "search.dev.yesno.csv",
+                   "test": "search.test.yesno.csv"}
+
     def get_train_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "search.train.yesno.csv")), "train")
+            self._read_tsv(self.get_split_file(data_dir, "train")), "train")
 
     def get_dev_examples(self, data_dir):
         """See base class."""
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "search.dev.yesno.csv")), "dev")
+            self._read_tsv(self.get_split_file(data_dir, "dev")), "dev")
 
     def get_test_examples(self, data_dir):
         return self._create_examples(
-            self._read_tsv(os.path.join(data_dir, "search.test.yesno.csv")), "test")
+            self._read_tsv(self.get_split_file(data_dir, "test")), "test")
 
     def get_labels(self):
         """See base class."""
@@ -266,6 +281,23 @@ class QuescateProcessor(DataProcessor):
         return examples
 
 
+def load_or_convert_examples_to_arrays(args, processor, split, examples, label_list, tokenizer, save=True):
+    """Returns the input_ids, input_mask, segment_ids and label_id arrays of `examples`,
+    from the feature cache if they were already built from the same data with the same settings.
+
+    The cache key covers the file the processor read for `split` only, so that other files in
+    the data directory (logs, predictions...) do not invalidate it."""
+    data_files = [processor.get_split_file(args.data_dir, split)]
+    cache_key = feature_cache_key(data_files, tokenizer, script="run_classifier", task_name=args.task_name,
+                                  split=split, label_list=label_list, max_seq_length=args.max_seq_length)
+
+    def build_arrays():
+        features = convert_examples_to_features(examples, label_list, args.max_seq_length, tokenizer)
+        return features_to_arrays(features, ["input_ids", "input_mask", "segment_ids", "label_id"])
+
+    return FeatureCache(args.feature_cache_dir).get_or_create(cache_key, build_arrays, save=save)
+
+
 def convert_examples_to_features(examples, label_list, max_seq_length, tokenizer):
     """Loads a data file into a list of `InputBatch`s."""
 
@@ -408,6 +440,11 @@ def main():
                         help="The maximum total input sequence length after WordPiece tokenization. \n"
                              "Sequences longer than this will be truncated, and sequences shorter \n"
                              "than this will be padded.")
+    parser.add_argument("--feature_cache_dir",
+                        default=None,
+                        type=str,
+                        help="Where to cache the featurized data (defaults to the features directory "
+                             "of the pytorch_pretrained_bert cache).")
     parser.add_argument("--do_train",
                         action='store_true',
                         help="Whether to run training.")
@@ -432,6 +469,22 @@ def main():
                         default=1,
                         type=int,
                         help="Total batch size for eval.")
+    parser.add_argument("--bucket_by_length",
+                        action='store_true',
+                        help="Batch examples of similar lengths together and pad each batch only to its "
+                             "longest example.")
+    parser.add_argument("--max_tokens_per_batch",
+                        default=None,
+                        type=int,
+                        help="With --bucket_by_length, also cap the number of padded tokens in a training batch.")
+    parser.add_argument("--early_exit",
+                        action='store_true',
+                        help="Train a classifier after every encoder layer, to allow early exit at inference.")
+    parser.add_argument("--early_exit_threshold",
+                        default=None,
+                        type=float,
+                        help="With --early_exit, stop at the first layer predicting a label with at least "
+                             "this probability during evaluation.")
     parser.add_argument("--learning_rate",
                         default=5e-5,
                         type=float,
@@ -546,23 +599,45 @@ def main():
 
     if args.do_train:
         train_examples = processor.get_train_examples(args.data_dir)
-        num_train_optimization_steps = int(
-            len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
-        if args.local_rank != -1:
-            num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
+        train_arrays = load_or_convert_examples_to_arrays(
+            args, processor, "train", train_examples, label_list, tokenizer,
+            save=args.local_rank == -1 or torch.distributed.get_rank() == 0)
+        train_data = TensorDataset(*[torch.from_numpy(train_arrays[name]) for name in [
+            "input_ids", "input_mask", "segment_ids", "label_id"]])
+        if args.bucket_by_length:
+            lengths = lengths_from_input_mask(train_data.tensors[1])
+            if args.local_rank == -1:
+                train_sampler = BucketBatchSampler(lengths, args.train_batch_size,
+                                                   max_tokens=args.max_tokens_per_batch, seed=args.seed)
+            else:
+                train_sampler = DistributedBucketBatchSampler(lengths, args.train_batch_size,
+                                                              max_tokens=args.max_tokens_per_batch, seed=args.seed)
+            train_dataloader = DataLoader(train_data, batch_sampler=train_sampler, collate_fn=TrimPaddingCollate())
+            # The number of batches of this process, which may change from one epoch to the next.
+            epoch_lengths = train_sampler.epoch_lengths(int(args.num_train_epochs))
+        else:
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+            epoch_lengths = [len(train_dataloader)] * int(args.num_train_epochs)
+        # One optimization step every gradient_accumulation_steps batches, counted from the start of each epoch.
+        num_train_optimization_steps = sum(length // args.gradient_accumulation_steps for length in epoch_lengths)
 
     # Prepare model (load), download from s3
     if args.do_train or args.do_eval:
         cache_dir = args.cache_dir if args.cache_dir else os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE), 'distributed_{}'.format(args.local_rank))
         model = BertForSequenceClassification.from_pretrained(args.bert_model,
                   cache_dir=cache_dir,
-                  num_labels=num_labels)
+                  num_labels=num_labels,
+                  early_exit=args.early_exit)
     if args.do_predict:
         output_model_file = os.path.join(args.output_dir, WEIGHTS_NAME)
         output_config_file = os.path.join(args.output_dir, CONFIG_NAME)
         # Load a trained model and config that you have fine-tuned
         config = BertConfig(output_config_file)
-        model = BertForSequenceClassification(config, num_labels=num_labels)
+        model = BertForSequenceClassification(config, num_labels=num_labels, early_exit=args.early_exit)
         model.load_state_dict(torch.load(output_model_file))
 
     if args.fp16:
@@ -611,25 +686,14 @@ def main():
     nb_tr_steps = 0
     tr_loss = 0
     if args.do_train:
-        train_features = convert_examples_to_features(
-            train_examples, label_list, args.max_seq_length, tokenizer)
         logger.info("***** Running training *****")
         logger.info("  Num examples = %d", len(train_examples))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_optimization_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
-        else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
-
         model.train()
-        for _ in trange(int(args.num_train_epochs), desc="Epoch"):
+        for epoch in trange(int(args.num_train_epochs), desc="Epoch"):
+            if hasattr(train_sampler, "set_epoch"):
+                train_sampler.set_epoch(epoch)
             tr_loss = 0
             nb_tr_examples, nb_tr_steps = 0, 0
             for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration")):
@@ -659,6 +723,9 @@ def main():
                     optimizer.step()
                     optimizer.zero_grad()
                     global_step += 1
+        # Past t_total, warmup_linear gives a negative learning rate.
+        assert global_step <= num_train_optimization_steps, \
+            "{} optimization steps instead of {}".format(global_step, num_train_optimization_steps)
 
     if args.do_train:
         # Save a trained model and the associated configuration
@@ -671,12 +738,13 @@ def main():
 
         # Load a trained model and config that you have fine-tuned
         config = BertConfig(output_config_file)
-        model = BertForSequenceClassification(config, num_labels=num_labels)
+        model = BertForSequenceClassification(config, num_labels=num_labels, early_exit=args.early_exit)
         model.load_state_dict(torch.load(output_model_file))
 
         model.to(device)
     elif not args.do_train and not args.do_predict:
-        model = BertForSequenceClassification.from_pretrained(args.bert_model, num_labels=num_labels)
+        model = BertForSequenceClassification.from_pretrained(args.bert_model, num_labels=num_labels,
+                                                              early_exit=args.early_exit)
         model.to(device)
 
     """
@@ -684,21 +752,24 @@ def main():
     """
     if args.do_eval and (args.local_rank == -1 or torch.distributed.get_rank() == 0):
         eval_examples = processor.get_dev_examples(args.data_dir)
-        eval_features = convert_examples_to_features(
-            eval_examples, label_list, args.max_seq_length, tokenizer)
+        eval_arrays = load_or_convert_examples_to_arrays(args, processor, "dev", eval_examples, label_list, tokenizer)
         logger.info("***** Running evaluation *****")
         logger.info("  Num examples = %d", len(eval_examples))
         logger.info("  Batch size = %d", args.eval_batch_size)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        eval_data = TensorDataset(*[torch.from_numpy(eval_arrays[name]) for name in [
+            "input_ids", "input_mask", "segment_ids", "label_id"]])
         # Run prediction for full data
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        if args.bucket_by_length:
+            eval_sampler = BucketBatchSampler(lengths_from_input_mask(eval_data.tensors[1]), args.eval_batch_size,
+                                              shuffle=False)
+            eval_dataloader = DataLoader(eval_data, batch_sampler=eval_sampler, collate_fn=TrimPaddingCollate())
+        else:
+            eval_sampler = SequentialSampler(eval_data)
+            eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
         model.eval()
+        if args.early_exit_threshold is not None:
+            model.early_exit_threshold = args.early_exit_threshold
         eval_loss, eval_accuracy = 0, 0
         nb_eval_steps, nb_eval_examples = 0, 0
 
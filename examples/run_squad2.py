@@ -26,7 +26,6 @@ import json
 import math
 import os
 import random
-import pickle
 from tqdm import tqdm, trange
 
 import numpy as np
@@ -38,6 +37,7 @@ from pytorch_pretrained_bert.tokenization import whitespace_tokenize, BasicToken
 from pytorch_pretrained_bert.modeling import BertForQuestionAnswering
 from pytorch_pretrained_bert.optimization import BertAdam
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from pytorch_pretrained_bert.feature_cache import FeatureCache, feature_cache_key, features_to_arrays
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -937,6 +937,9 @@ def main():
     parser.add_argument("--max_query_length", default=64, type=int,
                         help="The maximum number of tokens for the question. Questions longer than this will "
                              "be truncated to this length.")
+    parser.add_argument("--feature_cache_dir", default=None, type=str,
+                        help="Where to cache the featurized training data (defaults to the features "
+                             "directory of the pytorch_pretrained_bert cache).")
     parser.add_argument("--do_train", default=False, action='store_true', help="Whether to run training.")
     parser.add_argument("--do_predict", default=False, action='store_true', help="Whether to run eval on the dev set.")
     parser.add_argument("--train_batch_size", default=32, type=int, help="Total batch size for training.")
@@ -1109,27 +1112,12 @@ def main():
 
     global_step = 0
     if args.do_train:
-        cached_train_features_file = args.train_file+'_{0}_{1}_{2}_{3}'.format(
-            args.bert_model, str(args.max_seq_length), str(args.doc_stride), str(args.max_query_length))
-        train_features = None
-        try:
-            with open(cached_train_features_file, "rb") as reader:
-                train_features = pickle.load(reader)
-        except:
-            train_features = convert_examples_to_features(
-                examples=train_examples,
-                tokenizer=tokenizer,
-                max_seq_length=args.max_seq_length,  # default=384
-                doc_stride=args.doc_stride,  # default=128
-                max_query_length=args.max_query_length,  # default=64
-                is_training=True)
-            if args.local_rank == -1 or torch.distributed.get_rank() == 0:
-                logger.info("  Saving train features into cached file %s", cached_train_features_file)
-                with open(cached_train_features_file, "wb") as writer:
-                    pickle.dump(train_features, writer)
-
+        feature_cache = FeatureCache(args.feature_cache_dir)
+        cache_key = feature_cache_key(args.train_file, tokenizer, script="run_squad2",
+                                      max_seq_length=args.max_seq_length, doc_stride=args.doc_stride,
+                                      max_query_length=args.max_query_length)
 
-        try:
+        def build_train_features():
             train_features = convert_examples_to_features(
                 examples=train_examples,
                 tokenizer=tokenizer,
@@ -1137,28 +1125,18 @@ def main():
                 doc_stride=args.doc_stride,  # default=128
                 max_query_length=args.max_query_length,  # default=64
                 is_training=True)
-            if args.local_rank == -1 or torch.distributed.get_rank() == 0:
-                logger.info("  Saving train features into cached file %s", cached_train_features_file)
-                with open(cached_train_features_file, "wb") as writer:
-                    pickle.dump(train_features, writer)
-
-            with open(cached_train_features_file, "rb") as reader:
-                train_features = pickle.load(reader)
-
+            return features_to_arrays(train_features, ["input_ids", "input_mask", "segment_ids",
+                                                       "start_position", "end_position", "is_impossible"])
 
+        train_arrays = feature_cache.get_or_create(
+            cache_key, build_train_features, save=args.local_rank == -1 or torch.distributed.get_rank() == 0)
         logger.info("***** Running training *****")
         logger.info("  Num orig examples = %d", len(train_examples))
-        logger.info("  Num split examples = %d", len(train_features))
+        logger.info("  Num split examples = %d", len(train_arrays["input_ids"]))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_start_positions = torch.tensor([f.start_position for f in train_features], dtype=torch.long)
-        all_end_positions = torch.tensor([f.end_position for f in train_features], dtype=torch.long)
-        all_is_impossibles = torch.tensor([int(f.is_impossible) for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                   all_start_positions, all_end_positions, all_is_impossibles)
+        train_data = TensorDataset(*[torch.from_numpy(train_arrays[name]) for name in [
+            "input_ids", "input_mask", "segment_ids", "start_position", "end_position", "is_impossible"]])
         if args.local_rank == -1:
             train_sampler = RandomSampler(train_data)
         else:
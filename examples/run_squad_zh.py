@@ -26,7 +26,6 @@ import json
 import math
 import os
 import random
-import pickle
 from tqdm import tqdm, trange
 
 import numpy as np
@@ -39,6 +38,7 @@ from pytorch_pretrained_bert.modeling import BertForQuestionAnswering
 # from pytorch_pretrained_bert.modeling import BertForQuestionAnswerLSTMDropout as BertForQuestionAnswering
 from pytorch_pretrained_bert.optimization import BertAdam
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from pytorch_pretrained_bert.feature_cache import FeatureCache, feature_cache_key, features_to_arrays
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -59,10 +59,14 @@ class SquadExample(object):
                  orig_answer_text=None,
                  start_position=None,
                  end_position=None,
-                 is_impossible=None):
+                 is_impossible=None,
+                 paragraph_text=None,
+                 char_to_word_offset=None):
         self.qas_id = qas_id
         self.question_text = question_text
         self.doc_tokens = doc_tokens
+        self.paragraph_text = paragraph_text
+        self.char_to_word_offset = char_to_word_offset
         self.orig_answer_text = orig_answer_text
         self.start_position = start_position
         self.end_position = end_position
@@ -104,12 +108,14 @@ class InputFeatures(object):
                  segment_ids,
                  start_position=None,
                  end_position=None,
-                 is_impossible=None):
+                 is_impossible=None,
+                 token_to_char_span=None):
         self.unique_id = unique_id
         self.example_index = example_index
         self.doc_span_index = doc_span_index
         self.tokens = tokens
         self.token_to_orig_map = token_to_orig_map
+        self.token_to_char_span = token_to_char_span
         self.token_is_max_context = token_is_max_context
         self.input_ids = input_ids
         self.input_mask = input_mask
@@ -292,7 +298,9 @@ def read_squad_examples(input_file, is_training):
                     orig_answer_text=orig_answer_text,
                     start_position=start_position,
                     end_position=end_position,
-                    is_impossible=is_impossible)
+                    is_impossible=is_impossible,
+                    paragraph_text=paragraph_text,
+                    char_to_word_offset=char_to_word_offset)
                 examples.append(example)
     return examples
 
@@ -332,15 +340,8 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
         if len(query_tokens) > max_query_length:  # max_query_length=64(default)
             query_tokens = query_tokens[0:max_query_length]
 
-        tok_to_orig_index = []
-        orig_to_tok_index = []
-        all_doc_tokens = []
-        for (i, token) in enumerate(example.doc_tokens):  # one by one chinese word.
-            orig_to_tok_index.append(len(all_doc_tokens))
-            sub_tokens = tokenizer.tokenize(token)  # eg: puppeteer --> ['puppet', '##eer']
-            for sub_token in sub_tokens:
-                tok_to_orig_index.append(i)
-                all_doc_tokens.append(sub_token)
+        (all_doc_tokens, tok_to_orig_index, orig_to_tok_index,
+         tok_to_char_span) = _tokenize_doc_tokens(example, tokenizer)
 
         tok_start_position = None
         tok_end_position = None
@@ -380,6 +381,7 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
         for (doc_span_index, doc_span) in enumerate(doc_spans):
             tokens = []
             token_to_orig_map = {}
+            token_to_char_span = {} if tok_to_char_span is not None else None
             token_is_max_context = {}
             segment_ids = []
             tokens.append("[CLS]")
@@ -393,6 +395,8 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
             for i in range(doc_span.length):
                 split_token_index = doc_span.start + i
                 token_to_orig_map[len(tokens)] = tok_to_orig_index[split_token_index]
+                if tok_to_char_span is not None:
+                    token_to_char_span[len(tokens)] = tok_to_char_span[split_token_index]
 
                 is_max_context = _check_is_max_context(doc_spans, doc_span_index,
                                                        split_token_index)
@@ -479,12 +483,48 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
                     segment_ids=segment_ids,
                     start_position=start_position,
                     end_position=end_position,
-                    is_impossible=example.is_impossible))
+                    is_impossible=example.is_impossible,
+                    token_to_char_span=token_to_char_span))
             unique_id += 1
 
     return features
 
 
+def _tokenize_doc_tokens(example, tokenizer):
+    """Wordpiece-tokenizes the document of an example.
+
+    When the example keeps its paragraph text, the whole paragraph is tokenized once with
+    character offsets, so every wordpiece also knows its `(start, end)` span in the paragraph
+    and predictions can be read back from it directly. Otherwise each whitespace-separated
+    doc token is tokenized on its own.
+
+    Returns:
+        A tuple `(all_doc_tokens, tok_to_orig_index, orig_to_tok_index, tok_to_char_span)`,
+        `tok_to_char_span` being None when the paragraph text is unknown.
+    """
+    if example.paragraph_text is None:
+        tok_to_orig_index = []
+        orig_to_tok_index = []
+        all_doc_tokens = []
+        for (i, token) in enumerate(example.doc_tokens):  # one by one chinese word.
+            orig_to_tok_index.append(len(all_doc_tokens))
+            sub_tokens = tokenizer.tokenize(token)  # eg: puppeteer --> ['puppet', '##eer']
+            for sub_token in sub_tokens:
+                tok_to_orig_index.append(i)
+                all_doc_tokens.append(sub_token)
+        return all_doc_tokens, tok_to_orig_index, orig_to_tok_index, None
+
+    all_doc_tokens, tok_to_char_span = tokenizer.tokenize_with_offsets(example.paragraph_text)
+    tok_to_orig_index = [example.char_to_word_offset[start] for (start, _) in tok_to_char_span]
+    orig_to_tok_index = []
+    tok_index = 0
+    for i in range(len(example.doc_tokens)):
+        while tok_index < len(tok_to_orig_index) and tok_to_orig_index[tok_index] < i:
+            tok_index += 1
+        orig_to_tok_index.append(tok_index)
+    return all_doc_tokens, tok_to_orig_index, orig_to_tok_index, tok_to_char_span
+
+
 def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
                          orig_answer_text):
     """Returns tokenized answer spans that better match the annotated answer."""
@@ -705,7 +745,15 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
             if len(nbest) >= n_best_size:  # n_best_size=20, nbest(=[]) just save 20 pred results.
                 break
             feature = features[pred.feature_index]
-            if pred.start_index > 0:
+            if pred.start_index > 0 and feature.token_to_char_span is not None:
+                # The wordpieces know their span in the paragraph, no need to re-align.
+                char_start = feature.token_to_char_span[pred.start_index][0]
+                char_end = feature.token_to_char_span[pred.end_index][1]
+                final_text = example.paragraph_text[char_start:char_end]
+                if final_text in seen_predictions:
+                    continue
+                seen_predictions[final_text] = True
+            elif pred.start_index > 0:
                 tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
                 orig_doc_start = feature.token_to_orig_map[pred.start_index]
                 orig_doc_end = feature.token_to_orig_map[pred.end_index]
@@ -1020,6 +1068,9 @@ def main():
     parser.add_argument("--max_query_length", default=64, type=int,
                         help="The maximum number of tokens for the question. Questions longer than this will "
                              "be truncated to this length.")
+    parser.add_argument("--feature_cache_dir", default=None, type=str,
+                        help="Where to cache the featurized training data (defaults to the features "
+                             "directory of the pytorch_pretrained_bert cache).")
     parser.add_argument("--do_train", default=False, action='store_true', help="Whether to run training.")
     parser.add_argument("--do_predict", default=False, action='store_true', help="Whether to run eval on the dev set.")
     parser.add_argument("--train_batch_size", default=32, type=int, help="Total batch size for training.")
@@ -1192,13 +1243,12 @@ def main():
 
     global_step = 0
     if args.do_train:
-        cached_train_features_file = args.train_file+'_{0}_{1}_{2}_{3}'.format(
-            args.bert_model, str(args.max_seq_length), str(args.doc_stride), str(args.max_query_length))
-        train_features = None
-        try:
-            with open(cached_train_features_file, "rb") as reader:
-                train_features = pickle.load(reader)
-        except:
+        feature_cache = FeatureCache(args.feature_cache_dir)
+        cache_key = feature_cache_key(args.train_file, tokenizer, script="run_squad_zh",
+                                      max_seq_length=args.max_seq_length, doc_stride=args.doc_stride,
+                                      max_query_length=args.max_query_length)
+
+        def build_train_features():
             train_features = convert_examples_to_features(
                 examples=train_examples,
                 tokenizer=tokenizer,
@@ -1206,23 +1256,18 @@ def main():
                 doc_stride=args.doc_stride,  # default=128
                 max_query_length=args.max_query_length,  # default=64
                 is_training=True)
-            if args.local_rank == -1 or torch.distributed.get_rank() == 0:
-                logger.info("  Saving train features into cached file %s", cached_train_features_file)
-                with open(cached_train_features_file, "wb") as writer:
-                    pickle.dump(train_features, writer)
+            return features_to_arrays(train_features, ["input_ids", "input_mask", "segment_ids",
+                                                       "start_position", "end_position", "is_impossible"])
+
+        train_arrays = feature_cache.get_or_create(
+            cache_key, build_train_features, save=args.local_rank == -1 or torch.distributed.get_rank() == 0)
         logger.info("***** Running training *****")
         logger.info("  Num orig examples = %d", len(train_examples))
-        logger.info("  Num split examples = %d", len(train_features))
+        logger.info("  Num split examples = %d", len(train_arrays["input_ids"]))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_start_positions = torch.tensor([f.start_position for f in train_features], dtype=torch.long)
-        all_end_positions = torch.tensor([f.end_position for f in train_features], dtype=torch.long)
-        all_is_impossibles = torch.tensor([int(f.is_impossible) for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                   all_start_positions, all_end_positions, all_is_impossibles)
+        train_data = TensorDataset(*[torch.from_numpy(train_arrays[name]) for name in [
+            "input_ids", "input_mask", "segment_ids", "start_position", "end_position", "is_impossible"]])
         if args.local_rank == -1:
             train_sampler = RandomSampler(train_data)
         else:
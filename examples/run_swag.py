@@ -31,6 +31,7 @@ from pytorch_pretrained_bert.tokenization import BertTokenizer
 from pytorch_pretrained_bert.modeling import BertForMultipleChoice
 from pytorch_pretrained_bert.optimization import BertAdam
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+from pytorch_pretrained_bert.feature_cache import FeatureCache, feature_cache_key
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -233,6 +234,21 @@ def select_field(features, field):
         for feature in features
     ]
 
+
+def load_or_convert_examples_to_arrays(args, input_file, examples, tokenizer, save=True):
+    """Returns the input_ids, input_mask, segment_ids and label arrays of `examples`,
+    from the feature cache if they were already built from the same file with the same settings."""
+    cache_key = feature_cache_key(input_file, tokenizer, script="run_swag", max_seq_length=args.max_seq_length)
+
+    def build_arrays():
+        features = convert_examples_to_features(examples, tokenizer, args.max_seq_length, True)
+        arrays = {field: np.array(select_field(features, field), dtype=np.int64)
+                  for field in ["input_ids", "input_mask", "segment_ids"]}
+        arrays["label"] = np.array([f.label for f in features], dtype=np.int64)
+        return arrays
+
+    return FeatureCache(args.feature_cache_dir).get_or_create(cache_key, build_arrays, save=save)
+
 def warmup_linear(x, warmup=0.002):
     if x < warmup:
         return x/warmup
@@ -264,6 +280,11 @@ def main():
                         help="The maximum total input sequence length after WordPiece tokenization. \n"
                              "Sequences longer than this will be truncated, and sequences shorter \n"
                              "than this will be padded.")
+    parser.add_argument("--feature_cache_dir",
+                        default=None,
+                        type=str,
+                        help="Where to cache the featurized data (defaults to the features directory "
+                             "of the pytorch_pretrained_bert cache).")
     parser.add_argument("--do_train",
                         action='store_true',
                         help="Whether to run training.")
@@ -415,17 +436,15 @@ def main():
 
     global_step = 0
     if args.do_train:
-        train_features = convert_examples_to_features(
-            train_examples, tokenizer, args.max_seq_length, True)
+        train_arrays = load_or_convert_examples_to_arrays(
+            args, os.path.join(args.data_dir, 'train.csv'), train_examples, tokenizer,
+            save=args.local_rank == -1 or torch.distributed.get_rank() == 0)
         logger.info("***** Running training *****")
         logger.info("  Num examples = %d", len(train_examples))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_steps)
-        all_input_ids = torch.tensor(select_field(train_features, 'input_ids'), dtype=torch.long)
-        all_input_mask = torch.tensor(select_field(train_features, 'input_mask'), dtype=torch.long)
-        all_segment_ids = torch.tensor(select_field(train_features, 'segment_ids'), dtype=torch.long)
-        all_label = torch.tensor([f.label for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
+        train_data = TensorDataset(*[torch.from_numpy(train_arrays[name]) for name in [
+            "input_ids", "input_mask", "segment_ids", "label"]])
         if args.local_rank == -1:
             train_sampler = RandomSampler(train_data)
         else:
@@ -479,15 +498,13 @@ def main():
 
     if args.do_eval and (args.local_rank == -1 or torch.distributed.get_rank() == 0):
         eval_examples = read_swag_examples(os.path.join(args.data_dir, 'val.csv'), is_training = True)
-        eval_features = convert_examples_to_features(
-            eval_examples, tokenizer, args.max_seq_length, True)
+        eval_arrays = load_or_convert_examples_to_arrays(
+            args, os.path.join(args.data_dir, 'val.csv'), eval_examples, tokenizer)
         logger.info("***** Running evaluation *****")
         logger.info("  Num examples = %d", len(eval_examples))
         logger.info("  Batch size = %d", args.eval_batch_size)
-        all_input_ids = torch.tensor(select_field(eval_features, 'input_ids'), dtype=torch.long)
-        all_input_mask = torch.tensor(select_field(eval_features, 'input_mask'), dtype=torch.long)
-        all_segment_ids = torch.tensor(select_field(eval_features, 'segment_ids'), dtype=torch.long)
-        all_label = torch.tensor([f.label for f in eval_features], dtype=torch.long)
+        all_input_ids, all_input_mask, all_segment_ids, all_label = [
+            torch.from_numpy(eval_arrays[name]) for name in ["input_ids", "input_mask", "segment_ids", "label"]]
         eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
         # Run prediction for full data
         eval_sampler = SequentialSampler(eval_data)
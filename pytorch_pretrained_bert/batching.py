@@ -0,0 +1,194 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Length-bucketed batching: batches of features of similar lengths, padded to their own maximum."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import math
+import random
+
+import torch
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
+
+
+def lengths_from_input_mask(input_mask):
+    """Returns the true length of every feature of a [num_features, ..., seq_length] input mask as a list.
+
+    For multiple choice features ([num_features, num_choices, seq_length]) this is the length of
+    the longest choice.
+    """
+    lengths = input_mask.ne(0).sum(-1)
+    while lengths.dim() > 1:
+        lengths = lengths.max(-1)[0]
+    return lengths.tolist()
+
+
+class BucketBatchSampler(Sampler):
+    """Yields batches of indices of features with similar lengths.
+
+    Features are shuffled, taken `bucket_size_multiplier` batches at a time, sorted by length
+    within these pools and cut into batches, and the batches are shuffled. Without `shuffle`,
+    all the features are sorted by length (for inference).
+
+    Params:
+        lengths: the true length of every feature, e.g. `lengths_from_input_mask(all_input_mask)`.
+        batch_size: maximum number of features in a batch.
+        max_tokens: maximum number of (padded) tokens in a batch, i.e. its number of features
+            times the length of its longest feature. At least one of `batch_size` and
+            `max_tokens` must be given. A feature longer than `max_tokens` gets a batch of its own.
+        shuffle: whether to shuffle the features and the batches.
+        bucket_size_multiplier: size of the pools sorted by length, in number of batches.
+        drop_last: whether to drop the last batch of each pool if it is smaller than `batch_size`.
+        seed: the random seed, combined with the epoch set by `set_epoch`.
+    """
+
+    def __init__(self, lengths, batch_size=None, max_tokens=None, shuffle=True, bucket_size_multiplier=100,
+                 drop_last=False, seed=0):
+        if batch_size is None and max_tokens is None:
+            raise ValueError("At least one of batch_size and max_tokens must be given")
+        if batch_size is not None and batch_size <= 0:
+            raise ValueError("batch_size should be a positive integer, got {}".format(batch_size))
+        if max_tokens is not None and max_tokens <= 0:
+            raise ValueError("max_tokens should be a positive integer, got {}".format(max_tokens))
+        self.lengths = list(lengths)
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.bucket_size_multiplier = bucket_size_multiplier
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        """Sets the epoch used to seed the shuffling, as `DistributedSampler.set_epoch`."""
+        self.epoch = epoch
+
+    def _pool_size(self):
+        if self.batch_size is not None:
+            return self.batch_size * self.bucket_size_multiplier
+        average_length = max(1, sum(self.lengths) // max(1, len(self.lengths)))
+        return max(1, self.max_tokens // average_length) * self.bucket_size_multiplier
+
+    def _split_batches(self, indices):
+        """Cuts `indices`, sorted by length, into batches."""
+        batches = []
+        batch = []
+        batch_max_length = 0
+        for index in indices:
+            length = max(self.lengths[index], batch_max_length)
+            full = self.batch_size is not None and len(batch) == self.batch_size
+            over_budget = self.max_tokens is not None and length * (len(batch) + 1) > self.max_tokens
+            if batch and (full or over_budget):
+                batches.append(batch)
+                batch = []
+                length = self.lengths[index]
+            batch.append(index)
+            batch_max_length = length
+        if batch and not (self.drop_last and self.batch_size is not None and len(batch) < self.batch_size):
+            batches.append(batch)
+        return batches
+
+    def batches(self):
+        """Returns the list of batches of the current epoch."""
+        indices = list(range(len(self.lengths)))
+        if not self.shuffle:
+            indices.sort(key=lambda index: self.lengths[index])
+            return self._split_batches(indices)
+        rng = random.Random(self.seed + self.epoch)
+        rng.shuffle(indices)
+        pool_size = self._pool_size()
+        batches = []
+        for start in range(0, len(indices), pool_size):
+            pool = sorted(indices[start:start + pool_size], key=lambda index: self.lengths[index])
+            batches.extend(self._split_batches(pool))
+        rng.shuffle(batches)
+        return batches
+
+    def __iter__(self):
+        return iter(self.batches())
+
+    def __len__(self):
+        return len(self.batches())
+
+    def epoch_lengths(self, num_epochs):
+        """Returns the number of batches of each of the epochs 0, ..., num_epochs - 1.
+
+        With `max_tokens` the number of batches depends on how the features fall into the pools,
+        so it can change from one epoch to the next. Use this rather than `len` to count the
+        optimization steps of a training run.
+        """
+        epoch = self.epoch
+        lengths = []
+        for other_epoch in range(num_epochs):
+            self.set_epoch(other_epoch)
+            lengths.append(len(self))
+        self.set_epoch(epoch)
+        return lengths
+
+
+class DistributedBucketBatchSampler(BucketBatchSampler):
+    """A `BucketBatchSampler` that can replace a `DistributedSampler`.
+
+    All the processes build the same batches (same seed and epoch) and each one takes every
+    `num_replicas`-th of them. Batches are repeated so that every process gets the same
+    number of batches.
+
+    Params:
+        num_replicas, rank: as in `DistributedSampler`, by default taken from the default
+            process group.
+        See `BucketBatchSampler` for the other parameters.
+    """
+
+    def __init__(self, lengths, batch_size=None, max_tokens=None, num_replicas=None, rank=None, **kwargs):
+        super(DistributedBucketBatchSampler, self).__init__(lengths, batch_size=batch_size,
+                                                            max_tokens=max_tokens, **kwargs)
+        if num_replicas is None:
+            num_replicas = torch.distributed.get_world_size()
+        if rank is None:
+            rank = torch.distributed.get_rank()
+        self.num_replicas = num_replicas
+        self.rank = rank
+
+    def batches(self):
+        batches = super(DistributedBucketBatchSampler, self).batches()
+        if not batches:
+            return batches
+        num_batches = int(math.ceil(len(batches) / self.num_replicas)) * self.num_replicas
+        # Repeated cyclically: there may be fewer batches than half the replicas.
+        batches = (batches * int(math.ceil(num_batches / len(batches))))[:num_batches]
+        return batches[self.rank:num_batches:self.num_replicas]
+
+
+class TrimPaddingCollate(object):
+    """Collate function cutting the padding of a batch of features padded at the end down to its longest feature.
+
+    Items are tuples of tensors as returned by a `TensorDataset`. Every tensor of at least two
+    dimensions (after batching) whose last dimension is the padded sequence length is cut to
+    the longest true length in the batch, read from the input mask at `mask_index`.
+    """
+
+    def __init__(self, mask_index=1):
+        self.mask_index = mask_index
+
+    def __call__(self, items):
+        batch = default_collate(items)
+        input_mask = batch[self.mask_index]
+        seq_length = input_mask.size(-1)
+        max_length = max(1, int(input_mask.ne(0).sum(-1).max())) if input_mask.numel() else seq_length
+        return [tensor[..., :max_length] if tensor.dim() >= 2 and tensor.size(-1) == seq_length else tensor
+                for tensor in batch]
@@ -0,0 +1,236 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Export of `PreTrainedBertModel`s for inference without the Python model code, to TorchScript
+(`export_torchscript`) or to ONNX (`export_onnx`, run on CPU with ONNX Runtime by `OnnxRuntimeModel`).
+
+The exported models take the three input tensors of the models, all required (pass zeros as
+`token_type_ids` and ones as `attention_mask` for single unpadded sentences):
+    input_ids, token_type_ids, attention_mask: torch.LongTensor of shape [batch_size, sequence_length]
+and return the inference outputs of the model (its `forward` without labels):
+    `BertModel`: (sequence_output, pooled_output), i.e. `output_all_encoded_layers=False`;
+    `BertForSequenceClassification`: logits of shape [batch_size, num_labels];
+    `BertForQuestionAnswering`: (start_logits, end_logits) of shape [batch_size, sequence_length];
+    `BertForTokenClassification`: logits of shape [batch_size, sequence_length, num_labels].
+The batch size and the sequence length may differ from those of the example inputs.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import inspect
+import logging
+
+import numpy as np
+import torch
+from torch import nn
+
+from .modeling import BertModel, BertForPreTraining, BertForQuestionAnswering
+
+logger = logging.getLogger(__name__)
+
+INPUT_NAMES = ["input_ids", "token_type_ids", "attention_mask"]
+
+
+class InferenceOutputs(nn.Module):
+    """Calls `model` with the three input tensors and returns its inference outputs as tensors."""
+
+    def __init__(self, model):
+        super(InferenceOutputs, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, token_type_ids, attention_mask):
+        if isinstance(self.model, BertModel):
+            return self.model(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+        return self.model(input_ids, token_type_ids, attention_mask)
+
+
+def check_exportable(model):
+    """Raises a ValueError if the outputs of `model` depend on its inputs in ways a traced graph cannot follow."""
+    config = model.config
+    if getattr(config, "packed_execution", False):
+        raise ValueError("Models with packed_execution cannot be exported: the packing depends on the attention mask")
+    if getattr(config, "attention_chunk_size", 0) > 0:
+        raise ValueError("Models with attention_chunk_size cannot be exported: the number of chunks depends "
+                         "on the sequence length")
+    if getattr(model, "early_exit_threshold", None) is not None:
+        raise ValueError("Models with an early_exit_threshold cannot be exported: the layers run depend on the inputs")
+
+
+def example_inputs(model, batch_size=2, seq_length=16):
+    """Returns random (input_ids, token_type_ids, attention_mask) for `model`, with some padding in the last sequence."""
+    device = next(model.parameters()).device
+    input_ids = torch.randint(0, model.config.vocab_size, (batch_size, seq_length), dtype=torch.long, device=device)
+    token_type_ids = torch.zeros_like(input_ids)
+    token_type_ids[:, seq_length // 2:] = 1
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[-1, seq_length - seq_length // 4:] = 0
+    return input_ids, token_type_ids, attention_mask
+
+
+def _as_tuple(outputs):
+    return outputs if isinstance(outputs, tuple) else (outputs,)
+
+
+def _other_example_inputs(model, inputs):
+    """Returns example inputs of another batch size and sequence length than `inputs`."""
+    batch_size, seq_length = inputs[0].size()
+    if seq_length + 3 > model.config.max_position_embeddings:
+        return example_inputs(model, batch_size=batch_size + 1, seq_length=max(1, seq_length - 3))
+    return example_inputs(model, batch_size=batch_size + 1, seq_length=seq_length + 3)
+
+
+def check_outputs(model, exported, inputs, atol=1e-4):
+    """Raises a ValueError if `exported(*inputs)` (a callable returning tensors) differs from the outputs of `model`."""
+    with torch.no_grad():
+        expected = _as_tuple(InferenceOutputs(model)(*inputs))
+        outputs = _as_tuple(exported(*inputs))
+    if len(outputs) != len(expected):
+        raise ValueError("The exported model returns {} outputs instead of {}".format(len(outputs), len(expected)))
+    for output, expected_output in zip(outputs, expected):
+        output = torch.as_tensor(output).to(expected_output.device)
+        if output.shape != expected_output.shape or not torch.allclose(output, expected_output, atol=atol):
+            raise ValueError("The outputs of the exported model differ from those of the model "
+                             "(max difference {})".format((output - expected_output).abs().max().item()
+                                                          if output.shape == expected_output.shape else "n/a"))
+
+
+def export_torchscript(model, path=None, inputs=None, freeze=True):
+    """Traces the inference forward pass of `model` into a TorchScript module.
+
+    Params:
+        model: a `PreTrainedBertModel` (e.g. `BertModel`, `BertForSequenceClassification`,
+            `BertForQuestionAnswering`, `BertForTokenClassification`). It is put in eval mode.
+        path: where to save the module, if given. `torch.jit.load(path)` loads it back without
+            this package.
+        inputs: the example (input_ids, token_type_ids, attention_mask) to trace with. Random by default.
+        freeze: whether to freeze the module (its weights become constants of the graph, which
+            lets the JIT fold and fuse more and lowers the per-call overhead).
+
+    The module is checked against the model on inputs of another batch size and sequence length.
+    Returns the `torch.jit.ScriptModule`.
+    """
+    check_exportable(model)
+    model.eval()
+    if inputs is None:
+        inputs = example_inputs(model)
+    with torch.no_grad():
+        traced = torch.jit.trace(InferenceOutputs(model).eval(), tuple(inputs), check_trace=False)
+    if freeze:
+        traced = torch.jit.freeze(traced)
+    check_outputs(model, traced, _other_example_inputs(model, inputs))
+    if path is not None:
+        torch.jit.save(traced, path)
+        logger.info("Saved the TorchScript module of %s to %s", model.__class__.__name__, path)
+    return traced
+
+
+def output_names(model):
+    """Returns the names of the outputs of `model` in an exported graph."""
+    if isinstance(model, BertModel):
+        return ["sequence_output", "pooled_output"]
+    if isinstance(model, BertForQuestionAnswering):
+        return ["start_logits", "end_logits"]
+    if isinstance(model, BertForPreTraining):
+        return ["prediction_scores", "seq_relationship_score"]
+    return ["logits"]
+
+
+def _dynamic_axes(model, inputs):
+    """Returns the dynamic axes of the inputs and outputs: the batch axis, and the sequence axis where it is kept."""
+    with torch.no_grad():
+        outputs = _as_tuple(InferenceOutputs(model)(*inputs))
+        other_outputs = _as_tuple(InferenceOutputs(model)(*_other_example_inputs(model, inputs)))
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in INPUT_NAMES}
+    for name, output, other_output in zip(output_names(model), outputs, other_outputs):
+        dynamic_axes[name] = {0: "batch"}
+        if output.dim() > 1 and output.size(1) != other_output.size(1):
+            dynamic_axes[name][1] = "sequence"
+    return dynamic_axes
+
+
+def export_onnx(model, path, inputs=None, opset_version=None, check=True):
+    """Exports the inference forward pass of `model` to an ONNX graph with dynamic batch and sequence axes.
+
+    Params:
+        model: a `PreTrainedBertModel`, as for `export_torchscript`. It is put in eval mode.
+            Quantized models cannot be exported: quantize the exported graph with ONNX Runtime instead.
+        path: where to save the graph.
+        inputs: the example (input_ids, token_type_ids, attention_mask) to export with. Random by default.
+        opset_version: the ONNX opset to target, the default of `torch.onnx.export` if None.
+        check: whether to check the graph against the model with `OnnxRuntimeModel` (needs onnxruntime),
+            on inputs of another batch size and sequence length.
+
+    The graph has the inputs "input_ids", "token_type_ids" and "attention_mask" and the outputs
+    named by `output_names(model)`.
+    """
+    check_exportable(model)
+    if getattr(model.config, "quantized", False):
+        raise ValueError("Quantized models cannot be exported to ONNX")
+    model.eval()
+    if inputs is None:
+        inputs = example_inputs(model)
+    kwargs = {}
+    if opset_version is not None:
+        kwargs["opset_version"] = opset_version
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # The graph is traced, as by `export_torchscript`.
+        kwargs["dynamo"] = False
+    with torch.no_grad():
+        torch.onnx.export(InferenceOutputs(model).eval(), tuple(inputs), path, input_names=INPUT_NAMES,
+                          output_names=output_names(model), dynamic_axes=_dynamic_axes(model, inputs), **kwargs)
+    if check:
+        check_outputs(model, OnnxRuntimeModel(path), _other_example_inputs(model, inputs))
+    logger.info("Saved the ONNX graph of %s to %s", model.__class__.__name__, path)
+
+
+class OnnxRuntimeModel(object):
+    """Runs a model exported by `export_onnx` with ONNX Runtime, called as the `forward` of the model.
+
+    Params:
+        path: the ONNX graph.
+        num_threads: number of threads of the ONNX Runtime session (its default if None).
+        providers: the ONNX Runtime execution providers, ["CPUExecutionProvider"] by default.
+
+    Calls take torch.LongTensors (or arrays) as the model and return torch.FloatTensors: the logits
+    of the classification heads, the (start_logits, end_logits) of `BertForQuestionAnswering` and
+    the (sequence_output, pooled_output) of `BertModel`.
+    """
+
+    def __init__(self, path, num_threads=None, providers=None):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("Running exported ONNX models requires onnxruntime: `pip install onnxruntime`")
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads is not None:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(path, options,
+                                                    providers=providers or ["CPUExecutionProvider"])
+        self.output_names = [output.name for output in self.session.get_outputs()]
+
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None):
+        input_ids = torch.as_tensor(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        feed = {name: np.ascontiguousarray(torch.as_tensor(tensor).cpu().numpy().astype(np.int64))
+                for name, tensor in zip(INPUT_NAMES, [input_ids, token_type_ids, attention_mask])}
+        outputs = tuple(torch.from_numpy(output) for output in self.session.run(self.output_names, feed))
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    __call__ = forward
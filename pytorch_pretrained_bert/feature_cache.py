@@ -0,0 +1,161 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""On-disk cache of featurized datasets, stored as columns of NumPy arrays."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import logging
+import os
+import tempfile
+import zipfile
+from hashlib import sha256
+
+import numpy as np
+
+from .file_utils import PYTORCH_PRETRAINED_BERT_CACHE
+
+logger = logging.getLogger(__name__)
+
+# Bump when the layout of the cached files or the meaning of the key changes.
+FEATURE_CACHE_VERSION = 1
+_METADATA_NAME = "__metadata__"
+
+
+def file_hash(path):
+    """Returns the sha256 hex digest of the content of a file."""
+    digest = sha256()
+    with open(path, "rb") as reader:
+        for block in iter(lambda: reader.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def vocab_hash(tokenizer):
+    """Returns the sha256 hex digest of the vocabulary of a `BertTokenizer`, tokens in id order."""
+    digest = sha256()
+    for token, index in tokenizer.vocab.items():
+        digest.update("{}\t{}\n".format(token, index).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def feature_cache_key(input_files, tokenizer, **params):
+    """Returns the cache key of the features built from `input_files` with `tokenizer`.
+
+    Params:
+        input_files: the path (or list of paths) of the data the features are built from.
+            The key depends on their content, not on their name or modification time.
+        tokenizer: the `BertTokenizer` used. The key depends on its vocab, `do_lower_case` and
+            `never_split`.
+        params: everything else the features depend on (max_seq_length, doc_stride, ...),
+            as JSON-serializable values.
+    """
+    if isinstance(input_files, str):
+        input_files = [input_files]
+    description = {
+        "version": FEATURE_CACHE_VERSION,
+        "inputs": [file_hash(path) for path in input_files],
+        "vocab": vocab_hash(tokenizer),
+        "do_lower_case": tokenizer.basic_tokenizer.do_lower_case,
+        "never_split": sorted(tokenizer.basic_tokenizer.never_split),
+        "params": params,
+    }
+    return sha256(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def features_to_arrays(features, names, dtype=np.int64):
+    """Gathers the attribute `name` of all the features into one array for each of `names`."""
+    return {name: np.array([getattr(feature, name) for feature in features], dtype=dtype) for name in names}
+
+
+def _array_checksum(array):
+    return sha256(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+class FeatureCache(object):
+    """A directory of featurized datasets, one `.npz` file of named NumPy arrays per key.
+
+    Each file records its key and a checksum of every array. A file that cannot be read,
+    was written for another key or does not match its checksums is reported, deleted and
+    treated as missing, so that the features are built again instead of being reused.
+    """
+
+    def __init__(self, cache_dir=None):
+        if cache_dir is None:
+            cache_dir = os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE), "features")
+        self.cache_dir = str(cache_dir)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + ".npz")
+
+    def load(self, key):
+        """Returns the dict of arrays stored for `key`, or None if there is no valid entry."""
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                metadata = json.loads(data[_METADATA_NAME].tobytes().decode("utf-8"))
+                arrays = {name: data[name] for name in data.files if name != _METADATA_NAME}
+            if metadata["version"] != FEATURE_CACHE_VERSION or metadata["key"] != key:
+                raise ValueError("entry was written for another key or cache version")
+            if sorted(metadata["checksums"]) != sorted(arrays):
+                raise ValueError("entry does not have the expected arrays")
+            for name, array in arrays.items():
+                if _array_checksum(array) != metadata["checksums"][name]:
+                    raise ValueError("checksum mismatch for '{}'".format(name))
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile, EOFError) as e:
+            logger.warning("Discarding invalid cached features %s: %s", path, e)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+        logger.info("Loaded cached features from %s", path)
+        return arrays
+
+    def save(self, key, arrays):
+        """Stores a dict of arrays for `key`, atomically replacing any previous entry."""
+        arrays = {name: np.asarray(array) for name, array in arrays.items()}
+        if _METADATA_NAME in arrays:
+            raise ValueError("'{}' is a reserved array name".format(_METADATA_NAME))
+        metadata = {
+            "version": FEATURE_CACHE_VERSION,
+            "key": key,
+            "checksums": {name: _array_checksum(array) for name, array in arrays.items()},
+        }
+        arrays[_METADATA_NAME] = np.frombuffer(json.dumps(metadata).encode("utf-8"), dtype=np.uint8)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Readers (e.g. other distributed workers) never see a partially written file.
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as writer:
+                np.savez(writer, **arrays)
+            os.replace(temp_path, self.path(key))
+        except BaseException:
+            os.remove(temp_path)
+            raise
+        logger.info("Saved features into cached file %s", self.path(key))
+
+    def get_or_create(self, key, build_fn, save=True):
+        """Returns the arrays stored for `key`, calling `build_fn()` (and storing its result if `save`) on a miss."""
+        arrays = self.load(key)
+        if arrays is None:
+            arrays = build_fn()
+            if save:
+                self.save(key, arrays)
+        return arrays
@@ -29,6 +29,7 @@ import tempfile
 import shutil
 
 import torch
+import torch.utils.checkpoint
 from torch import nn
 from torch.nn import CrossEntropyLoss
 
@@ -47,6 +48,9 @@ PRETRAINED_MODEL_ARCHIVE_MAP = {
 }
 CONFIG_NAME = 'bert_config.json'
 WEIGHTS_NAME = 'pytorch_model.bin'
+# Options of `BertConfig` that change how a model runs but not its weights, and that can be
+# passed to `from_pretrained` to override the value in the pretrained config.
+CONFIG_OVERRIDES = ('fuse_qkv', 'attention_chunk_size', 'packed_execution', 'fused_sublayers')
 
 def gelu(x):
     """Implementation of the gelu activation function.
@@ -56,6 +60,23 @@ def gelu(x):
     return x * 0.5 * (1.0 + torch.erf(x / math.sqrt(2.0)))
 
 
+def fused_gelu_available(config):
+    """Whether the native gelu kernel can replace `gelu` for the activation of `config`."""
+    return (getattr(config, "fused_sublayers", True) and config.hidden_act == "gelu"
+            and hasattr(nn.functional, "gelu"))
+
+
+def residual_layer_norm(layer_norm, hidden_states, input_tensor, fused):
+    """Returns `layer_norm(hidden_states + input_tensor)`.
+
+    If `fused`, the residual is added in place: `hidden_states` is the fresh output of a dense
+    layer (and dropout), which autograd does not need, so this saves a [batch, seq, hidden] tensor.
+    """
+    if fused:
+        return layer_norm(hidden_states.add_(input_tensor))
+    return layer_norm(hidden_states + input_tensor)
+
+
 def swish(x):
     return x * torch.sigmoid(x)
 
@@ -77,7 +98,13 @@ class BertConfig(object):
                  attention_probs_dropout_prob=0.1,
                  max_position_embeddings=512,
                  type_vocab_size=2,
-                 initializer_range=0.02):
+                 initializer_range=0.02,
+                 fuse_qkv=False,
+                 attention_chunk_size=0,
+                 packed_execution=False,
+                 quantized=False,
+                 embedding_compression=None,
+                 fused_sublayers=True):
         """Constructs BertConfig.
 
         Args:
@@ -101,6 +128,30 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            fuse_qkv: Whether the self-attention layers compute the query, key and value
+                projections with a single [hidden_size, 3 * hidden_size] linear layer. Checkpoints
+                in either layout can be loaded into models in either layout.
+            attention_chunk_size: If > 0, the self-attention layers process the queries in blocks of
+                this many positions, so that only [batch_size, num_heads, attention_chunk_size, seq_length]
+                attention scores are held at a time instead of the full [seq_length, seq_length] matrix.
+                In training, each block is checkpointed (its scores are recomputed in the backward pass
+                instead of being kept), so that the saving holds for training as well. The results are
+                the same as with the full attention.
+            packed_execution: Whether `BertModel` removes the padding tokens (according to
+                `attention_mask`) after the embeddings and runs the encoder over the real tokens
+                only, packed in a [num_tokens, hidden_size] tensor. The encoded layers are padded
+                again at the end, with zeros at the padding positions.
+            quantized: Whether the linear layers of the encoder are dynamically quantized to int8
+                (see `PreTrainedBertModel.quantize`). Set by `quantize`, so that the config saved
+                with a quantized model's state dict marks it as a quantized checkpoint.
+            embedding_compression: How the word embedding table (and the tied decoder of the language
+                model heads) is stored: None for float32, "fp16" or "int8" (int8 rows with a float32
+                scale per row). Set by `PreTrainedBertModel.compress_embeddings`.
+            fused_sublayers: Whether the feed-forward and output sublayers of the encoder use fused
+                kernels where available: the native `gelu` kernel on the output of the intermediate
+                dense layer (whose bias is added by the matrix multiplication) instead of the
+                elementwise `gelu` formula, and the residual added in place to the output of the
+                dense layer before the layer norm. The results are the same up to rounding.
         """
         if isinstance(vocab_size_or_config_json_file, str):
             with open(vocab_size_or_config_json_file, "r", encoding='utf-8') as reader:
@@ -119,6 +170,12 @@ class BertConfig(object):
             self.max_position_embeddings = max_position_embeddings
             self.type_vocab_size = type_vocab_size
             self.initializer_range = initializer_range
+            self.fuse_qkv = fuse_qkv
+            self.attention_chunk_size = attention_chunk_size
+            self.packed_execution = packed_execution
+            self.quantized = quantized
+            self.embedding_compression = embedding_compression
+            self.fused_sublayers = fused_sublayers
         else:
             raise ValueError("First argument must be either a vocabulary size (int)"
                              "or the path to a pretrained model config file (str)")
@@ -151,53 +208,104 @@ class BertConfig(object):
         return json.dumps(self.to_dict(), indent=2, sort_keys=True) + "\n"
 
 
-try:
-    from apex.normalization.fused_layer_norm import FusedLayerNorm as BertLayerNorm
-except ImportError:
-    print("Better speed can be achieved with apex installed from https://www.github.com/nvidia/apex.")
+_apex_layer_norm = None
+_layer_norm_backend_selected = False
 
-    class BertLayerNorm(nn.Module):
-        def __init__(self, hidden_size, eps=1e-12):
-            """Construct a layernorm module in the TF style (epsilon inside the square root).
-            """
-            super(BertLayerNorm, self).__init__()
-            self.weight = nn.Parameter(torch.ones(hidden_size))  # use nn.Parameter instead of tensor, in order to w trainable
-            self.bias = nn.Parameter(torch.zeros(hidden_size))
-            self.variance_epsilon = eps
 
-        def forward(self, x):
-            """mean(-1, keepdim=True)
+def _select_layer_norm_backend():
+    """Chooses the layer norm kernel on first use: apex's fused kernel for CUDA tensors if apex is installed,
+    torch's native (fused) `layer_norm` otherwise."""
+    global _apex_layer_norm, _layer_norm_backend_selected
+    try:
+        from apex.normalization.fused_layer_norm import fused_layer_norm_affine
+        _apex_layer_norm = fused_layer_norm_affine
+        logger.info("BertLayerNorm uses apex's fused layer norm on CUDA and torch's native layer norm on CPU")
+    except ImportError:
+        logger.info("BertLayerNorm uses torch's native layer norm (apex is not installed, see "
+                    "https://www.github.com/nvidia/apex for its fused CUDA kernel)")
+    _layer_norm_backend_selected = True
 
-            equal x.mean(1, keepdim=True), i.e., row avg and the result shape=(x.shape[0], 1)
 
-            ```
-            >> a = torch.randn(4, 4)
-            >> a
-            tensor([[-1.6398, -0.9298, -0.3846, -0.9870],
-                    [ 0.6984,  0.2334,  0.1056,  0.7462],
-                    [ 0.7707,  0.8448, -0.4504, -0.5658],
-                    [-0.0849,  0.7164, -0.4773, -1.7439]])
-
-            >> a.mean(-2, keepdim=True)
-            tensor([[-0.0639,  0.2162, -0.3017, -0.6376]])
-            >> a.mean(-1, keepdim=True)
-            tensor([[-0.9853],
-                    [ 0.4459],
-                    [ 0.1498],
-                    [-0.3974]])
-            >> a.mean(0, keepdim=True)
-            tensor([[-0.0639,  0.2162, -0.3017, -0.6376]])
-            >> a.mean(1, keepdim=True)
-            tensor([[-0.9853],
-                    [ 0.4459],
-                    [ 0.1498],
-                    [-0.3974]])
-            ```
-            """
-            u = x.mean(-1, keepdim=True)
-            s = (x - u).pow(2).mean(-1, keepdim=True)
-            x = (x - u) / torch.sqrt(s + self.variance_epsilon)
-            return self.weight * x + self.bias
+class BertLayerNorm(nn.Module):
+    def __init__(self, hidden_size, eps=1e-12):
+        """Construct a layernorm module in the TF style (epsilon inside the square root).
+
+        Both backends compute (x - mean) / sqrt(variance + eps) * weight + bias in a single kernel,
+        the variance being the biased one, which is the TF formula.
+        """
+        super(BertLayerNorm, self).__init__()
+        self.weight = nn.Parameter(torch.ones(hidden_size))  # use nn.Parameter instead of tensor, in order to w trainable
+        self.bias = nn.Parameter(torch.zeros(hidden_size))
+        self.variance_epsilon = eps
+
+    def forward(self, x):
+        if not _layer_norm_backend_selected:
+            _select_layer_norm_backend()
+        if _apex_layer_norm is not None and x.is_cuda:
+            return _apex_layer_norm(x, self.weight, self.bias, self.weight.size(), self.variance_epsilon)
+        return nn.functional.layer_norm(x, self.weight.size(), self.weight, self.bias, self.variance_epsilon)
+
+
+class BertCompressedEmbedding(nn.Module):
+    """A read-only embedding table stored in float16, or in int8 with a float32 scale per row.
+
+    Lookups (`forward`) and products with the whole table (`linear`, as the tied decoder of the
+    language model heads) dequantize the rows they need and compute in float32, so that the
+    table only takes 2 (or about 1) bytes per weight in memory.
+    """
+    MODES = ("fp16", "int8")
+
+    def __init__(self, num_embeddings, embedding_dim, mode="fp16"):
+        super(BertCompressedEmbedding, self).__init__()
+        if mode not in self.MODES:
+            raise ValueError("Unknown embedding compression '{}', should be one of {}".format(mode, self.MODES))
+        self.num_embeddings = num_embeddings
+        self.embedding_dim = embedding_dim
+        self.mode = mode
+        if mode == "fp16":
+            self.register_buffer("weight", torch.zeros(num_embeddings, embedding_dim, dtype=torch.float16))
+        else:
+            self.register_buffer("weight", torch.zeros(num_embeddings, embedding_dim, dtype=torch.int8))
+            self.register_buffer("scale", torch.ones(num_embeddings))
+
+    @classmethod
+    def from_weight(cls, weight, mode="fp16"):
+        """Returns the compressed version of a float [num_embeddings, embedding_dim] weight."""
+        module = cls(weight.size(0), weight.size(1), mode=mode).to(weight.device)
+        weight = weight.detach().float()
+        if mode == "fp16":
+            module.weight.copy_(weight)
+        else:
+            scale = weight.abs().max(1)[0].clamp(min=1e-12) / 127.0
+            module.weight.copy_((weight / scale.unsqueeze(1)).round().clamp(-127, 127))
+            module.scale.copy_(scale)
+        return module
+
+    def _dequantize(self, weight, scale=None):
+        weight = weight.float()
+        return weight if scale is None else weight * scale.unsqueeze(-1)
+
+    def forward(self, input_ids):
+        return self._dequantize(self.weight[input_ids], self.scale[input_ids] if self.mode == "int8" else None)
+
+    def linear(self, hidden_states, block_size=8192):
+        """Returns `hidden_states` multiplied by the transposed table, dequantizing `block_size` rows at a time."""
+        outputs = []
+        for start in range(0, self.num_embeddings, block_size):
+            end = start + block_size
+            block = self._dequantize(self.weight[start:end], self.scale[start:end] if self.mode == "int8" else None)
+            outputs.append(nn.functional.linear(hidden_states, block.to(hidden_states.dtype)))
+        return torch.cat(outputs, dim=-1)
+
+
+class BertCompressedDecoder(nn.Module):
+    """Decoder of a language model head tied to a `BertCompressedEmbedding`."""
+    def __init__(self, embedding):
+        super(BertCompressedDecoder, self).__init__()
+        self.embedding = embedding
+
+    def forward(self, hidden_states):
+        return self.embedding.linear(hidden_states)
 
 
 class BertEmbeddings(nn.Module):
@@ -214,9 +322,12 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        """`position_ids` defaults to 0, ..., sequence_length - 1 for every sequence of the batch."""
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         """
         Example:
         
@@ -233,7 +344,6 @@ class BertEmbeddings(nn.Module):
         
         error if a.shape[-1] != 1
         """
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -260,11 +370,50 @@ class BertSelfAttention(nn.Module):
 
         """type(self.query) = <class 'torch.nn.modules.linear.Linear'>
         """
-        self.query = nn.Linear(config.hidden_size, self.all_head_size)  # (768, 768), input=(N, 768), output=(N, 768)
-        self.key = nn.Linear(config.hidden_size, self.all_head_size)  # (768, 768)
-        self.value = nn.Linear(config.hidden_size, self.all_head_size)  # (768, 768)
+        self.fuse_qkv = getattr(config, "fuse_qkv", False)
+        if self.fuse_qkv:
+            # query, key and value weights stacked in this order: (768, 3 * 768)
+            self.qkv = nn.Linear(config.hidden_size, 3 * self.all_head_size)
+        else:
+            self.query = nn.Linear(config.hidden_size, self.all_head_size)  # (768, 768), input=(N, 768), output=(N, 768)
+            self.key = nn.Linear(config.hidden_size, self.all_head_size)  # (768, 768)
+            self.value = nn.Linear(config.hidden_size, self.all_head_size)  # (768, 768)
 
         self.dropout = nn.Dropout(config.attention_probs_dropout_prob)  # attention_probs_dropout_prob=0.1
+        self.attention_chunk_size = getattr(config, "attention_chunk_size", 0)
+
+    def set_fuse_qkv(self, fuse_qkv):
+        """Switches in place between the separate query/key/value layers and the fused `qkv` layer."""
+        if fuse_qkv == self.fuse_qkv:
+            return
+        if fuse_qkv:
+            self.qkv = nn.Linear(self.query.in_features, 3 * self.all_head_size).to(self.query.weight)
+            with torch.no_grad():
+                self.qkv.weight.copy_(torch.cat([self.query.weight, self.key.weight, self.value.weight], 0))
+                self.qkv.bias.copy_(torch.cat([self.query.bias, self.key.bias, self.value.bias], 0))
+            del self.query, self.key, self.value
+        else:
+            weights = self.qkv.weight.split(self.all_head_size, 0)
+            biases = self.qkv.bias.split(self.all_head_size, 0)
+            for name, weight, bias in zip(["query", "key", "value"], weights, biases):
+                linear = nn.Linear(self.qkv.in_features, self.all_head_size).to(self.qkv.weight)
+                with torch.no_grad():
+                    linear.weight.copy_(weight)
+                    linear.bias.copy_(bias)
+                setattr(self, name, linear)
+            del self.qkv
+        self.fuse_qkv = fuse_qkv
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Converts checkpoints saved with the other query/key/value layout to the layout of this module.
+        names = [prefix + name + "." for name in ["query", "key", "value"]]
+        for param in ["weight", "bias"]:
+            if self.fuse_qkv and all(name + param in state_dict for name in names):
+                state_dict[prefix + "qkv." + param] = torch.cat([state_dict.pop(name + param) for name in names], 0)
+            elif not self.fuse_qkv and prefix + "qkv." + param in state_dict:
+                for name, tensor in zip(names, state_dict.pop(prefix + "qkv." + param).chunk(3, 0)):
+                    state_dict[name + param] = tensor
+        super(BertSelfAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def transpose_for_scores(self, x):
         """
@@ -335,9 +484,17 @@ class BertSelfAttention(nn.Module):
             input: hidden_states
             output: mixed_query_layer
         """
-        mixed_query_layer = self.query(hidden_states)  # output
-        mixed_key_layer = self.key(hidden_states)
-        mixed_value_layer = self.value(hidden_states)
+        if self.fuse_qkv:
+            # A single GEMM over hidden_states, split into three views.
+            mixed_query_layer, mixed_key_layer, mixed_value_layer = \
+                self.qkv(hidden_states).split(self.all_head_size, dim=-1)
+        else:
+            mixed_query_layer = self.query(hidden_states)  # output
+            mixed_key_layer = self.key(hidden_states)
+            mixed_value_layer = self.value(hidden_states)
+
+        if hidden_states.dim() == 2:
+            return self.packed_attention(mixed_query_layer, mixed_key_layer, mixed_value_layer, attention_mask)
 
         """query_layer
         <class 'torch.Tensor'>, torch.Size([1, 12, 11, 64])
@@ -346,6 +503,11 @@ class BertSelfAttention(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
+        if 0 < self.attention_chunk_size < query_layer.size(2):
+            context_layer = self.chunked_attention(query_layer, key_layer, value_layer, attention_mask)
+            context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
+            return context_layer.view(*(context_layer.size()[:-2] + (self.all_head_size,)))
+
         # Take the dot product between "query" and "key" to get the raw attention scores.
         """key_layer.transpose(-1, -2).size() = torch.Size([1, 12, 64, 11])
         Example:
@@ -416,7 +578,7 @@ class BertSelfAttention(nn.Module):
         attention_scores = attention_scores + attention_mask
 
         # Normalize the attention scores to probabilities.
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)  # torch.Size([1, 12, 11, 11])
+        attention_probs = nn.functional.softmax(attention_scores, dim=-1)  # torch.Size([1, 12, 11, 11])
 
         # This is actually dropping out entire tokens to attend to, which might
         # seem a bit unusual, but is taken from the original Transformer paper.
@@ -428,6 +590,65 @@ class BertSelfAttention(nn.Module):
         context_layer = context_layer.view(*new_context_layer_shape)
         return context_layer
 
+    def packed_attention(self, mixed_query_layer, mixed_key_layer, mixed_value_layer, cu_seqlens):
+        """Attention over packed sequences (see `BertConfig.packed_execution`).
+
+        The projections are [num_tokens, all_head_size] tensors holding the tokens of all the
+        sequences back to back, sequence `i` being the rows `cu_seqlens[i]:cu_seqlens[i + 1]`.
+        Each sequence only attends to itself, so no attention mask is needed.
+        """
+        def split_heads(x):
+            # [num_tokens, all_head_size] -> [num_heads, num_tokens, head_size]
+            return x.view(x.size(0), self.num_attention_heads, self.attention_head_size).transpose(0, 1)
+
+        query_layer = split_heads(mixed_query_layer)
+        key_layer = split_heads(mixed_key_layer)
+        value_layer = split_heads(mixed_value_layer)
+        context_blocks = []
+        for start, end in zip(cu_seqlens[:-1], cu_seqlens[1:]):
+            if start == end:
+                continue
+            attention_scores = torch.matmul(query_layer[:, start:end], key_layer[:, start:end].transpose(-1, -2))
+            attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+            attention_probs = self.dropout(nn.functional.softmax(attention_scores, dim=-1))
+            context_blocks.append(torch.matmul(attention_probs, value_layer[:, start:end]))
+        context_layer = torch.cat(context_blocks, dim=1) if context_blocks else value_layer
+        return context_layer.transpose(0, 1).contiguous().view(-1, self.all_head_size)
+
+    def chunked_attention(self, query_layer, key_layer, value_layer, attention_mask):
+        """Same as the attention in `forward`, one block of `attention_chunk_size` queries at a time.
+
+        Each query only attends over the keys, so the softmax of a block of query rows is exact
+        and the blocks are independent. When gradients are needed, autograd would keep the scores
+        and probabilities of every block for the backward pass, so each block is checkpointed and
+        recomputed there instead. Returns the context of shape [batch_size, num_heads, seq_length, head_size].
+        """
+        key_layer_t = key_layer.transpose(-1, -2)
+        # The mask is [batch_size, 1, 1, seq_length] from BertModel, but may also hold one row per query.
+        per_query_mask = attention_mask.dim() == 4 and attention_mask.size(2) > 1
+        checkpoint = torch.is_grad_enabled() and any(
+            tensor.requires_grad for tensor in (query_layer, key_layer, value_layer))
+        context_blocks = []
+        for start in range(0, query_layer.size(2), self.attention_chunk_size):
+            end = start + self.attention_chunk_size
+            block_mask = attention_mask[:, :, start:end] if per_query_mask else attention_mask
+            if checkpoint:
+                # The dropout mask is recomputed identically: checkpoint restores the RNG state.
+                context_blocks.append(torch.utils.checkpoint.checkpoint(
+                    self._attention_block, query_layer[:, :, start:end], key_layer_t, value_layer, block_mask,
+                    use_reentrant=False))
+            else:
+                context_blocks.append(self._attention_block(query_layer[:, :, start:end], key_layer_t, value_layer,
+                                                            block_mask))
+        return torch.cat(context_blocks, dim=2)
+
+    def _attention_block(self, query_block, key_layer_t, value_layer, attention_mask):
+        attention_scores = torch.matmul(query_block, key_layer_t)
+        attention_scores = attention_scores / math.sqrt(self.attention_head_size)
+        attention_scores = attention_scores + attention_mask
+        attention_probs = self.dropout(nn.functional.softmax(attention_scores, dim=-1))
+        return torch.matmul(attention_probs, value_layer)
+
 
 class BertSelfOutput(nn.Module):
     def __init__(self, config):
@@ -435,6 +656,7 @@ class BertSelfOutput(nn.Module):
         self.dense = nn.Linear(config.hidden_size, config.hidden_size)  # (768, 768)
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.fused = getattr(config, "fused_sublayers", True)
 
     def forward(self, hidden_states, input_tensor):
         hidden_states = self.dense(hidden_states)
@@ -442,7 +664,7 @@ class BertSelfOutput(nn.Module):
         """residual connection
         input_tensor is the raw input
         """
-        hidden_states = self.LayerNorm(hidden_states + input_tensor)
+        hidden_states = residual_layer_norm(self.LayerNorm, hidden_states, input_tensor, self.fused)
         return hidden_states
 
 
@@ -469,6 +691,9 @@ class BertIntermediate(nn.Module):
         """
         self.intermediate_act_fn = ACT2FN[config.hidden_act] \
             if isinstance(config.hidden_act, str) else config.hidden_act
+        if isinstance(config.hidden_act, str) and fused_gelu_available(config):
+            # Same erf formula as `gelu`, in one native kernel instead of four elementwise passes.
+            self.intermediate_act_fn = nn.functional.gelu
 
     def forward(self, hidden_states):
         hidden_states = self.dense(hidden_states)
@@ -482,11 +707,13 @@ class BertOutput(nn.Module):
         self.dense = nn.Linear(config.intermediate_size, config.hidden_size)  # (3072, 768), 768*4=3072
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.fused = getattr(config, "fused_sublayers", True)
 
     def forward(self, hidden_states, input_tensor):
         hidden_states = self.dense(hidden_states)
         hidden_states = self.dropout(hidden_states)
-        hidden_states = self.LayerNorm(hidden_states + input_tensor)  # residual connection
+        # residual connection
+        hidden_states = residual_layer_norm(self.LayerNorm, hidden_states, input_tensor, self.fused)
         return hidden_states
 
 
@@ -514,7 +741,28 @@ class BertEncoder(nn.Module):
         """
         self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
 
-    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
+    def resolve_layers(self, output_layers):
+        """Returns the indices of `output_layers` (which may be negative, as list indices) in [0, num_layers)."""
+        num_layers = len(self.layer)
+        indices = [int(index) for index in output_layers]
+        if not indices:
+            raise ValueError("output_layers should not be empty")
+        for index in indices:
+            if not -num_layers <= index < num_layers:
+                raise ValueError("Layer index {} out of range for a model with {} layers".format(index, num_layers))
+        return [index % num_layers for index in indices]
+
+    def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True, output_layers=None):
+        if output_layers is not None:
+            # Only run the layers up to the deepest requested one, and only keep the requested ones.
+            indices = self.resolve_layers(output_layers)
+            wanted = set(indices)
+            outputs = {}
+            for index, layer_module in enumerate(self.layer[:max(indices) + 1]):
+                hidden_states = layer_module(hidden_states, attention_mask)
+                if index in wanted:
+                    outputs[index] = hidden_states
+            return [outputs[index] for index in indices]
         all_encoder_layers = []
         for layer_module in self.layer:
             hidden_states = layer_module(hidden_states, attention_mask)
@@ -754,6 +1002,66 @@ class PreTrainedBertModel(nn.Module):
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
 
+    def set_fuse_qkv(self, fuse_qkv=True):
+        """Switches all the self-attention layers to the fused (or back to the separate) query/key/value layout.
+
+        `model.set_fuse_qkv(False)` followed by `model.state_dict()` exports a fused model in the
+        layout of the original checkpoints.
+        """
+        if getattr(self.config, "quantized", False):
+            raise ValueError("The query/key/value layout of a quantized model cannot be changed")
+        for module in self.modules():
+            if isinstance(module, BertSelfAttention):
+                module.set_fuse_qkv(fuse_qkv)
+        self.config.fuse_qkv = fuse_qkv
+        return self
+
+    def compress_embeddings(self, mode="fp16"):
+        """Replaces the word embedding table by a read-only `BertCompressedEmbedding` (for inference).
+
+        `mode` is "fp16" or "int8" (int8 rows with a float32 scale per row). The decoders of the
+        language model heads tied to the table use the compressed table as well. As with `quantize`,
+        the saved state dict and config of a compressed model make a checkpoint that
+        `from_pretrained` loads back compressed.
+        """
+        current = getattr(self.config, "embedding_compression", None)
+        if current is not None:
+            if current != mode:
+                raise ValueError("The embeddings are already compressed to {}".format(current))
+            return self
+        for embeddings in [module for module in self.modules() if isinstance(module, BertEmbeddings)]:
+            weight = embeddings.word_embeddings.weight
+            compressed = BertCompressedEmbedding.from_weight(weight, mode=mode)
+            embeddings.word_embeddings = compressed
+            for head in self.modules():
+                if isinstance(head, BertLMPredictionHead) and head.decoder.weight is weight:
+                    head.decoder = BertCompressedDecoder(compressed)
+        self.config.embedding_compression = mode
+        return self
+
+    def quantize(self, dtype=torch.qint8):
+        """Converts the linear layers of the encoder to dynamically quantized int8 layers, for CPU inference.
+
+        The query/key/value (or fused qkv) projections, the attention output and the feed-forward
+        layers of every `BertLayer` get int8 weights, and their inputs are quantized on the fly.
+        The embeddings, the layer norms, the pooler and the task heads stay in float. The model
+        must be on the CPU and is converted in place.
+
+        A quantized model is saved as usual (`torch.save(model.state_dict(), ...)` next to its
+        config, which now has `quantized: true`) and `from_pretrained` loads it back quantized.
+        """
+        if getattr(self.config, "quantized", False):
+            return self
+        names = set()
+        for name, module in self.named_modules():
+            if isinstance(module, (BertSelfAttention, BertSelfOutput, BertIntermediate, BertOutput)):
+                for child_name, child in module.named_children():
+                    if isinstance(child, nn.Linear):
+                        names.add(name + "." + child_name)
+        torch.quantization.quantize_dynamic(self, names, dtype=dtype, inplace=True)
+        self.config.quantized = True
+        return self
+
     @classmethod
     def from_pretrained(cls, pretrained_model_name, state_dict=None, cache_dir=None, *inputs, **kwargs):
         """
@@ -775,9 +1083,21 @@ class PreTrainedBertModel(nn.Module):
                     . `pytorch_model.bin` a PyTorch dump of a BertForPreTraining instance
             cache_dir: an optional path to a folder in which the pre-trained models will be cached.
             state_dict: an optional state dictionnary (collections.OrderedDict object) to use instead of Google pre-trained models
+            fuse_qkv, attention_chunk_size, packed_execution, fused_sublayers: optional overrides of the
+                execution options of the model config (see `BertConfig`). The query/key/value weights
+                of the checkpoint are converted to the layout of the model when loaded.
+            quantize: whether to quantize the model (see `quantize`) after loading the weights.
+                Quantized checkpoints (with `quantized: true` in their config) are always loaded
+                into a quantized model.
+            compress_embeddings: "fp16" or "int8" to compress the word embeddings (see
+                `compress_embeddings`) after loading the weights. As with `quantize`, compressed
+                checkpoints are always loaded into a compressed model.
             *inputs, **kwargs: additional input for the specific Bert class
                 (ex: num_labels for BertForSequenceClassification)
         """
+        config_overrides = {name: kwargs.pop(name) for name in CONFIG_OVERRIDES if name in kwargs}
+        quantize = kwargs.pop("quantize", False)
+        compress_embeddings = kwargs.pop("compress_embeddings", None)
         if pretrained_model_name in PRETRAINED_MODEL_ARCHIVE_MAP:
             archive_file = PRETRAINED_MODEL_ARCHIVE_MAP[pretrained_model_name]
         else:
@@ -813,9 +1133,18 @@ class PreTrainedBertModel(nn.Module):
         # Load config
         config_file = os.path.join(serialization_dir, CONFIG_NAME)
         config = BertConfig.from_json_file(config_file)
+        for name, value in config_overrides.items():
+            setattr(config, name, value)
         logger.info("Model config {}".format(config))
         # Instantiate model.
         model = cls(config, *inputs, **kwargs)
+        if getattr(config, "quantized", False):
+            # Quantized checkpoints hold packed int8 weights, which load into quantized layers only.
+            config.quantized = False
+            model.quantize()
+        if getattr(config, "embedding_compression", None) is not None:
+            mode, config.embedding_compression = config.embedding_compression, None
+            model.compress_embeddings(mode)
         if state_dict is None:
             weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
             state_dict = torch.load(weights_path)
@@ -860,6 +1189,10 @@ class PreTrainedBertModel(nn.Module):
         if tempdir:
             # Clean up temp dir
             shutil.rmtree(tempdir)
+        if quantize:
+            model.quantize()
+        if compress_embeddings is not None:
+            model.compress_embeddings(compress_embeddings)
         return model
 
 
@@ -881,9 +1214,16 @@ class BertModel(PreTrainedBertModel):
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `output_layers`: an optional list of layer indices (negative indices count from the last layer, as
+            `--layers -1,-2,-3,-4` in `extract_features.py`). Only the layers up to the deepest requested one
+            are run and only the requested ones are kept: under `torch.no_grad()`, each other layer output is
+            freed as soon as the next layer has consumed it, whereas the default `output_all_encoded_layers=True`
+            keeps all of them alive (see benchmarks/benchmark_inference_memory.py). Overrides
+            `output_all_encoded_layers`.
 
     Outputs: Tuple of (encoded_layers, pooled_output)
-        `encoded_layers`: controled by `output_all_encoded_layers` argument:
+        `encoded_layers`: if `output_layers` is given, the list of the requested layers, in the requested
+            order. Otherwise controled by `output_all_encoded_layers` argument:
             - `output_all_encoded_layers=True`: outputs a list of the full sequences of encoded-hidden-states at the end
                 of each attention block (i.e. 12 full sequences for BERT-base, 24 for BERT-large), each
                 encoded-hidden-state is a torch.FloatTensor of size [batch_size, sequence_length, hidden_size],
@@ -891,7 +1231,8 @@ class BertModel(PreTrainedBertModel):
                 to the last attention block of shape [batch_size, sequence_length, hidden_size],
         `pooled_output`: a torch.FloatTensor of size [batch_size, hidden_size] which is the output of a
             classifier pretrained on top of the hidden state associated to the first character of the
-            input (`CLS`) to train on the Next-Sentence task (see BERT's paper).
+            input (`CLS`) to train on the Next-Sentence task (see BERT's paper). With `output_layers`,
+            it is computed from the deepest requested layer.
 
     Example usage:
     ```python
@@ -914,7 +1255,8 @@ class BertModel(PreTrainedBertModel):
         self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True,
+                output_layers=None):
         """
         input_ids.size():
             [batch_size, sequence_length]=(1, 11)
@@ -931,6 +1273,65 @@ class BertModel(PreTrainedBertModel):
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
+        extended_attention_mask = self.extended_attention_mask(attention_mask)
+
+        embedding_output = self.embeddings(input_ids, token_type_ids)
+
+        """
+        len(encoded_layers):12
+        
+        encoded_layers[-1]:
+            tensor([[[-0.8518,  0.3912,  0.5088,  ..., -0.1979,  0.7120,  0.5696],
+                     [-0.6076,  0.3478,  0.6967,  ..., -0.1021,  0.7538,  0.2632],
+                     [-0.7219,  0.4112,  0.5620,  ...,  0.1213,  0.6766,  0.0796],
+                     ...,
+                     [-0.5522,  0.2484,  0.6567,  ..., -0.0234,  0.6370,  0.3357],
+                     [-0.5070,  0.3667,  0.5719,  ...,  0.1145,  0.7756,  0.3638],
+                     [-0.6879,  0.3948,  0.6282,  ...,  0.0524,  0.5342,  0.1659]]],
+                   grad_fn=<AddBackward0>)
+        
+        encoded_layers[-1].size():
+            torch.Size([1, 11, 768])
+        """
+        if getattr(self.config, "packed_execution", False):
+            encoded_layers = self.packed_encoder_forward(embedding_output, attention_mask,
+                                                         output_all_encoded_layers, output_layers)
+        elif output_layers is not None:
+            encoded_layers = self.encoder(embedding_output, extended_attention_mask, output_layers=output_layers)
+        else:
+            encoded_layers = self.encoder(embedding_output,
+                                          extended_attention_mask,
+                                          output_all_encoded_layers=output_all_encoded_layers)
+        if output_layers is not None:
+            # The pooled output is that of the deepest requested layer.
+            indices = self.encoder.resolve_layers(output_layers)
+            sequence_output = encoded_layers[indices.index(max(indices))]
+        else:
+            sequence_output = encoded_layers[-1]  # the final hidden layer output
+
+        """
+        len(encoded_layers):12
+        
+        encoded_layers[-1].size():
+            torch.Size([1, 11, 768])
+        
+        pooled_output:
+            torch.Size([1, 768])
+        """
+        pooled_output = self.pooler(sequence_output)
+        """
+        When pre-training, the `output_all_encoded_layers=False`
+        When `BertModel`, the `output_all_encoded_layers=True`
+        ...
+        
+        """
+        if output_layers is None and not output_all_encoded_layers:
+            encoded_layers = encoded_layers[-1]
+        return encoded_layers, pooled_output
+
+    def extended_attention_mask(self, attention_mask):
+        """Returns the additive [batch_size, 1, 1, sequence_length] attention mask of the encoder
+        for a [batch_size, sequence_length] `attention_mask` of 1s and 0s."""
         # We create a 3D attention mask from a 2D tensor mask.
         # Sizes are [batch_size, 1, 1, to_seq_length]
         # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
@@ -1002,50 +1403,27 @@ class BertModel(PreTrainedBertModel):
         extended_attention_mask:
             tensor([[[[-0., -0., -0., -0., -0., -0., -0., -0., -0., -0., -0.]]]])
         """
-        extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
-
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        return (1.0 - extended_attention_mask) * -10000.0
 
-        """
-        len(encoded_layers):12
-        
-        encoded_layers[-1]:
-            tensor([[[-0.8518,  0.3912,  0.5088,  ..., -0.1979,  0.7120,  0.5696],
-                     [-0.6076,  0.3478,  0.6967,  ..., -0.1021,  0.7538,  0.2632],
-                     [-0.7219,  0.4112,  0.5620,  ...,  0.1213,  0.6766,  0.0796],
-                     ...,
-                     [-0.5522,  0.2484,  0.6567,  ..., -0.0234,  0.6370,  0.3357],
-                     [-0.5070,  0.3667,  0.5719,  ...,  0.1145,  0.7756,  0.3638],
-                     [-0.6879,  0.3948,  0.6282,  ...,  0.0524,  0.5342,  0.1659]]],
-                   grad_fn=<AddBackward0>)
-        
-        encoded_layers[-1].size():
-            torch.Size([1, 11, 768])
-        """
-        encoded_layers = self.encoder(embedding_output,
-                                      extended_attention_mask,
-                                      output_all_encoded_layers=output_all_encoded_layers)
-        sequence_output = encoded_layers[-1]  # the final hidden layer output
+    def packed_encoder_forward(self, embedding_output, attention_mask, output_all_encoded_layers=True,
+                               output_layers=None):
+        """Runs the encoder over the non-padding tokens only (see `BertConfig.packed_execution`).
 
+        Returns the encoded layers padded back to [batch_size, sequence_length, hidden_size], with
+        zeros at the padding positions.
         """
-        len(encoded_layers):12
-        
-        encoded_layers[-1].size():
-            torch.Size([1, 11, 768])
-        
-        pooled_output:
-            torch.Size([1, 768])
-        """
-        pooled_output = self.pooler(sequence_output)
-        """
-        When pre-training, the `output_all_encoded_layers=False`
-        When `BertModel`, the `output_all_encoded_layers=True`
-        ...
-        
-        """
-        if not output_all_encoded_layers:
-            encoded_layers = encoded_layers[-1]
-        return encoded_layers, pooled_output
+        batch_size, seq_length, hidden_size = embedding_output.size()
+        token_indices = attention_mask.reshape(-1).nonzero().squeeze(1)
+        cu_seqlens = [0] + torch.cumsum(attention_mask.ne(0).sum(1), 0).tolist()
+        packed_output = embedding_output.view(-1, hidden_size).index_select(0, token_indices)
+        packed_layers = self.encoder(packed_output, cu_seqlens, output_all_encoded_layers=output_all_encoded_layers,
+                                     output_layers=output_layers)
+        encoded_layers = []
+        for packed_layer in packed_layers:
+            layer = packed_layer.new_zeros(batch_size * seq_length, hidden_size)
+            encoded_layers.append(layer.index_copy(0, token_indices, packed_layer).view(
+                batch_size, seq_length, hidden_size))
+        return encoded_layers
 
 
 class BertForPreTraining(PreTrainedBertModel):
@@ -1321,6 +1699,13 @@ class BertForSequenceClassification(PreTrainedBertModel):
         if `labels` is `None`:
             Outputs the classification logits of shape [batch_size, num_labels].
 
+    Early exit:
+        With `early_exit=True`, a classifier head is added after each encoder layer but the last one
+        and trained together with the final classifier (the loss is the mean of the losses of all the
+        heads). At inference, once `early_exit_threshold` is set, each example stops at the first layer
+        whose head predicts a class with a probability of at least `early_exit_threshold`, so that easy
+        examples skip the top layers. `early_exit_forward` also returns the layer each example exited at.
+
     Example usage:
     ```python
     # Already been converted into WordPiece token ids
@@ -1337,15 +1722,31 @@ class BertForSequenceClassification(PreTrainedBertModel):
     logits = model(input_ids, token_type_ids, input_mask)
     ```
     """
-    def __init__(self, config, num_labels=2):
+    def __init__(self, config, num_labels=2, early_exit=False):
         super(BertForSequenceClassification, self).__init__(config)
         self.num_labels = num_labels
         self.bert = BertModel(config)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
         self.classifier = nn.Linear(config.hidden_size, num_labels)
+        self.early_exit = early_exit
+        self.early_exit_threshold = None
+        if early_exit:
+            self.exit_heads = nn.ModuleList([BertEarlyExitHead(config, num_labels)
+                                             for _ in range(config.num_hidden_layers - 1)])
         self.apply(self.init_bert_weights)
 
     def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None):
+        if self.early_exit and labels is not None:
+            encoded_layers, pooled_output = self.bert(input_ids, token_type_ids, attention_mask)
+            all_logits = [head(layer) for head, layer in zip(self.exit_heads, encoded_layers)]
+            all_logits.append(self.classifier(self.dropout(pooled_output)))
+            loss_fct = CrossEntropyLoss()
+            losses = [loss_fct(logits.view(-1, self.num_labels), labels.view(-1)) for logits in all_logits]
+            return sum(losses) / len(losses)
+        if self.early_exit and self.early_exit_threshold is not None and labels is None:
+            logits, _ = self.early_exit_forward(input_ids, token_type_ids, attention_mask)
+            return logits
+
         _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
         pooled_output = self.dropout(pooled_output)
         logits = self.classifier(pooled_output)
@@ -1357,6 +1758,59 @@ class BertForSequenceClassification(PreTrainedBertModel):
         else:
             return logits
 
+    def early_exit_forward(self, input_ids, token_type_ids=None, attention_mask=None, threshold=None):
+        """Classifies each example at the first layer confident enough, only running the layers it needs.
+
+        Returns a tuple (logits, exit_layers): the logits of shape [batch_size, num_labels] and a
+        torch.LongTensor of shape [batch_size] holding the index of the layer each example exited at.
+        `threshold` defaults to `early_exit_threshold`.
+        """
+        if not self.early_exit:
+            raise ValueError("The model was built without early exit heads (early_exit=False)")
+        threshold = self.early_exit_threshold if threshold is None else threshold
+        if threshold is None:
+            raise ValueError("No early exit threshold given")
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        if token_type_ids is None:
+            token_type_ids = torch.zeros_like(input_ids)
+        num_layers = len(self.bert.encoder.layer)
+        hidden_states = self.bert.embeddings(input_ids, token_type_ids)
+        extended_attention_mask = self.bert.extended_attention_mask(attention_mask)
+        logits = hidden_states.new_zeros(input_ids.size(0), self.num_labels)
+        exit_layers = input_ids.new_full((input_ids.size(0),), num_layers - 1)
+        # Indices in the batch of the examples still running; finished ones are dropped from the batch.
+        remaining = torch.arange(input_ids.size(0), device=input_ids.device)
+        for index, layer_module in enumerate(self.bert.encoder.layer):
+            hidden_states = layer_module(hidden_states, extended_attention_mask)
+            if index == num_layers - 1:
+                logits[remaining] = self.classifier(self.dropout(self.bert.pooler(hidden_states)))
+                break
+            layer_logits = self.exit_heads[index](hidden_states)
+            done = nn.functional.softmax(layer_logits, dim=-1).max(-1)[0] >= threshold
+            if done.any():
+                logits[remaining[done]] = layer_logits[done]
+                exit_layers[remaining[done]] = index
+                keep = (~done).nonzero().squeeze(1)
+                remaining = remaining[keep]
+                if remaining.numel() == 0:
+                    break
+                hidden_states = hidden_states[keep]
+                extended_attention_mask = extended_attention_mask[keep]
+        return logits, exit_layers
+
+
+class BertEarlyExitHead(nn.Module):
+    """Classifier on the [CLS] token of an intermediate layer, as the pooler and classifier on top of BertModel."""
+    def __init__(self, config, num_labels):
+        super(BertEarlyExitHead, self).__init__()
+        self.pooler = BertPooler(config)
+        self.dropout = nn.Dropout(config.hidden_dropout_prob)
+        self.classifier = nn.Linear(config.hidden_size, num_labels)
+
+    def forward(self, hidden_states):
+        return self.classifier(self.dropout(self.pooler(hidden_states)))
+
 
 class BertForMultipleChoice(PreTrainedBertModel):
     """BERT model for multiple choice tasks.
@@ -1554,10 +2008,7 @@ class BertForQuestionAnswering(PreTrainedBertModel):
             torch.Size([1, 11, 768])
         """
         sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
-        logits = self.qa_outputs(sequence_output)  # torch.Size([1, 11, 2])
-        start_logits, end_logits = logits.split(1, dim=-1)  # torch.Size([1, 11, 1])
-        start_logits = start_logits.squeeze(-1)
-        end_logits = end_logits.squeeze(-1)
+        start_logits, end_logits = self.qa_logits(sequence_output)
 
         if start_positions is not None and end_positions is not None:
             # If we are on multi-GPU, split add a dimension
@@ -1598,6 +2049,12 @@ class BertForQuestionAnswering(PreTrainedBertModel):
         else:
             return start_logits, end_logits
 
+    def qa_logits(self, sequence_output):
+        """Returns the start and end logits of shape [batch_size, sequence_length] from the encoder output."""
+        logits = self.qa_outputs(sequence_output)  # torch.Size([1, 11, 2])
+        start_logits, end_logits = logits.split(1, dim=-1)  # torch.Size([1, 11, 1])
+        return start_logits.squeeze(-1), end_logits.squeeze(-1)
+
 
 # =============================================================================
 
@@ -1618,6 +2075,9 @@ class BertForQuestionAnswerLSTM(BertForQuestionAnswering):
         sequence_output, _ = self.mix(sequence_output)
         return sequence_output
 
+    def qa_logits(self, sequence_output):
+        return super(BertForQuestionAnswerLSTM, self).qa_logits(self.mix_operate(sequence_output))
+
     def forward(self, input_ids, token_type_ids=None,
                 attention_mask=None, start_positions=None, end_positions=None):
         sequence_output, _ = self.bert(input_ids, token_type_ids,
@@ -0,0 +1,168 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Inference of `BertForQuestionAnswering` over the sliding-window doc spans of SQuAD-style features.
+
+BERT attends in both directions, so the hidden states of the tokens shared by two overlapping
+windows (or of a question shared by all the windows of an example) differ from one window to the
+other and cannot be reused. What can be reused exactly is:
+    - whole windows: identical windows (e.g. the same question asked twice about the same
+      context) are encoded once;
+    - the embeddings of the question prefix `[CLS] question [SEP]`, which are the same for every
+      window of an example since they only depend on the tokens, positions and segments.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import logging
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+SpanLogits = collections.namedtuple("SpanLogits", ["unique_id", "start_logits", "end_logits"])
+
+
+class QuestionAnsweringEngine(object):
+    """Computes the start/end logits of doc span features, skipping redundant work.
+
+    Params:
+        model: a `BertForQuestionAnswering` (or subclass), in eval mode.
+        batch_size: number of windows encoded at once.
+        deduplicate: encode identical windows (same tokens and segments) once.
+        reuse_question_prefix: embed the `[CLS] question [SEP]` prefix once per example and only
+            embed the rest of each window. Needs `trim_padding`.
+        trim_padding: pad each batch only to its longest window instead of the full sequence length.
+            This needs a head which looks at each position on its own, as `BertForQuestionAnswering`
+            (not e.g. `BertForQuestionAnswerLSTM`, whose LSTM also reads the padding).
+
+    `predict` returns one `SpanLogits` per feature, in order, whose logits only cover the real
+    (non-padding) tokens of the feature, and records what was saved in `stats`.
+    """
+
+    def __init__(self, model, batch_size=32, deduplicate=True, reuse_question_prefix=False, trim_padding=True):
+        if reuse_question_prefix and not trim_padding:
+            raise ValueError("reuse_question_prefix needs trim_padding")
+        self.model = model
+        self.batch_size = batch_size
+        self.deduplicate = deduplicate
+        self.reuse_question_prefix = reuse_question_prefix
+        self.trim_padding = trim_padding
+        self.stats = {}
+        self._prefix_cache_example_index = None
+
+    @staticmethod
+    def _window(feature):
+        """Returns the input ids and segment ids of the real tokens of a feature, and its question prefix length."""
+        length = sum(1 for m in feature.input_mask if m)
+        input_ids = tuple(feature.input_ids[:length])
+        segment_ids = tuple(feature.segment_ids[:length])
+        prefix_length = segment_ids.index(1) if 1 in segment_ids else length
+        return input_ids, segment_ids, prefix_length
+
+    def predict(self, features):
+        """Returns the `SpanLogits` of each of `features` (objects with `unique_id`, `example_index`,
+        `input_ids`, `input_mask` and `segment_ids`, as the `InputFeatures` of run_squad.py)."""
+        windows = []
+        window_index = {}
+        feature_windows = []
+        for feature in features:
+            input_ids, segment_ids, prefix_length = self._window(feature)
+            key = (input_ids, segment_ids)
+            if not self.deduplicate or key not in window_index:
+                window_index[key] = len(windows)
+                windows.append((feature.example_index, input_ids, segment_ids, prefix_length))
+            feature_windows.append(window_index[key] if self.deduplicate else len(windows) - 1)
+
+        max_seq_length = max(len(feature.input_ids) for feature in features) if features else 0
+        self.stats = {
+            "features": len(features),
+            "windows": len(windows),
+            "padded_tokens": sum(len(feature.input_ids) for feature in features),
+            "real_tokens": sum(len(windows[index][1]) for index in feature_windows),
+            "encoded_tokens": 0,
+            "embedded_tokens": 0,
+        }
+
+        device = next(self.model.parameters()).device
+        window_logits = [None] * len(windows)
+        # Embeddings of the question prefixes of the current example.
+        prefix_cache = {}
+        self._prefix_cache_example_index = None
+        # Windows are taken in feature order, so that the windows of an example are batched together.
+        for start in range(0, len(windows), self.batch_size):
+            batch = windows[start:start + self.batch_size]
+            seq_length = max(len(window[1]) for window in batch) if self.trim_padding else max_seq_length
+            input_ids = torch.zeros(len(batch), seq_length, dtype=torch.long)
+            segment_ids = torch.zeros(len(batch), seq_length, dtype=torch.long)
+            input_mask = torch.zeros(len(batch), seq_length, dtype=torch.long)
+            for i, (_, ids, segments, _) in enumerate(batch):
+                input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+                segment_ids[i, :len(ids)] = torch.tensor(segments, dtype=torch.long)
+                input_mask[i, :len(ids)] = 1
+            input_ids, segment_ids, input_mask = input_ids.to(device), segment_ids.to(device), input_mask.to(device)
+            self.stats["encoded_tokens"] += len(batch) * seq_length
+
+            with torch.no_grad():
+                if self.reuse_question_prefix:
+                    embedding_output = self._embed_with_prefix_cache(batch, input_ids, segment_ids, prefix_cache)
+                    sequence_output = self.model.bert.encoder(
+                        embedding_output, self.model.bert.extended_attention_mask(input_mask),
+                        output_all_encoded_layers=False)[-1]
+                    start_logits, end_logits = self.model.qa_logits(sequence_output)
+                else:
+                    self.stats["embedded_tokens"] += len(batch) * seq_length
+                    start_logits, end_logits = self.model(input_ids, segment_ids, input_mask)
+            start_logits, end_logits = start_logits.cpu(), end_logits.cpu()
+            for i, window in enumerate(batch):
+                length = len(window[1])
+                window_logits[start + i] = (start_logits[i, :length].tolist(), end_logits[i, :length].tolist())
+
+        logger.info("Encoded %d windows for %d features: %d tokens encoded and %d embedded, instead of %d",
+                    self.stats["windows"], self.stats["features"], self.stats["encoded_tokens"],
+                    self.stats["embedded_tokens"], self.stats["padded_tokens"])
+        return [SpanLogits(unique_id=feature.unique_id, start_logits=window_logits[index][0],
+                           end_logits=window_logits[index][1])
+                for feature, index in zip(features, feature_windows)]
+
+    def _embed_with_prefix_cache(self, batch, input_ids, segment_ids, prefix_cache):
+        """Returns the embeddings of a batch, embedding each question prefix once per example."""
+        embeddings = self.model.bert.embeddings
+        batch_size, seq_length = input_ids.size()
+        max_position = embeddings.position_embeddings.num_embeddings - 1
+        # The part of each window after its prefix, shifted to the start of the row.
+        prefix_lengths = torch.tensor([window[3] for window in batch], device=input_ids.device)
+        suffix_length = max(len(window[1]) - window[3] for window in batch)
+        positions = prefix_lengths.unsqueeze(1) + torch.arange(suffix_length, device=input_ids.device).unsqueeze(0)
+        gather_positions = positions.clamp(max=seq_length - 1)
+        suffix_output = embeddings(input_ids.gather(1, gather_positions), segment_ids.gather(1, gather_positions),
+                                   position_ids=positions.clamp(max=max_position))
+        self.stats["embedded_tokens"] += batch_size * suffix_length
+
+        embedding_output = suffix_output.new_zeros(batch_size, seq_length, suffix_output.size(-1))
+        for i, (example_index, ids, segments, prefix_length) in enumerate(batch):
+            if example_index != self._prefix_cache_example_index:
+                prefix_cache.clear()
+                self._prefix_cache_example_index = example_index
+            key = ids[:prefix_length]
+            if key not in prefix_cache:
+                prefix_cache[key] = embeddings(input_ids[i:i + 1, :prefix_length],
+                                               segment_ids[i:i + 1, :prefix_length])[0]
+                self.stats["embedded_tokens"] += prefix_length
+            embedding_output[i, :prefix_length] = prefix_cache[key]
+            embedding_output[i, prefix_length:len(ids)] = suffix_output[i, :len(ids) - prefix_length]
+        return embedding_output
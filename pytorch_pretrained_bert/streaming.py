@@ -0,0 +1,175 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Streaming featurization: encode corpora that do not fit in memory."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import logging
+import multiprocessing
+import queue
+import threading
+
+from .tokenization import _batch_encode_chunk, _encode_chunk, _init_batch_encode_worker
+
+logger = logging.getLogger(__name__)
+
+
+def read_lines(input_file, skip_empty=True):
+    """Yields the lines of a text file one at a time, without the trailing newline."""
+    with open(input_file, "r", encoding="utf-8") as reader:
+        for line in reader:
+            line = line.rstrip("\r\n")
+            if skip_empty and not line.strip():
+                continue
+            yield line
+
+
+def read_json_records(input_file):
+    """Yields the records of a JSON lines file (one JSON object per line) one at a time."""
+    with open(input_file, "r", encoding="utf-8") as reader:
+        for line_number, line in enumerate(reader, 1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError as e:
+                raise ValueError("Invalid JSON record at {}:{}: {}".format(input_file, line_number, e))
+
+
+class _EndOfStream(object):
+    """Queue item telling the consumer that the producer is done, with the error that stopped it if any."""
+
+    def __init__(self, error=None):
+        self.error = error
+
+
+def stream_encode(tokenizer, records, max_len=128, text_key="text", text_pair_key=None, keep_keys=(),
+                  chunk_size=256, num_workers=1, prefetch=4):
+    """Tokenizes and encodes a stream of records with bounded memory.
+
+    Records are read, grouped in chunks of `chunk_size` and encoded by a background thread
+    (and `num_workers` processes if > 1) while the caller consumes the results. At most
+    `prefetch` encoded chunks are queued ahead of the consumer, and as many more are in
+    flight in the worker processes, so a slow consumer stops the reading of `records`
+    instead of letting features pile up in memory.
+
+    Params:
+        tokenizer: a `BertTokenizer`.
+        records: an iterable of strings, of `(text, text_pair)` tuples or of dicts, e.g.
+            `read_lines(path)` or `read_json_records(path)`.
+        max_len: the padded sequence length.
+        text_key: the key of the text in dict records.
+        text_pair_key: the key of the optional second segment in dict records.
+        keep_keys: keys of dict records copied as they are into the features (e.g. labels).
+        chunk_size: number of records encoded at a time.
+        num_workers: number of processes used to tokenize.
+        prefetch: maximum number of encoded chunks waiting to be consumed.
+
+    Yields:
+        One dict per record with np.int64 arrays of shape [max_len] under `input_ids`,
+        `input_mask` and `segment_ids`, and the `keep_keys` of the record.
+    """
+    if prefetch < 1:
+        raise ValueError("prefetch should be >= 1, got {}".format(prefetch))
+    if chunk_size < 1:
+        raise ValueError("chunk_size should be >= 1, got {}".format(chunk_size))
+    output_queue = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+
+    def put(item):
+        # Gives up if the consumer went away, so that the thread never blocks forever.
+        while not stop.is_set():
+            try:
+                output_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def chunks():
+        texts, text_pairs, extras = [], [], []
+        for record in records:
+            if stop.is_set():
+                return
+            if isinstance(record, str):
+                text, text_pair, extra = record, None, {}
+            elif isinstance(record, dict):
+                text = record[text_key]
+                text_pair = record[text_pair_key] if text_pair_key is not None else None
+                extra = {key: record[key] for key in keep_keys}
+            else:
+                (text, text_pair), extra = record, {}
+            texts.append(text)
+            text_pairs.append(text_pair)
+            extras.append(extra)
+            if len(texts) == chunk_size:
+                yield texts, text_pairs, extras
+                texts, text_pairs, extras = [], [], []
+        if texts:
+            yield texts, text_pairs, extras
+
+    def pair_argument(text_pairs):
+        return None if all(text_pair is None for text_pair in text_pairs) else text_pairs
+
+    def produce():
+        pool = None
+        try:
+            if num_workers > 1:
+                pool = multiprocessing.Pool(num_workers, initializer=_init_batch_encode_worker,
+                                            initargs=(tokenizer,))
+                pending = collections.deque()
+                for texts, text_pairs, extras in chunks():
+                    pending.append((pool.apply_async(_batch_encode_chunk,
+                                                     ((texts, pair_argument(text_pairs), max_len),)), extras))
+                    if len(pending) >= prefetch:
+                        result, extras = pending.popleft()
+                        if not put((result.get(), extras)):
+                            return
+                while pending:
+                    result, extras = pending.popleft()
+                    if not put((result.get(), extras)):
+                        return
+            else:
+                for texts, text_pairs, extras in chunks():
+                    if not put((_encode_chunk(tokenizer, texts, pair_argument(text_pairs), max_len), extras)):
+                        return
+            put(_EndOfStream())
+        except Exception as e:
+            put(_EndOfStream(e))
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    producer = threading.Thread(target=produce, name="stream_encode", daemon=True)
+    producer.start()
+    try:
+        while True:
+            item = output_queue.get()
+            if isinstance(item, _EndOfStream):
+                if item.error is not None:
+                    raise item.error
+                return
+            (input_ids, input_mask, segment_ids), extras = item
+            for i, extra in enumerate(extras):
+                feature = {"input_ids": input_ids[i], "input_mask": input_mask[i], "segment_ids": segment_ids[i]}
+                feature.update(extra)
+                yield feature
+    finally:
+        stop.set()
+        producer.join()
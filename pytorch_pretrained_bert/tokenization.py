@@ -19,9 +19,17 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import collections.abc
 import unicodedata
 import os
+import re
 import logging
+import mmap
+import multiprocessing
+import struct
+import zlib
+
+import numpy as np
 
 from .file_utils import cached_path
 
@@ -48,6 +56,7 @@ PRETRAINED_VOCAB_POSITIONAL_EMBEDDINGS_SIZE_MAP = {
     'bert-base-chinese': 512,
 }
 VOCAB_NAME = 'vocab.txt'
+COMPILED_VOCAB_NAME = 'vocab.bin'
 
 
 def load_vocab(vocab_file):
@@ -76,28 +85,180 @@ def whitespace_tokenize(text):
     return tokens
 
 
+# Layout of a compiled vocabulary file (all little-endian):
+#   header:  magic, number of tokens, hash table size, blob size, flags
+#   offsets: int64[num_tokens + 1], token `i` is blob[offsets[i]:offsets[i + 1]]
+#   table:   int32[table_size], open-addressing hash index (crc32, linear probing), -1 if empty
+#   blob:    the utf-8 encoded tokens, in id order
+_COMPILED_VOCAB_MAGIC = b"BERTVOC1"
+_COMPILED_VOCAB_HEADER = struct.Struct("<8sQQQQ")
+_COMPILED_VOCAB_HAS_DUPLICATES = 1
+
+
+def is_compiled_vocab(vocab_file):
+    """Checks whether `vocab_file` is a vocabulary written by `compile_vocab`."""
+    with open(vocab_file, "rb") as reader:
+        return reader.read(len(_COMPILED_VOCAB_MAGIC)) == _COMPILED_VOCAB_MAGIC
+
+
+def compile_vocab(vocab_file, compiled_vocab_file):
+    """Compiles a `vocab.txt` file into the binary format read by `CompiledVocab`.
+
+    Token ids are the same as the ones given by `load_vocab`: the line number, the last
+    line winning for a token that appears several times.
+    """
+    with open(vocab_file, "r", encoding="utf-8") as reader:
+        tokens = [line.strip().encode("utf-8") for line in reader]
+    offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(token) for token in tokens])
+    table_size = 1
+    while table_size < 2 * len(tokens):
+        table_size *= 2
+    table = np.full(table_size, -1, dtype=np.int32)
+    mask = table_size - 1
+    flags = 0
+    for index, token in enumerate(tokens):
+        slot = zlib.crc32(token) & mask
+        while table[slot] >= 0 and tokens[table[slot]] != token:
+            slot = (slot + 1) & mask
+        if table[slot] >= 0:
+            flags |= _COMPILED_VOCAB_HAS_DUPLICATES
+        table[slot] = index
+    blob = b"".join(tokens)
+    with open(compiled_vocab_file, "wb") as writer:
+        writer.write(_COMPILED_VOCAB_HEADER.pack(
+            _COMPILED_VOCAB_MAGIC, len(tokens), table_size, len(blob), flags))
+        writer.write(offsets.tobytes())
+        writer.write(table.tobytes())
+        writer.write(blob)
+
+
+class CompiledVocab(collections.abc.Mapping):
+    """A read-only token -> id mapping memory-mapped from a file written by `compile_vocab`.
+
+    Opening it costs nothing beyond the mmap call, and all the processes reading the same
+    file (e.g. DataLoader workers) share its pages. `ids_to_tokens` gives the reverse
+    id -> token lookup by array indexing.
+    """
+
+    def __init__(self, compiled_vocab_file):
+        self.compiled_vocab_file = compiled_vocab_file
+        with open(compiled_vocab_file, "rb") as reader:
+            self._mmap = mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, num_tokens, table_size, blob_size, flags = _COMPILED_VOCAB_HEADER.unpack_from(self._mmap, 0)
+        if magic != _COMPILED_VOCAB_MAGIC:
+            raise ValueError("'{}' is not a compiled vocabulary file".format(compiled_vocab_file))
+        offsets_start = _COMPILED_VOCAB_HEADER.size
+        table_start = offsets_start + 8 * (num_tokens + 1)
+        self._blob_start = table_start + 4 * table_size
+        view = memoryview(self._mmap)
+        self._offsets = view[offsets_start:table_start].cast("q")
+        self._table = view[table_start:self._blob_start].cast("i")
+        self._mask = table_size - 1
+        self._num_tokens = num_tokens
+        self._has_duplicates = bool(flags & _COMPILED_VOCAB_HAS_DUPLICATES)
+        self.ids_to_tokens = _CompiledIdsToTokens(self)
+
+    def __reduce__(self):
+        # Worker processes map the file again instead of receiving a copy of it.
+        return self.__class__, (self.compiled_vocab_file,)
+
+    def token_bytes(self, index):
+        start = self._blob_start + self._offsets[index]
+        end = self._blob_start + self._offsets[index + 1]
+        return self._mmap[start:end]
+
+    def __getitem__(self, token):
+        key = token.encode("utf-8") if isinstance(token, str) else None
+        if key is None:
+            raise KeyError(token)
+        table = self._table
+        slot = zlib.crc32(key) & self._mask
+        while True:
+            index = table[slot]
+            if index < 0:
+                raise KeyError(token)
+            if self.token_bytes(index) == key:
+                return index
+            slot = (slot + 1) & self._mask
+
+    def __len__(self):
+        if self._has_duplicates:
+            return sum(1 for _ in self)
+        return self._num_tokens
+
+    def __iter__(self):
+        if not self._has_duplicates:
+            for index in range(self._num_tokens):
+                yield self.ids_to_tokens[index]
+            return
+        # Same order as `load_vocab`: a repeated token comes where it first appears.
+        seen = set()
+        for index in range(self._num_tokens):
+            token = self.ids_to_tokens[index]
+            if token not in seen:
+                seen.add(token)
+                yield token
+
+
+class _CompiledIdsToTokens(collections.abc.Sequence):
+    """The id -> token view of a `CompiledVocab`."""
+
+    def __init__(self, vocab):
+        self._vocab = vocab
+
+    def __len__(self):
+        return self._vocab._num_tokens
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        # Ids are keys, as in the `ids_to_tokens` dict of a text vocab: negative ids are not valid.
+        if not 0 <= index < len(self):
+            raise KeyError(index)
+        return self._vocab.token_bytes(index).decode("utf-8")
+
+
 class BertTokenizer(object):
     """Runs end-to-end tokenization: punctuation splitting + wordpiece"""
 
     def __init__(self, vocab_file, do_lower_case=True, max_len=None,
-                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]", "[unused1]")):
+                 never_split=("[UNK]", "[SEP]", "[PAD]", "[CLS]", "[MASK]", "[unused1]"),
+                 word_cache_size=100000):
+        """Constructs a BertTokenizer.
+
+        Args:
+          vocab_file: Path to a one-wordpiece-per-line vocabulary file, or to its compiled
+            form written by `compile_vocab`, which is memory-mapped instead of loaded.
+          do_lower_case: Whether to lower case the input.
+          max_len: Maximum number of token ids accepted by `convert_tokens_to_ids`.
+          never_split: Tokens which are never lower cased or split on punctuation.
+          word_cache_size: Maximum number of words whose wordpieces are kept in the
+            least-recently-used cache of `tokenize`. 0 disables the cache.
+        """
         if not os.path.isfile(vocab_file):
             raise ValueError(
                 "Can't find a vocabulary file at path '{}'. To load the vocabulary from a Google pretrained "
                 "model use `tokenizer = BertTokenizer.from_pretrained(PRETRAINED_MODEL_NAME)`".format(vocab_file))
-        self.vocab = load_vocab(vocab_file)
-        self.ids_to_tokens = collections.OrderedDict(
-            [(ids, tok) for tok, ids in self.vocab.items()])
+        if is_compiled_vocab(vocab_file):
+            self.vocab = CompiledVocab(vocab_file)
+            self.ids_to_tokens = self.vocab.ids_to_tokens
+        else:
+            self.vocab = load_vocab(vocab_file)
+            self.ids_to_tokens = collections.OrderedDict(
+                [(ids, tok) for tok, ids in self.vocab.items()])
+        self._id_to_token_table = None
         self.basic_tokenizer = BasicTokenizer(do_lower_case=do_lower_case,
                                               never_split=never_split)
         self.wordpiece_tokenizer = WordpieceTokenizer(vocab=self.vocab)
         self.max_len = max_len if max_len is not None else int(1e12)  # max_len=512
+        self.word_cache_size = word_cache_size
+        self.clear_cache()
 
     def tokenize(self, text):
         split_tokens = []
-        for token in self.basic_tokenizer.tokenize(text):
-            for sub_token in self.wordpiece_tokenizer.tokenize(token):
-                split_tokens.append(sub_token)
+        for word in self.basic_tokenizer.split_words(text):
+            split_tokens.extend(self._tokenize_word(word))
         """
         split_tokens:
             ['[CLS]', 'who', '[UNK]', '[UNK]', '一', '[UNK]', '[UNK]', '[UNK]', 'was', 'jim', 'henson', '?', '[SEP]', 
@@ -105,6 +266,74 @@ class BertTokenizer(object):
         """
         return split_tokens
 
+    def tokenize_with_offsets(self, text):
+        """Tokenizes a piece of text and keeps track of where each wordpiece comes from.
+
+        Returns:
+            A tuple `(tokens, offsets)`. `tokens` is the same as `tokenize(text)` and `offsets[i]`
+            is the `(start, end)` character span of `tokens[i]` in `text`. A `##` piece maps to the
+            characters it covers without the prefix, an `[UNK]` to its whole basic token.
+        """
+        unk_token = self.wordpiece_tokenizer.unk_token
+        split_tokens = []
+        split_offsets = []
+        for token, char_spans in zip(*self.basic_tokenizer.tokenize_with_char_spans(text)):
+            sub_tokens = self.wordpiece_tokenizer.tokenize(token)
+            if sub_tokens == [unk_token]:
+                split_tokens.append(unk_token)
+                split_offsets.append((char_spans[0][0], char_spans[-1][1]))
+                continue
+            start = 0
+            for sub_token in sub_tokens:
+                length = len(sub_token) - 2 if start > 0 else len(sub_token)
+                split_tokens.append(sub_token)
+                split_offsets.append((char_spans[start][0], char_spans[start + length - 1][1]))
+                start += length
+        return split_tokens, split_offsets
+
+    def _tokenize_word(self, word):
+        """Returns the wordpieces of a whitespace-delimited word, going through the LRU word cache."""
+        cache = self.word_cache
+        sub_tokens = cache.get(word)
+        if sub_tokens is not None:
+            self.cache_hits += 1
+            cache.move_to_end(word)
+            return sub_tokens
+        self.cache_misses += 1
+        sub_tokens = []
+        for token in self.basic_tokenizer.tokenize_word(word):
+            sub_tokens.extend(self.wordpiece_tokenizer.tokenize(token))
+        if self.word_cache_size > 0:
+            cache[word] = sub_tokens
+            if len(cache) > self.word_cache_size:
+                cache.popitem(last=False)
+        return sub_tokens
+
+    def __getstate__(self):
+        # Pickled copies (e.g. for the workers of `batch_encode`) only carry the vocab and the
+        # settings: the word cache and the id -> token table are rebuilt on use.
+        state = self.__dict__.copy()
+        state["word_cache"] = collections.OrderedDict()
+        state["cache_hits"] = 0
+        state["cache_misses"] = 0
+        state["_id_to_token_table"] = None
+        return state
+
+    def cache_info(self):
+        """Returns the hits, misses, current size and maximum size of the word cache."""
+        return {"hits": self.cache_hits, "misses": self.cache_misses,
+                "size": len(self.word_cache), "max_size": self.word_cache_size}
+
+    def clear_cache(self):
+        """Empties the word cache and resets its counters.
+
+        This must be called after changing `basic_tokenizer` options such as `do_lower_case`
+        or `never_split`, or the vocab, on an existing tokenizer.
+        """
+        self.word_cache = collections.OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def convert_tokens_to_ids(self, tokens):
         """Converts a sequence of tokens into ids using the vocab."""
         ids = []
@@ -125,6 +354,155 @@ class BertTokenizer(object):
             tokens.append(self.ids_to_tokens[i])
         return tokens
 
+    @property
+    def id_to_token_table(self):
+        """A NumPy object array with the token of id `i` at index `i` (None for unused ids)."""
+        if self._id_to_token_table is None:
+            if isinstance(self.vocab, CompiledVocab):
+                table = np.empty(len(self.ids_to_tokens), dtype=object)
+                table[:] = self.ids_to_tokens[:]
+            else:
+                table = np.empty(max(self.ids_to_tokens, default=-1) + 1, dtype=object)
+                for i, token in self.ids_to_tokens.items():
+                    table[i] = token
+            self._id_to_token_table = table
+        return self._id_to_token_table
+
+    def batch_convert_tokens_to_ids(self, tokens, max_len=None, pad_id=0, return_tensors="np"):
+        """Bulk version of `convert_tokens_to_ids`.
+
+        Args:
+          tokens: a list of tokens, or a list of token lists for a batch.
+          max_len: length of the rows of a batch. Rows are padded with `pad_id` to the longest
+            one by default. A row longer than `max_len` raises a ValueError.
+          pad_id: the id used for padding.
+          return_tensors: "np" for an int64 NumPy array, "pt" for a torch LongTensor.
+
+        Returns:
+          An array of shape [len(tokens)], or [batch_size, max_len] for a batch.
+        """
+        if return_tensors not in ("np", "pt"):
+            raise ValueError("return_tensors should be 'np' or 'pt', got {}".format(return_tensors))
+        lookup = self.vocab.__getitem__
+        if len(tokens) > 0 and not isinstance(tokens[0], str):
+            lengths = [len(row) for row in tokens]
+            width = max(lengths, default=0) if max_len is None else max_len
+            if max(lengths, default=0) > min(width, self.max_len):
+                raise ValueError(
+                    "Token indices sequence length is longer than the specified maximum "
+                    " sequence length ({} > {})".format(max(lengths), min(width, self.max_len)))
+            flat = np.fromiter((lookup(token) for row in tokens for token in row),
+                               dtype=np.int64, count=sum(lengths))
+            ids = np.full((len(tokens), width), pad_id, dtype=np.int64)
+            lengths = np.asarray(lengths, dtype=np.int64)
+            ids[np.arange(width) < lengths[:, None]] = flat
+        else:
+            if len(tokens) > self.max_len:
+                raise ValueError(
+                    "Token indices sequence length is longer than the specified maximum "
+                    " sequence length for this BERT model ({} > {}). Running this"
+                    " sequence through BERT will result in indexing errors".format(len(tokens), self.max_len)
+                )
+            ids = np.fromiter(map(lookup, tokens), dtype=np.int64, count=len(tokens))
+        if return_tensors == "pt":
+            import torch
+            return torch.from_numpy(ids)
+        return ids
+
+    def batch_convert_ids_to_tokens(self, ids, pad_id=None):
+        """Bulk version of `convert_ids_to_tokens` as a single gather over `id_to_token_table`.
+
+        Args:
+          ids: a list, NumPy array or torch tensor of ids, of any shape.
+          pad_id: if given, positions holding `pad_id` are dropped and lists are returned
+            instead of an array, e.g. to decode a padded [batch_size, seq_len] batch.
+
+        Returns:
+          An object array of tokens with the same shape as `ids`. If `pad_id` is given, a list
+          of tokens for 1-D ids and a list of token lists (one per row) for 2-D ids.
+        """
+        if hasattr(ids, "detach"):
+            ids = ids.detach().cpu().numpy()
+        ids = np.asarray(ids, dtype=np.int64)
+        table = self.id_to_token_table
+        # Negative ids would index the table from the end: raise as `convert_ids_to_tokens` does.
+        if ids.size and ids.min() < 0:
+            raise KeyError(int(ids.min()))
+        if ids.size and ids.max() >= len(table):
+            raise KeyError(int(ids.max()))
+        tokens = table[ids]
+        if pad_id is None:
+            return tokens
+        keep = ids != pad_id
+        if tokens.ndim == 1:
+            return tokens[keep].tolist()
+        if tokens.ndim != 2:
+            raise ValueError("Padding can only be removed from 1-D or 2-D ids, got shape {}".format(ids.shape))
+        return [row[row_keep].tolist() for row, row_keep in zip(tokens, keep)]
+
+    def encode(self, text, text_pair=None, max_len=128):
+        """Converts a text (or a text pair) into the BERT input format.
+
+        The sequence is `[CLS] text [SEP]` or `[CLS] text [SEP] text_pair [SEP]`, truncated
+        longest-first to `max_len` tokens the same way the example scripts do.
+
+        Returns:
+            A tuple `(input_ids, segment_ids)` of unpadded lists.
+        """
+        tokens_a = self.tokenize(text)
+        tokens_b = None
+        if text_pair:
+            tokens_b = self.tokenize(text_pair)
+        if tokens_b:
+            # Account for [CLS], [SEP], [SEP] with "- 3"
+            _truncate_seq_pair(tokens_a, tokens_b, max_len - 3)
+        elif len(tokens_a) > max_len - 2:
+            # Account for [CLS] and [SEP] with "- 2"
+            tokens_a = tokens_a[:(max_len - 2)]
+
+        tokens = ["[CLS]"] + tokens_a + ["[SEP]"]
+        segment_ids = [0] * len(tokens)
+        if tokens_b:
+            tokens += tokens_b + ["[SEP]"]
+            segment_ids += [1] * (len(tokens_b) + 1)
+        return self.convert_tokens_to_ids(tokens), segment_ids
+
+    def batch_encode(self, texts, text_pairs=None, max_len=128, num_workers=1, chunk_size=1000):
+        """Encodes a batch of texts (or text pairs) into padded NumPy arrays.
+
+        Params:
+            texts: a list of strings.
+            text_pairs: an optional list of second segments, aligned with `texts`.
+            max_len: the padded sequence length.
+            num_workers: number of processes used to tokenize. Each worker receives the
+                tokenizer once, when the pool starts: its vocab and settings, without the
+                word cache or the wordpiece trie (see `__getstate__`).
+            chunk_size: number of examples sent to a worker at a time.
+
+        Returns:
+            A tuple `(input_ids, input_mask, segment_ids)` of np.int64 arrays of shape
+            [len(texts), max_len].
+        """
+        if text_pairs is not None and len(text_pairs) != len(texts):
+            raise ValueError("`texts` and `text_pairs` must have the same length "
+                             "({} != {})".format(len(texts), len(text_pairs)))
+        chunks = []
+        for start in range(0, len(texts), chunk_size):
+            chunks.append((texts[start:start + chunk_size],
+                           None if text_pairs is None else text_pairs[start:start + chunk_size],
+                           max_len))
+        if num_workers > 1 and len(chunks) > 1:
+            with multiprocessing.Pool(min(num_workers, len(chunks)),
+                                      initializer=_init_batch_encode_worker,
+                                      initargs=(self,)) as pool:
+                results = pool.map(_batch_encode_chunk, chunks)
+        else:
+            results = [_encode_chunk(self, *chunk) for chunk in chunks]
+        if not results:
+            empty = np.zeros((0, max_len), dtype=np.int64)
+            return empty, empty.copy(), empty.copy()
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
+
     @classmethod
     def from_pretrained(cls, pretrained_model_name, cache_dir=None, *inputs, **kwargs):
         """
@@ -136,7 +514,10 @@ class BertTokenizer(object):
         else:
             vocab_file = pretrained_model_name
         if os.path.isdir(vocab_file):
-            vocab_file = os.path.join(vocab_file, VOCAB_NAME)
+            if os.path.isfile(os.path.join(vocab_file, COMPILED_VOCAB_NAME)):
+                vocab_file = os.path.join(vocab_file, COMPILED_VOCAB_NAME)
+            else:
+                vocab_file = os.path.join(vocab_file, VOCAB_NAME)
         # redirect to the cache, if necessary
         try:
             """Save file to "~/.pytorch_pretrained_bert".
@@ -166,6 +547,49 @@ class BertTokenizer(object):
         return tokenizer
 
 
+def _truncate_seq_pair(tokens_a, tokens_b, max_length):
+    """Truncates a sequence pair in place to the maximum length."""
+
+    # This is a simple heuristic which will always truncate the longer sequence
+    # one token at a time. This makes more sense than truncating an equal percent
+    # of tokens from each, since if one sequence is very short then each token
+    # that's truncated likely contains more information than a longer sequence.
+    while True:
+        total_length = len(tokens_a) + len(tokens_b)
+        if total_length <= max_length:
+            break
+        if len(tokens_a) > len(tokens_b):
+            tokens_a.pop()
+        else:
+            tokens_b.pop()
+
+
+def _encode_chunk(tokenizer, texts, text_pairs, max_len):
+    """Encodes a list of texts into padded (input_ids, input_mask, segment_ids) arrays."""
+    input_ids = np.zeros((len(texts), max_len), dtype=np.int64)
+    input_mask = np.zeros((len(texts), max_len), dtype=np.int64)
+    segment_ids = np.zeros((len(texts), max_len), dtype=np.int64)
+    for i, text in enumerate(texts):
+        ids, segments = tokenizer.encode(text, None if text_pairs is None else text_pairs[i], max_len)
+        input_ids[i, :len(ids)] = ids
+        input_mask[i, :len(ids)] = 1
+        segment_ids[i, :len(ids)] = segments
+    return input_ids, input_mask, segment_ids
+
+
+# The tokenizer of a `batch_encode` worker process, set once by the pool initializer.
+_worker_tokenizer = None
+
+
+def _init_batch_encode_worker(tokenizer):
+    global _worker_tokenizer
+    _worker_tokenizer = tokenizer
+
+
+def _batch_encode_chunk(chunk):
+    return _encode_chunk(_worker_tokenizer, *chunk)
+
+
 class BasicTokenizer(object):
     """Runs basic tokenization (punctuation splitting, lower casing, etc.)."""
 
@@ -182,6 +606,98 @@ class BasicTokenizer(object):
 
     def tokenize(self, text):
         """Tokenizes a piece of text."""
+        if text.isascii():
+            return self._tokenize_ascii(text)
+        split_tokens = []
+        for token in self.split_words(text):
+            if len(token) == 1 and _is_unified_cjk_char(token):
+                # Most words of Chinese text: nothing to lower case, strip or split.
+                split_tokens.append(token)
+            else:
+                split_tokens.extend(self.tokenize_word(token))
+
+        """
+        output_tokens:
+            ['[CLS]', 'who', '这', '是', '一', '个', '测', '试', 'was', 'jim', 'henson', '?', '[SEP]', 'jim', 'henson', 
+                'was', 'a', 'puppeteer', '[SEP]']
+        """
+        # `tokenize_word` never produces whitespace or empty tokens, so unlike the original
+        # implementation there is no need to join and re-split the tokens here.
+        return split_tokens
+
+    def _tokenize_ascii(self, text):
+        """Same as `tokenize` for pure-ASCII text.
+
+        ASCII text has no CJK characters and nothing for `_run_strip_accents` to remove, so
+        cleanup is a single `str.translate` and punctuation splitting a single regex per word.
+        """
+        never_split = self.never_split
+        split_on_punc = _ASCII_SPLIT_ON_PUNC_PATTERN.findall
+        split_tokens = []
+        for token in text.translate(_ASCII_CLEAN_TABLE).split():
+            if self.do_lower_case and token not in never_split:
+                token = token.lower()
+            if token in never_split:
+                split_tokens.append(token)
+            else:
+                split_tokens.extend(split_on_punc(token))
+        return split_tokens
+
+    def tokenize_with_char_spans(self, text):
+        """Tokenizes a piece of text and maps every character of every token back to `text`.
+
+        Returns:
+            A tuple `(tokens, char_spans)`. `tokens` is the same as `tokenize(text)` and
+            `char_spans[i][j]` is the `(start, end)` span in `text` of the j-th character of
+            `tokens[i]`. Characters produced by lower casing or accent stripping map to the
+            character they come from.
+        """
+        tokens = []
+        char_spans = []
+        for word, word_spans in self._split_words_with_char_spans(text):
+            if self.do_lower_case and word not in self.never_split:
+                normalized = self._run_strip_accents(word.lower())
+                normalized_chars = [self._run_strip_accents(char.lower()) for char in word]
+                if "".join(normalized_chars) == normalized:
+                    word_spans = [span for char, span in zip(normalized_chars, word_spans)
+                                  for _ in range(len(char))]
+                else:
+                    # Context dependent lower casing (e.g. a final sigma): map every character
+                    # to the whole word.
+                    word_spans = [(word_spans[0][0], word_spans[-1][1])] * len(normalized)
+                word = normalized
+            start = 0
+            for token in self._run_split_on_punc(word):
+                tokens.append(token)
+                char_spans.append(word_spans[start:start + len(token)])
+                start += len(token)
+        return tokens, char_spans
+
+    def _split_words_with_char_spans(self, text):
+        """Same as `split_words`, yielding each word with the span in `text` of each of its characters."""
+        word = []
+        word_spans = []
+        for i, char in enumerate(text):
+            char_class = _char_class(char)
+            if ord(char) == 0xfffd or char_class & _CONTROL:
+                continue
+            if char_class & (_WHITESPACE | _CHINESE) or char.isspace():
+                if word:
+                    yield "".join(word), word_spans
+                    word = []
+                    word_spans = []
+                if char_class & _CHINESE:
+                    yield char, [(i, i + 1)]
+                continue
+            word.append(char)
+            word_spans.append((i, i + 1))
+        if word:
+            yield "".join(word), word_spans
+
+    def split_words(self, text):
+        """Cleans `text` and splits it on whitespace, with every CJK character as its own word."""
+        if text.isascii():
+            return text.translate(_ASCII_CLEAN_TABLE).split()
         text = self._clean_text(text)
         # This was added on November 1st, 2018 for the multilingual and Chinese
         # models. This is also applied to the English models now, but it doesn't
@@ -189,22 +705,19 @@ class BasicTokenizer(object):
         # and generally don't have any Chinese data in them (there are Chinese
         # characters in the vocabulary because Wikipedia does have some Chinese
         # words in the English Wikipedia.).
-        text = self._tokenize_chinese_chars(text)
-        orig_tokens = whitespace_tokenize(text)
-        split_tokens = []
-        for token in orig_tokens:
-            if self.do_lower_case and token not in self.never_split:
-                token = token.lower()
-                token = self._run_strip_accents(token)
-            split_tokens.extend(self._run_split_on_punc(token))
+        # Matching CJK characters and whitespace-separated runs in a single regex pass gives
+        # the same words as `whitespace_tokenize(self._tokenize_chinese_chars(text))`
+        # without building the intermediate spaced-out string.
+        return _CJK_SEGMENTATION_PATTERN.findall(text)
 
-        """
-        output_tokens:
-            ['[CLS]', 'who', '这', '是', '一', '个', '测', '试', 'was', 'jim', 'henson', '?', '[SEP]', 'jim', 'henson', 
-                'was', 'a', 'puppeteer', '[SEP]']
-        """
-        output_tokens = whitespace_tokenize(" ".join(split_tokens))
-        return output_tokens
+    def tokenize_word(self, token):
+        """Lower cases, strips accents and splits punctuation of a single word from `split_words`."""
+        if token.isascii():
+            return self._tokenize_ascii(token)
+        if self.do_lower_case and token not in self.never_split:
+            token = token.lower()
+            token = self._run_strip_accents(token)
+        return self._run_split_on_punc(token)
 
     def _run_strip_accents(self, text):
         """Strips accents from a piece of text."""
@@ -234,13 +747,15 @@ class BasicTokenizer(object):
         """
         if text in self.never_split:
             return [text]
+        if not _has_astral_chars(text):
+            return _get_char_class_patterns()["split_on_punc"].findall(text)
         chars = list(text)
         i = 0
         start_new_word = True
         output = []
         while i < len(chars):
             char = chars[i]
-            if _is_punctuation(char):
+            if _char_class(char) & _PUNCTUATION:
                 output.append([char])
                 start_new_word = True
             else:
@@ -278,16 +793,10 @@ class BasicTokenizer(object):
                 ' ', 'w', 'a', 's', ' ', 'a', ' ', 'p', 'u', 'p', 'p', 'e', 't', 'e', 'e', 'r', ' ', '[', 'S', 'E', 'P', 
                 ']']
         """
-        output = []
-        for char in text:
-            cp = ord(char)  #
-            if self._is_chinese_char(cp):
-                output.append(" ")
-                output.append(char)
-                output.append(" ")
-            else:
-                output.append(char)
-        return "".join(output)
+        text = text.translate(_get_char_class_patterns()["cjk_spacing"])
+        if _has_astral_chars(text):
+            text = _ASTRAL_CJK_CHAR_PATTERN.sub(r" \g<0> ", text)
+        return text
 
     def _is_chinese_char(self, cp):
         """Checks whether CP is the codepoint of a CJK character."""
@@ -299,32 +808,75 @@ class BasicTokenizer(object):
         # as is Japanese Hiragana and Katakana. Those alphabets are used to write
         # space-separated words, so they are not treated specially and handled
         # like the all of the other languages.
-        if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-                (cp >= 0x3400 and cp <= 0x4DBF) or  #
-                (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-                (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-                (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-                (cp >= 0x2B820 and cp <= 0x2CEAF) or
-                (cp >= 0xF900 and cp <= 0xFAFF) or  #
-                (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-            return True
-
+        if cp < 0x10000:
+            return bool(_get_bmp_char_classes()[cp] & _CHINESE)
+        for start, end in _CJK_RANGES:
+            if start <= cp <= end:
+                return True
         return False
 
     def _clean_text(self, text):
         """Performs invalid character removal and whitespace cleanup on text."""
+        if not _has_astral_chars(text):
+            patterns = _get_char_class_patterns()
+            return patterns["whitespace"].sub(" ", patterns["invalid"].sub("", text))
         output = []
         for char in text:
-            cp = ord(char)
-            if cp == 0 or cp == 0xfffd or _is_control(char):
+            char_class = _char_class(char)
+            if ord(char) == 0xfffd or char_class & _CONTROL:
                 continue
-            if _is_whitespace(char):
+            if char_class & _WHITESPACE:
                 output.append(" ")
             else:
                 output.append(char)
         return "".join(output)
 
 
+class WordpieceTrie(object):
+    """Prefix trie over a wordpiece vocabulary.
+
+    Two roots are kept: `root` holds every vocabulary entry as-is and is used for
+    the word-initial piece, `suffix_root` holds the `##` continuation pieces with
+    the prefix removed. Each terminal node stores the full vocabulary token under
+    the `""` key, so a match never has to rebuild the piece string.
+    """
+
+    def __init__(self, vocab, suffix_prefix="##"):
+        self.root = {}
+        self.suffix_root = {}
+        for token in vocab:
+            self._insert(self.root, token, token)
+            if token.startswith(suffix_prefix):
+                self._insert(self.suffix_root, token[len(suffix_prefix):], token)
+
+    @staticmethod
+    def _insert(node, chars, token):
+        if not chars:
+            # The greedy matcher never looks up an empty piece.
+            return
+        for char in chars:
+            node = node.setdefault(char, {})
+        node[""] = token
+
+    def longest_match(self, text, start, is_suffix=False):
+        """Returns `(piece, end)` for the longest vocab piece of `text` starting at `start`.
+
+        `piece` is None when no vocabulary entry matches.
+        """
+        node = self.suffix_root if is_suffix else self.root
+        piece = None
+        end = start
+        for i in range(start, len(text)):
+            node = node.get(text[i])
+            if node is None:
+                break
+            token = node.get("")
+            if token is not None:
+                piece = token
+                end = i + 1
+        return piece, end
+
+
 class WordpieceTokenizer(object):
     """Runs WordPiece tokenization."""
 
@@ -332,12 +884,28 @@ class WordpieceTokenizer(object):
         self.vocab = vocab
         self.unk_token = unk_token
         self.max_input_chars_per_word = max_input_chars_per_word
+        self._trie = None
+
+    def __getstate__(self):
+        # The trie is rebuilt lazily from the vocab rather than pickled.
+        state = self.__dict__.copy()
+        state["_trie"] = None
+        return state
+
+    @property
+    def trie(self):
+        """The `WordpieceTrie` of the vocab, built on first use so that constructing a tokenizer stays cheap."""
+        if self._trie is None:
+            self._trie = WordpieceTrie(self.vocab)
+        return self._trie
 
     def tokenize(self, text):
         """Tokenizes a piece of text into its word pieces.
 
         This uses a greedy longest-match-first algorithm to perform tokenization
-        using the given vocabulary.
+        using the given vocabulary. The longest match at each position is found by
+        walking `self.trie`, which costs O(word length) instead of probing the
+        vocab with every shorter substring.
 
         For example:
           input = "unaffable"
@@ -359,26 +927,17 @@ class WordpieceTokenizer(object):
         """
 
         output_tokens = []
+        longest_match = self.trie.longest_match
         for token in whitespace_tokenize(text):  # text is a word
-            chars = list(token)
-            if len(chars) > self.max_input_chars_per_word:
+            if len(token) > self.max_input_chars_per_word:
                 output_tokens.append(self.unk_token)  # unknown
                 continue
 
             is_bad = False
             start = 0
             sub_tokens = []
-            while start < len(chars):
-                end = len(chars)
-                cur_substr = None
-                while start < end:
-                    substr = "".join(chars[start:end])
-                    if start > 0:
-                        substr = "##" + substr
-                    if substr in self.vocab:
-                        cur_substr = substr
-                        break
-                    end -= 1
+            while start < len(token):
+                cur_substr, end = longest_match(token, start, start > 0)
                 if cur_substr is None:
                     is_bad = True
                     break
@@ -430,3 +989,123 @@ def _is_punctuation(char):
     if cat.startswith("P"):
         return True
     return False
+
+
+# This defines a "chinese character" as anything in the CJK Unicode block, see
+# `BasicTokenizer._is_chinese_char`.
+_CJK_RANGES = (
+    (0x4E00, 0x9FFF),
+    (0x3400, 0x4DBF),
+    (0x20000, 0x2A6DF),
+    (0x2A700, 0x2B73F),
+    (0x2B740, 0x2B81F),
+    (0x2B820, 0x2CEAF),
+    (0xF900, 0xFAFF),
+    (0x2F800, 0x2FA1F),
+)
+_ASTRAL_CJK_CHAR_PATTERN = re.compile(
+    "[" + "".join("\\U%08x-\\U%08x" % (start, end) for start, end in _CJK_RANGES if start > 0xffff) + "]")
+
+_ASTRAL_CHAR_PATTERN = re.compile("[\\U00010000-\\U0010ffff]")
+
+# A single CJK character, or a run of other non-whitespace characters: the words of `split_words`.
+_CJK_CHAR_CLASS = "".join("\\U%08x-\\U%08x" % (start, end) for start, end in _CJK_RANGES)
+_CJK_SEGMENTATION_PATTERN = re.compile("[" + _CJK_CHAR_CLASS + "]|[^\\s" + _CJK_CHAR_CLASS + "]+")
+
+
+def _is_unified_cjk_char(char):
+    """Checks whether `char` is one of the CJK unified ideographs, which `tokenize_word` leaves as they are.
+
+    The compatibility ideographs (0xF900-0xFAFF and 0x2F800-0x2FA1F) are not included since
+    accent stripping changes them into their unified equivalents.
+    """
+    return u"\u3400" <= char <= u"\u9fff" or u"\U00020000" <= char <= u"\U0002ceaf"
+
+
+# Bit flags of the per-codepoint character class table.
+_WHITESPACE = 1
+_CONTROL = 2
+_PUNCTUATION = 4
+_CHINESE = 8
+
+# One byte of class flags per Basic Multilingual Plane codepoint, built on first use.
+# Codepoints outside the BMP are rare and classified on the fly.
+_bmp_char_classes = None
+_char_class_patterns = None
+
+
+def _compute_char_class(char):
+    """Returns the class flags of `char` from the unicodedata based `_is_*` checks."""
+    char_class = 0
+    if _is_whitespace(char):
+        char_class |= _WHITESPACE
+    if _is_control(char):
+        char_class |= _CONTROL
+    if _is_punctuation(char):
+        char_class |= _PUNCTUATION
+    cp = ord(char)
+    for start, end in _CJK_RANGES:
+        if start <= cp <= end:
+            char_class |= _CHINESE
+    return char_class
+
+
+def _get_bmp_char_classes():
+    global _bmp_char_classes
+    if _bmp_char_classes is None:
+        _bmp_char_classes = bytearray(_compute_char_class(chr(cp)) for cp in range(0x10000))
+    return _bmp_char_classes
+
+
+def _char_class(char):
+    """Returns the class flags (`_WHITESPACE`, `_CONTROL`, ...) of a single character."""
+    cp = ord(char)
+    if cp < 0x10000:
+        return _get_bmp_char_classes()[cp]
+    return _compute_char_class(char)
+
+
+def _has_astral_chars(text):
+    """Checks whether `text` has a character outside the Basic Multilingual Plane."""
+    return _ASTRAL_CHAR_PATTERN.search(text) is not None
+
+
+def _bmp_regex_class(flag, extra=()):
+    """Builds a regex character class matching every BMP codepoint with `flag` set."""
+    table = _get_bmp_char_classes()
+    codepoints = [cp for cp in range(0x10000) if table[cp] & flag]
+    codepoints = sorted(set(codepoints).union(extra))
+    ranges = []
+    for cp in codepoints:
+        if ranges and ranges[-1][1] == cp - 1:
+            ranges[-1][1] = cp
+        else:
+            ranges.append([cp, cp])
+    return "[" + "".join("\\u%04x-\\u%04x" % (start, end) for start, end in ranges) + "]"
+
+
+def _get_char_class_patterns():
+    """Returns the compiled regexes and translation table used by `BasicTokenizer` on BMP text."""
+    global _char_class_patterns
+    if _char_class_patterns is None:
+        table = _get_bmp_char_classes()
+        punctuation = _bmp_regex_class(_PUNCTUATION)
+        _char_class_patterns = {
+            "cjk_spacing": {cp: " " + chr(cp) + " " for cp in range(0x10000) if table[cp] & _CHINESE},
+            "invalid": re.compile(_bmp_regex_class(_CONTROL, extra=(0, 0xfffd)) + "+"),
+            "whitespace": re.compile(_bmp_regex_class(_WHITESPACE)),
+            "split_on_punc": re.compile(punctuation + "|[^" + punctuation[1:] + "+"),
+        }
+    return _char_class_patterns
+
+
+# Pure-ASCII text is handled without the character class table, see `BasicTokenizer._tokenize_ascii`.
+_ASCII_CLEAN_TABLE = {}
+for _cp in range(128):
+    if _cp == 0 or _is_control(chr(_cp)):
+        _ASCII_CLEAN_TABLE[_cp] = None
+    elif _is_whitespace(chr(_cp)):
+        _ASCII_CLEAN_TABLE[_cp] = " "
+_ASCII_PUNCTUATION = re.escape("".join(chr(_cp) for _cp in range(128) if _is_punctuation(chr(_cp))))
+_ASCII_SPLIT_ON_PUNC_PATTERN = re.compile("[" + _ASCII_PUNCTUATION + "]|[^" + _ASCII_PUNCTUATION + "]+")
+del _cp
@@ -62,7 +62,7 @@ setup(
         "pytorch_pretrained_bert=pytorch_pretrained_bert.__main__:main"
       ]
     },
-    python_requires='>=3.5.0',
+    python_requires='>=3.7.0',
     tests_require=['pytest'],
     classifiers=[
           'Intended Audience :: Science/Research',
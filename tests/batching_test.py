@@ -0,0 +1,116 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import random
+import unittest
+
+import torch
+from torch.utils.data import DataLoader, TensorDataset
+
+from pytorch_pretrained_bert.batching import (BucketBatchSampler, DistributedBucketBatchSampler,
+                                              TrimPaddingCollate, lengths_from_input_mask)
+
+
+class BatchingTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = random.Random(0)
+        self.lengths = [rng.randint(1, 64) for _ in range(1000)]
+
+    def test_bucket_batch_sampler(self):
+        sampler = BucketBatchSampler(self.lengths, batch_size=16, bucket_size_multiplier=10)
+        batches = list(sampler)
+        self.assertEqual(sorted(index for batch in batches for index in batch), list(range(1000)))
+        self.assertTrue(all(len(batch) <= 16 for batch in batches))
+        # Batches are made of similar lengths, so there is less padding than with random batches.
+        def padded_size(batches):
+            return sum(len(batch) * max(self.lengths[i] for i in batch) for batch in batches)
+        random_batches = [list(range(i, min(i + 16, 1000))) for i in range(0, 1000, 16)]
+        self.assertLess(padded_size(batches), 0.7 * padded_size(random_batches))
+
+        self.assertEqual(batches, list(sampler))
+        sampler.set_epoch(1)
+        self.assertNotEqual(batches, list(sampler))
+
+        batches = list(BucketBatchSampler(self.lengths, batch_size=16, shuffle=False))
+        self.assertEqual([index for batch in batches for index in batch],
+                         sorted(range(1000), key=lambda index: self.lengths[index]))
+
+    def test_bucket_batch_sampler_max_tokens(self):
+        batches = list(BucketBatchSampler(self.lengths + [100], max_tokens=256))
+        self.assertEqual(sorted(index for batch in batches for index in batch), list(range(1001)))
+        for batch in batches:
+            if batch != [1000]:
+                self.assertLessEqual(len(batch) * max(self.lengths[i] for i in batch), 256)
+        self.assertIn([1000], batches)
+
+        batches = list(BucketBatchSampler(self.lengths, batch_size=4, max_tokens=256))
+        self.assertTrue(all(len(batch) <= 4 for batch in batches))
+
+        with self.assertRaises(ValueError):
+            BucketBatchSampler(self.lengths)
+
+    def test_epoch_lengths(self):
+        for sampler in [BucketBatchSampler(self.lengths, batch_size=16, max_tokens=300, bucket_size_multiplier=5),
+                        DistributedBucketBatchSampler(self.lengths, max_tokens=300, num_replicas=3, rank=1)]:
+            sampler.set_epoch(7)
+            epoch_lengths = sampler.epoch_lengths(4)
+            self.assertEqual(sampler.epoch, 7)
+            for epoch, length in enumerate(epoch_lengths):
+                sampler.set_epoch(epoch)
+                self.assertEqual(length, len(list(sampler)))
+
+    def test_distributed_bucket_batch_sampler(self):
+        samplers = [DistributedBucketBatchSampler(self.lengths, batch_size=16, num_replicas=3, rank=rank)
+                    for rank in range(3)]
+        replica_batches = [list(sampler) for sampler in samplers]
+        self.assertEqual(len(set(len(batches) for batches in replica_batches)), 1)
+        self.assertEqual(len(samplers[0]), len(replica_batches[0]))
+        indices = [index for batches in replica_batches for batch in batches for index in batch]
+        self.assertEqual(set(indices), set(range(1000)))
+
+    def test_distributed_bucket_batch_sampler_few_batches(self):
+        # Fewer batches than half the replicas: every rank still gets as many batches.
+        for lengths, batch_size, num_replicas in [([3, 5, 2], 4, 4), ([3, 5, 2, 7, 1], 2, 8)]:
+            num_batches = len(BucketBatchSampler(lengths, batch_size=batch_size))
+            self.assertGreater(num_replicas, 2 * num_batches)
+            # Padded up to a multiple of the number of replicas.
+            num_batches = -(-num_batches // num_replicas) * num_replicas
+            for rank in range(num_replicas):
+                sampler = DistributedBucketBatchSampler(lengths, batch_size=batch_size, num_replicas=num_replicas,
+                                                        rank=rank)
+                self.assertEqual(len(list(sampler)), num_batches // num_replicas)
+                self.assertEqual(len(sampler), num_batches // num_replicas)
+
+    def test_trim_padding_collate(self):
+        input_mask = (torch.arange(12).unsqueeze(0) < torch.tensor(self.lengths[:20]).unsqueeze(1) % 12).long()
+        input_ids = torch.randint(1, 100, (20, 12)) * input_mask
+        labels = torch.arange(20) % 12
+        dataset = TensorDataset(input_ids, input_mask, labels)
+        self.assertEqual(lengths_from_input_mask(input_mask), input_mask.sum(1).tolist())
+
+        sampler = BucketBatchSampler(lengths_from_input_mask(input_mask), batch_size=12)
+        for batch_ids, batch_mask, batch_labels in DataLoader(dataset, batch_sampler=sampler,
+                                                              collate_fn=TrimPaddingCollate(mask_index=1)):
+            self.assertEqual(batch_ids.size(1), max(1, int(batch_mask.sum(1).max())))
+            self.assertEqual(batch_ids.size(), batch_mask.size())
+            self.assertEqual(batch_labels.dim(), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert.export import (InferenceOutputs, OnnxRuntimeModel, example_inputs, export_onnx,
+                                            export_torchscript)
+from pytorch_pretrained_bert.modeling import (BertConfig, BertModel, BertForSequenceClassification,
+                                              BertForQuestionAnswering, BertForTokenClassification)
+from pytorch_pretrained_bert.tokenization import BasicTokenizer, BertTokenizer
+
+try:
+    import onnxruntime  # noqa: F401
+    _has_onnxruntime = True
+except ImportError:
+    _has_onnxruntime = False
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "samples")
+
+
+def load_samples(tmp_dir, max_len=48):
+    """Encodes the texts of samples/ (the pairs of input.txt and the sentences of sample_text.txt) with a
+    vocab of their own words. Returns the vocab size and (input_ids, segment_ids, input_mask) tensors."""
+    texts, text_pairs = [], []
+    with open(os.path.join(SAMPLES_DIR, "input.txt"), encoding="utf-8") as reader:
+        for line in reader:
+            text_a, _, text_b = line.strip().partition(" ||| ")
+            texts.append(text_a)
+            text_pairs.append(text_b)
+    with open(os.path.join(SAMPLES_DIR, "sample_text.txt"), encoding="utf-8") as reader:
+        sentences = [line.strip() for line in reader if line.strip()][:30]
+    texts.extend(sentences)
+    text_pairs.extend([None] * len(sentences))
+
+    words = set()
+    basic_tokenizer = BasicTokenizer(do_lower_case=True)
+    for text in texts + [text for text in text_pairs if text]:
+        words.update(basic_tokenizer.tokenize(text))
+    vocab_file = os.path.join(tmp_dir, "vocab.txt")
+    vocab = ["[PAD]", "[UNK]", "[CLS]", "[SEP]"] + sorted(words)
+    with open(vocab_file, "w", encoding="utf-8") as writer:
+        writer.write("".join(token + "\n" for token in vocab))
+    tokenizer = BertTokenizer(vocab_file)
+    input_ids, input_mask, segment_ids = tokenizer.batch_encode(texts, text_pairs, max_len=max_len)
+    return len(vocab), [torch.from_numpy(array) for array in (input_ids, segment_ids, input_mask)]
+
+
+class ExportTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.config = BertConfig(vocab_size_or_config_json_file=99, hidden_size=32, num_hidden_layers=2,
+                                 num_attention_heads=4, intermediate_size=37, max_position_embeddings=64)
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_export_torchscript(self):
+        for model_class in [BertModel, BertForSequenceClassification, BertForQuestionAnswering,
+                            BertForTokenClassification]:
+            model = model_class(self.config)
+            path = os.path.join(self.tmp_dir, model_class.__name__ + ".pt")
+            export_torchscript(model, path)
+            loaded = torch.jit.load(path)
+            # Other shapes than the traced ones.
+            for batch_size, seq_length in [(1, 7), (5, 30)]:
+                inputs = example_inputs(model, batch_size=batch_size, seq_length=seq_length)
+                with torch.no_grad():
+                    expected = InferenceOutputs(model)(*inputs)
+                    outputs = loaded(*inputs)
+                if not isinstance(expected, tuple):
+                    expected, outputs = (expected,), (outputs,)
+                self.assertEqual(len(outputs), len(expected))
+                for output, expected_output in zip(outputs, expected):
+                    self.assertEqual(output.shape, expected_output.shape)
+                    self.assertTrue(torch.allclose(output, expected_output, atol=1e-5))
+
+    @unittest.skipIf(not _has_onnxruntime, "onnxruntime is not installed")
+    def test_export_onnx(self):
+        vocab_size, inputs = load_samples(self.tmp_dir)
+        self.config.vocab_size = vocab_size
+        for model_class in [BertForSequenceClassification, BertForQuestionAnswering]:
+            model = model_class(self.config)
+            path = os.path.join(self.tmp_dir, model_class.__name__ + ".onnx")
+            # Exported with random inputs of another shape than the samples.
+            export_onnx(model, path)
+            runtime_model = OnnxRuntimeModel(path)
+            with torch.no_grad():
+                expected = model(*inputs)
+            outputs = runtime_model(*inputs)
+            if not isinstance(expected, tuple):
+                expected, outputs = (expected,), (outputs,)
+            for output, expected_output in zip(outputs, expected):
+                self.assertEqual(output.shape, expected_output.shape)
+                self.assertTrue(torch.allclose(output, expected_output, atol=1e-5))
+            # Same defaults as the model for the optional inputs.
+            with torch.no_grad():
+                expected = model(inputs[0][:1])
+            outputs = runtime_model(inputs[0][:1].numpy())
+            if not isinstance(expected, tuple):
+                expected, outputs = (expected,), (outputs,)
+            for output, expected_output in zip(outputs, expected):
+                self.assertTrue(torch.allclose(output, expected_output, atol=1e-5))
+
+    def test_export_unsupported(self):
+        self.config.packed_execution = True
+        with self.assertRaises(ValueError):
+            export_torchscript(BertModel(self.config))
+        self.config.packed_execution = False
+        model = BertForSequenceClassification(self.config, early_exit=True)
+        model.early_exit_threshold = 0.9
+        with self.assertRaises(ValueError):
+            export_torchscript(model)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,109 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from pytorch_pretrained_bert.feature_cache import FeatureCache, feature_cache_key
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+
+class FeatureCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.vocab_file = os.path.join(self.cache_dir, "vocab.txt")
+        with open(self.vocab_file, "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in ["[PAD]", "[UNK]", "[CLS]", "[SEP]", "want"]]))
+        self.input_file = os.path.join(self.cache_dir, "train.json")
+        with open(self.input_file, "w") as writer:
+            writer.write("{}")
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_feature_cache_key(self):
+        tokenizer = BertTokenizer(self.vocab_file)
+        key = feature_cache_key(self.input_file, tokenizer, max_seq_length=384, doc_stride=128)
+        self.assertEqual(key, feature_cache_key([self.input_file], BertTokenizer(self.vocab_file),
+                                                doc_stride=128, max_seq_length=384))
+        self.assertNotEqual(key, feature_cache_key(self.input_file, tokenizer, max_seq_length=384, doc_stride=64))
+        self.assertNotEqual(key, feature_cache_key(self.input_file, BertTokenizer(self.vocab_file, do_lower_case=False),
+                                                   max_seq_length=384, doc_stride=128))
+        self.assertNotEqual(key, feature_cache_key(self.input_file,
+                                                   BertTokenizer(self.vocab_file, never_split=("[UNK]", "[SEP]")),
+                                                   max_seq_length=384, doc_stride=128))
+        with open(self.vocab_file, "a") as vocab_writer:
+            vocab_writer.write("##ed\n")
+        self.assertNotEqual(key, feature_cache_key(self.input_file, BertTokenizer(self.vocab_file),
+                                                   max_seq_length=384, doc_stride=128))
+        with open(self.input_file, "w") as writer:
+            writer.write("{ }")
+        self.assertNotEqual(key, feature_cache_key(self.input_file, tokenizer, max_seq_length=384, doc_stride=128))
+
+    def test_save_and_load(self):
+        cache = FeatureCache(self.cache_dir)
+        arrays = {"input_ids": np.arange(12, dtype=np.int64).reshape(3, 4), "label": np.array([0, 1, 1])}
+        self.assertIsNone(cache.load("key"))
+
+        built = []
+        def build_fn():
+            built.append(True)
+            return arrays
+        for _ in range(2):
+            loaded = cache.get_or_create("key", build_fn)
+            self.assertEqual(sorted(loaded), ["input_ids", "label"])
+            for name in arrays:
+                self.assertListEqual(loaded[name].tolist(), arrays[name].tolist())
+        self.assertEqual(len(built), 1)
+
+        # An entry moved under another key is stale.
+        os.rename(cache.path("key"), cache.path("other_key"))
+        self.assertIsNone(cache.load("other_key"))
+        self.assertFalse(os.path.exists(cache.path("other_key")))
+
+    def test_corrupt_entries_are_not_reused(self):
+        cache = FeatureCache(self.cache_dir)
+        arrays = {"input_ids": np.arange(4096, dtype=np.int64)}
+
+        cache.save("key", arrays)
+        with open(cache.path("key"), "r+b") as writer:
+            writer.truncate(os.path.getsize(cache.path("key")) // 2)
+        self.assertIsNone(cache.load("key"))
+        self.assertFalse(os.path.exists(cache.path("key")))
+
+        cache.save("key", arrays)
+        with open(cache.path("key"), "r+b") as writer:
+            # Flip a byte in the middle of the (uncompressed) input_ids data.
+            writer.seek(2048)
+            byte = writer.read(1)
+            writer.seek(2048)
+            writer.write(bytes([byte[0] ^ 0xff]))
+        self.assertIsNone(cache.load("key"))
+
+        with open(cache.path("key"), "wb") as writer:
+            writer.write(b"not a npz file")
+        self.assertIsNone(cache.load("key"))
+
+
+if __name__ == "__main__":
+    unittest.main()
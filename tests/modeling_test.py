@@ -16,9 +16,12 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
 import unittest
 import json
 import random
+import shutil
+import tempfile
 
 import torch
 
@@ -26,6 +29,7 @@ from pytorch_pretrained_bert import (BertConfig, BertModel, BertForMaskedLM,
                                      BertForNextSentencePrediction, BertForPreTraining,
                                      BertForQuestionAnswering, BertForSequenceClassification,
                                      BertForTokenClassification)
+from pytorch_pretrained_bert.modeling import CONFIG_NAME, WEIGHTS_NAME, BertLayerNorm
 
 
 class BertModelTest(unittest.TestCase):
@@ -244,6 +248,263 @@ class BertModelTest(unittest.TestCase):
         self.assertEqual(obj["vocab_size"], 99)
         self.assertEqual(obj["hidden_size"], 37)
 
+    def test_layer_norm(self):
+        layer_norm = BertLayerNorm(16).double()
+        layer_norm.weight.data.normal_()
+        layer_norm.bias.data.normal_()
+        # Rows of variance close to eps tell apart where the epsilon is added.
+        for x in [torch.randn(3, 5, 16, dtype=torch.float64),
+                  0.5 + 1e-6 * torch.randn(3, 16, dtype=torch.float64)]:
+            u = x.mean(-1, keepdim=True)
+            s = (x - u).pow(2).mean(-1, keepdim=True)
+            expected = layer_norm.weight * (x - u) / torch.sqrt(s + layer_norm.variance_epsilon) + layer_norm.bias
+            self.assertTrue(torch.allclose(layer_norm(x), expected, atol=1e-8))
+
+    def test_fused_sublayers(self):
+        tester = BertModelTest.BertModelTester(self)
+        config, input_ids, token_type_ids, input_mask, _, _ = tester.prepare_config_and_inputs()
+        config.hidden_dropout_prob = 0.0
+        config.attention_probs_dropout_prob = 0.0
+        model = BertModel(config=config)
+        self.assertIs(model.encoder.layer[0].intermediate.intermediate_act_fn, torch.nn.functional.gelu)
+        unfused_config = BertConfig.from_dict(config.to_dict())
+        unfused_config.fused_sublayers = False
+        unfused_model = BertModel(config=unfused_config)
+        unfused_model.load_state_dict(model.state_dict())
+
+        outputs = []
+        for m in [model, unfused_model]:
+            layers, pooled = m(input_ids, token_type_ids, input_mask)
+            pooled.sum().backward()
+            outputs.append((layers[-1], m.embeddings.word_embeddings.weight.grad))
+        self.assertTrue(torch.allclose(outputs[0][0], outputs[1][0], atol=1e-5))
+        self.assertTrue(torch.allclose(outputs[0][1], outputs[1][1], atol=1e-5))
+
+    def test_fused_qkv(self):
+        tester = BertModelTest.BertModelTester(self)
+        config, input_ids, token_type_ids, input_mask, _, _ = tester.prepare_config_and_inputs()
+        model = BertModel(config=config).eval()
+        expected_layers, expected_pooled = model(input_ids, token_type_ids, input_mask)
+
+        fused_config = BertConfig.from_dict(config.to_dict())
+        fused_config.fuse_qkv = True
+        fused_model = BertModel(config=fused_config).eval()
+        # Checkpoints with separate query/key/value weights load into a fused model...
+        fused_model.load_state_dict(model.state_dict())
+        self.assertIn("encoder.layer.0.attention.self.qkv.weight", fused_model.state_dict())
+        layers, pooled = fused_model(input_ids, token_type_ids, input_mask)
+        self.assertTrue(torch.allclose(layers[-1], expected_layers[-1], atol=1e-5))
+        self.assertTrue(torch.allclose(pooled, expected_pooled, atol=1e-5))
+
+        # ... and fused checkpoints into an unfused model.
+        model = BertModel(config=config).eval()
+        model.load_state_dict(fused_model.state_dict())
+        self.assertTrue(torch.allclose(model(input_ids, token_type_ids, input_mask)[1], expected_pooled, atol=1e-5))
+
+        # Exporting back to the original layout.
+        fused_model.set_fuse_qkv(False)
+        self.assertFalse(fused_model.config.fuse_qkv)
+        self.assertEqual(sorted(fused_model.state_dict()), sorted(model.state_dict()))
+        self.assertTrue(torch.allclose(fused_model(input_ids, token_type_ids, input_mask)[1], expected_pooled,
+                                       atol=1e-5))
+
+    def test_chunked_attention(self):
+        tester = BertModelTest.BertModelTester(self, seq_length=23)
+        config, input_ids, token_type_ids, input_mask, _, _ = tester.prepare_config_and_inputs()
+        model = BertModel(config=config).eval()
+        expected_layers, expected_pooled = model(input_ids, token_type_ids, input_mask)
+
+        for chunk_size in [1, 5, 23, 64]:
+            chunked_config = BertConfig.from_dict(config.to_dict())
+            chunked_config.attention_chunk_size = chunk_size
+            chunked_model = BertModel(config=chunked_config).eval()
+            chunked_model.load_state_dict(model.state_dict())
+            layers, pooled = chunked_model(input_ids, token_type_ids, input_mask)
+            for layer, expected_layer in zip(layers, expected_layers):
+                self.assertTrue(torch.allclose(layer, expected_layer, atol=1e-5))
+            self.assertTrue(torch.allclose(pooled, expected_pooled, atol=1e-5))
+
+    def test_chunked_attention_backward(self):
+        tester = BertModelTest.BertModelTester(self, seq_length=64)
+        config, input_ids, token_type_ids, input_mask, _, _ = tester.prepare_config_and_inputs()
+        chunked_config = BertConfig.from_dict(config.to_dict())
+        chunked_config.attention_chunk_size = 8
+        models = [BertModel(config=config).eval(), BertModel(config=chunked_config).eval()]
+        models[1].load_state_dict(models[0].state_dict())
+
+        saved_bytes, grads = [], []
+        for model in models:
+            saved = []
+
+            def pack(tensor):
+                saved.append(tensor.numel() * tensor.element_size())
+                return tensor
+            with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+                _, pooled = model(input_ids, token_type_ids, input_mask)
+            pooled.sum().backward()
+            saved_bytes.append(sum(saved))
+            grads.append([p.grad for p in model.parameters()])
+        for grad, expected_grad in zip(grads[1], grads[0]):
+            self.assertTrue(torch.allclose(grad, expected_grad, atol=1e-5))
+        # The [seq_length, seq_length] scores and probabilities are not kept for the backward pass.
+        self.assertLess(saved_bytes[1], saved_bytes[0])
+
+        # With dropout (checkpoint restores the RNG state, so the recomputed blocks draw the same masks).
+        models[1].train()
+        _, pooled = models[1](input_ids, token_type_ids, input_mask)
+        pooled.sum().backward()
+
+    def test_packed_execution(self):
+        tester = BertModelTest.BertModelTester(self, batch_size=5, seq_length=11)
+        config, input_ids, token_type_ids, _, sequence_labels, _ = tester.prepare_config_and_inputs()
+        lengths = torch.tensor([11, 1, 6, 0, 9])
+        input_mask = (torch.arange(11).unsqueeze(0) < lengths.unsqueeze(1)).long()
+        input_mask[0, 4] = 0  # padding does not have to be at the end
+        model = BertForSequenceClassification(config, num_labels=2).eval()
+        with torch.no_grad():
+            expected_layers, _ = model.bert(input_ids, token_type_ids, input_mask)
+            expected_logits = model(input_ids, token_type_ids, input_mask)
+
+        packed_config = BertConfig.from_dict(config.to_dict())
+        packed_config.packed_execution = True
+        packed_model = BertForSequenceClassification(packed_config, num_labels=2).eval()
+        packed_model.load_state_dict(model.state_dict())
+        with torch.no_grad():
+            layers, _ = packed_model.bert(input_ids, token_type_ids, input_mask)
+            logits = packed_model(input_ids, token_type_ids, input_mask)
+        mask = input_mask.unsqueeze(-1).float()
+        for layer, expected_layer in zip(layers, expected_layers):
+            self.assertTrue(torch.allclose(layer * mask, expected_layer * mask, atol=1e-5))
+            self.assertEqual((layer * (1 - mask)).abs().max().item(), 0.0)
+        # The pooler reads the first token, which is padding in the 4th sequence.
+        self.assertTrue(torch.allclose(logits[lengths > 0], expected_logits[lengths > 0], atol=1e-5))
+
+        packed_model.train()
+        loss = packed_model(input_ids, token_type_ids, input_mask, sequence_labels)
+        loss.backward()
+
+    def test_output_layers(self):
+        tester = BertModelTest.BertModelTester(self)
+        config, input_ids, token_type_ids, input_mask, _, _ = tester.prepare_config_and_inputs()
+        model = BertModel(config=config).eval()
+        expected_layers, expected_pooled = model(input_ids, token_type_ids, input_mask)
+
+        layers, pooled = model(input_ids, token_type_ids, input_mask, output_layers=[-1, 0])
+        self.assertEqual(len(layers), 2)
+        self.assertTrue(torch.allclose(layers[0], expected_layers[-1]))
+        self.assertTrue(torch.allclose(layers[1], expected_layers[0]))
+        self.assertTrue(torch.allclose(pooled, expected_pooled))
+
+        # Layers above the deepest requested one are not run.
+        calls = []
+        hook = model.encoder.layer[-1].register_forward_hook(lambda *args: calls.append(True))
+        layers, pooled = model(input_ids, token_type_ids, input_mask, output_layers=[0])
+        hook.remove()
+        self.assertEqual(calls, [])
+        self.assertTrue(torch.allclose(layers[0], expected_layers[0]))
+        self.assertTrue(torch.allclose(pooled, model.pooler(expected_layers[0])))
+
+        with self.assertRaises(ValueError):
+            model(input_ids, token_type_ids, input_mask, output_layers=[config.num_hidden_layers])
+
+    def test_early_exit(self):
+        tester = BertModelTest.BertModelTester(self)
+        config, input_ids, token_type_ids, input_mask, sequence_labels, _ = tester.prepare_config_and_inputs()
+        model = BertForSequenceClassification(config, num_labels=3, early_exit=True)
+        self.assertEqual(len(model.exit_heads), config.num_hidden_layers - 1)
+        loss = model(input_ids, token_type_ids, input_mask, sequence_labels)
+        loss.backward()
+        self.assertIsNotNone(model.exit_heads[0].classifier.weight.grad)
+
+        model.eval()
+        with torch.no_grad():
+            expected_logits = model(input_ids, token_type_ids, input_mask)
+            # A threshold above 1 never exits early.
+            logits, exit_layers = model.early_exit_forward(input_ids, token_type_ids, input_mask, threshold=1.1)
+            self.assertTrue(torch.allclose(logits, expected_logits, atol=1e-5))
+            self.assertEqual(exit_layers.tolist(), [config.num_hidden_layers - 1] * tester.batch_size)
+            # A threshold of 0 always exits at the first layer.
+            model.early_exit_threshold = 0.0
+            logits = model(input_ids, token_type_ids, input_mask)
+            _, exit_layers = model.early_exit_forward(input_ids, token_type_ids, input_mask)
+            self.assertEqual(exit_layers.tolist(), [0] * tester.batch_size)
+            first_layer = model.bert(input_ids, token_type_ids, input_mask, output_layers=[0])[0][0]
+            self.assertTrue(torch.allclose(logits, model.exit_heads[0](first_layer), atol=1e-5))
+
+    def test_quantize(self):
+        tester = BertModelTest.BertModelTester(self)
+        config, input_ids, token_type_ids, input_mask, _, _ = tester.prepare_config_and_inputs()
+        model = BertForSequenceClassification(config, num_labels=3).eval()
+        with torch.no_grad():
+            expected_logits = model(input_ids, token_type_ids, input_mask)
+
+        serialization_dir = tempfile.mkdtemp()
+        try:
+            torch.save(model.state_dict(), os.path.join(serialization_dir, WEIGHTS_NAME))
+            with open(os.path.join(serialization_dir, CONFIG_NAME), "w") as writer:
+                writer.write(config.to_json_string())
+            quantized_model = BertForSequenceClassification.from_pretrained(
+                serialization_dir, num_labels=3, quantize=True).eval()
+            self.assertTrue(quantized_model.config.quantized)
+            layer = quantized_model.bert.encoder.layer[0]
+            for linear in [layer.attention.self.query, layer.attention.output.dense, layer.intermediate.dense,
+                           layer.output.dense]:
+                self.assertIsInstance(linear, torch.nn.quantized.dynamic.Linear)
+            self.assertIsInstance(quantized_model.classifier, torch.nn.Linear)
+            self.assertIsInstance(quantized_model.bert.embeddings.word_embeddings, torch.nn.Embedding)
+            with torch.no_grad():
+                logits = quantized_model(input_ids, token_type_ids, input_mask)
+            self.assertTrue(torch.allclose(logits, expected_logits, atol=1e-2))
+            with self.assertRaises(ValueError):
+                quantized_model.set_fuse_qkv(True)
+
+            # Quantized checkpoints are loaded back quantized.
+            torch.save(quantized_model.state_dict(), os.path.join(serialization_dir, WEIGHTS_NAME))
+            with open(os.path.join(serialization_dir, CONFIG_NAME), "w") as writer:
+                writer.write(quantized_model.config.to_json_string())
+            reloaded_model = BertForSequenceClassification.from_pretrained(serialization_dir, num_labels=3).eval()
+            self.assertTrue(reloaded_model.config.quantized)
+            with torch.no_grad():
+                self.assertTrue(torch.equal(reloaded_model(input_ids, token_type_ids, input_mask), logits))
+        finally:
+            shutil.rmtree(serialization_dir)
+
+    def test_compress_embeddings(self):
+        tester = BertModelTest.BertModelTester(self)
+        config, input_ids, token_type_ids, input_mask, _, _ = tester.prepare_config_and_inputs()
+        model = BertForMaskedLM(config).eval()
+        with torch.no_grad():
+            expected_scores = model(input_ids, token_type_ids, input_mask)
+
+        serialization_dir = tempfile.mkdtemp()
+        try:
+            torch.save(model.state_dict(), os.path.join(serialization_dir, WEIGHTS_NAME))
+            with open(os.path.join(serialization_dir, CONFIG_NAME), "w") as writer:
+                writer.write(config.to_json_string())
+            for mode, element_size, atol in [("fp16", 2, 1e-3), ("int8", 1, 2e-2)]:
+                compressed_model = BertForMaskedLM.from_pretrained(
+                    serialization_dir, compress_embeddings=mode).eval()
+                embedding = compressed_model.bert.embeddings.word_embeddings
+                self.assertEqual(embedding.weight.element_size(), element_size)
+                # The decoder is still tied to the (compressed) embeddings.
+                self.assertIs(compressed_model.cls.predictions.decoder.embedding, embedding)
+                with torch.no_grad():
+                    scores = compressed_model(input_ids, token_type_ids, input_mask)
+                    self.assertTrue(torch.allclose(scores, expected_scores, atol=atol))
+                    self.assertTrue(torch.allclose(embedding.linear(scores[..., :config.hidden_size], block_size=7),
+                                                   embedding.linear(scores[..., :config.hidden_size])))
+
+                compressed_dir = tempfile.mkdtemp(dir=serialization_dir)
+                torch.save(compressed_model.state_dict(), os.path.join(compressed_dir, WEIGHTS_NAME))
+                with open(os.path.join(compressed_dir, CONFIG_NAME), "w") as writer:
+                    writer.write(compressed_model.config.to_json_string())
+                reloaded_model = BertForMaskedLM.from_pretrained(compressed_dir).eval()
+                self.assertEqual(reloaded_model.config.embedding_compression, mode)
+                with torch.no_grad():
+                    self.assertTrue(torch.equal(reloaded_model(input_ids, token_type_ids, input_mask), scores))
+        finally:
+            shutil.rmtree(serialization_dir)
+
     def run_tester(self, tester):
         config_and_inputs = tester.prepare_config_and_inputs()
         output_result = tester.create_bert_model(*config_and_inputs)
@@ -0,0 +1,114 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import random
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert.modeling import BertConfig, BertForQuestionAnswering
+from pytorch_pretrained_bert.qa_inference import QuestionAnsweringEngine
+
+Feature = collections.namedtuple("Feature", ["unique_id", "example_index", "input_ids", "input_mask", "segment_ids"])
+
+
+def build_features(rng, examples, max_seq_length=32, doc_stride=6):
+    """Splits (question ids, doc ids) examples into overlapping windows, as run_squad.py does."""
+    features = []
+    for example_index, (question, doc) in enumerate(examples):
+        max_tokens_for_doc = max_seq_length - len(question) - 3
+        start_offset = 0
+        while True:
+            length = min(len(doc) - start_offset, max_tokens_for_doc)
+            input_ids = [1] + question + [2] + doc[start_offset:start_offset + length] + [2]
+            segment_ids = [0] * (len(question) + 2) + [1] * (length + 1)
+            input_mask = [1] * len(input_ids)
+            padding = [0] * (max_seq_length - len(input_ids))
+            features.append(Feature(len(features), example_index, input_ids + padding, input_mask + padding,
+                                    segment_ids + padding))
+            if start_offset + length == len(doc):
+                break
+            start_offset += min(length, doc_stride)
+    return features
+
+
+class QuestionAnsweringEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        torch.manual_seed(0)
+        rng = random.Random(0)
+        config = BertConfig(vocab_size_or_config_json_file=99, hidden_size=32, num_hidden_layers=2,
+                            num_attention_heads=4, intermediate_size=37, max_position_embeddings=64)
+        self.model = BertForQuestionAnswering(config).eval()
+        doc = [rng.randint(3, 98) for _ in range(40)]
+        question = [rng.randint(3, 98) for _ in range(5)]
+        examples = [(question, doc), ([rng.randint(3, 98) for _ in range(3)], doc[:10]),
+                    (question, doc), ([rng.randint(3, 98) for _ in range(8)], doc)]
+        self.features = build_features(rng, examples)
+
+    def expected_logits(self):
+        input_ids, input_mask, segment_ids = [torch.tensor([getattr(f, name) for f in self.features])
+                                              for name in ["input_ids", "input_mask", "segment_ids"]]
+        with torch.no_grad():
+            start_logits, end_logits = self.model(input_ids, segment_ids, input_mask)
+        lengths = input_mask.sum(1).tolist()
+        return [(start_logits[i, :n], end_logits[i, :n]) for i, n in enumerate(lengths)]
+
+    def check_predictions(self, engine):
+        results = engine.predict(self.features)
+        self.assertEqual([r.unique_id for r in results], [f.unique_id for f in self.features])
+        for result, (start_logits, end_logits) in zip(results, self.expected_logits()):
+            self.assertTrue(torch.allclose(torch.tensor(result.start_logits), start_logits, atol=1e-5))
+            self.assertTrue(torch.allclose(torch.tensor(result.end_logits), end_logits, atol=1e-5))
+            self.assertEqual(int(torch.tensor(result.start_logits).argmax()), int(start_logits.argmax()))
+            self.assertEqual(int(torch.tensor(result.end_logits).argmax()), int(end_logits.argmax()))
+        return engine.stats
+
+    def test_baseline(self):
+        stats = self.check_predictions(QuestionAnsweringEngine(self.model, batch_size=4, deduplicate=False,
+                                                               trim_padding=False))
+        self.assertEqual(stats["windows"], len(self.features))
+        self.assertEqual(stats["encoded_tokens"], stats["padded_tokens"])
+        self.assertEqual(stats["embedded_tokens"], stats["padded_tokens"])
+
+    def test_deduplicate(self):
+        stats = self.check_predictions(QuestionAnsweringEngine(self.model, batch_size=4))
+        # The third example repeats the first one.
+        num_duplicates = sum(1 for f in self.features if f.example_index == 2)
+        self.assertEqual(stats["windows"], len(self.features) - num_duplicates)
+        self.assertLess(stats["encoded_tokens"], stats["real_tokens"])
+        self.assertLess(stats["encoded_tokens"], 0.75 * stats["padded_tokens"])
+
+    def test_reuse_question_prefix(self):
+        stats = self.check_predictions(QuestionAnsweringEngine(self.model, batch_size=4, reuse_question_prefix=True))
+        without_prefix_reuse = self.check_predictions(QuestionAnsweringEngine(self.model, batch_size=4))
+        self.assertEqual(stats["encoded_tokens"], without_prefix_reuse["encoded_tokens"])
+        # Each window after the first one of an example saves its question prefix.
+        prefix_lengths = {f.example_index: f.segment_ids.index(1) for f in self.features}
+        windows = [f for f in self.features if f.example_index != 2]
+        saved = sum(prefix_lengths[f.example_index] for f in windows) - sum(
+            prefix_lengths[index] for index in prefix_lengths if index != 2)
+        self.assertLessEqual(stats["embedded_tokens"], without_prefix_reuse["embedded_tokens"] - saved)
+
+        with self.assertRaises(ValueError):
+            QuestionAnsweringEngine(self.model, reuse_question_prefix=True, trim_padding=False)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import unittest
+
+from pytorch_pretrained_bert.streaming import read_json_records, read_lines, stream_encode
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+
+class StreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        vocab_tokens = [
+            "[PAD]", "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing", ","
+        ]
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+        self.tokenizer = BertTokenizer(vocab_file)
+        os.remove(vocab_file)
+
+    def test_stream_encode_lines(self):
+        texts = [u"unwanted running", u"want, runn", u"running"] * 5
+        with open("/tmp/bert_streaming_test.txt", "w") as writer:
+            writer.write("\n\n".join(texts) + "\n")
+        expected = self.tokenizer.batch_encode(texts, max_len=8)
+
+        for num_workers in [1, 2]:
+            features = list(stream_encode(self.tokenizer, read_lines("/tmp/bert_streaming_test.txt"),
+                                          max_len=8, chunk_size=4, num_workers=num_workers, prefetch=1))
+            self.assertEqual(len(features), len(texts))
+            for key, expected_array in zip(["input_ids", "input_mask", "segment_ids"], expected):
+                self.assertListEqual([feature[key].tolist() for feature in features], expected_array.tolist())
+        os.remove("/tmp/bert_streaming_test.txt")
+
+    def test_stream_encode_json_records(self):
+        records = [{"question": u"want", "context": u"unwanted running", "label": i} for i in range(3)]
+        with open("/tmp/bert_streaming_test.jsonl", "w") as writer:
+            writer.write("".join(json.dumps(record) + "\n" for record in records))
+
+        features = list(stream_encode(self.tokenizer, read_json_records("/tmp/bert_streaming_test.jsonl"),
+                                      max_len=8, text_key="question", text_pair_key="context",
+                                      keep_keys=("label",), chunk_size=2))
+        os.remove("/tmp/bert_streaming_test.jsonl")
+        self.assertEqual([feature["label"] for feature in features], [0, 1, 2])
+        self.assertListEqual(features[0]["input_ids"].tolist(), [2, 4, 3, 8, 5, 6, 9, 3])
+        self.assertListEqual(features[0]["segment_ids"].tolist(), [0, 0, 0, 1, 1, 1, 1, 1])
+
+    def test_stream_encode_stops_reading_early(self):
+        consumed = []
+
+        def records():
+            for i in range(1000):
+                consumed.append(i)
+                yield u"running"
+
+        stream = stream_encode(self.tokenizer, records(), max_len=8, chunk_size=10, prefetch=2)
+        next(stream)
+        stream.close()
+        # At most the chunk being consumed, `prefetch` queued chunks and the one blocked on the queue.
+        self.assertLessEqual(len(consumed), 10 * 4)
+
+    def test_stream_encode_raises_errors(self):
+        with self.assertRaises(KeyError):
+            list(stream_encode(self.tokenizer, [{"txt": u"running"}], max_len=8))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -17,10 +17,17 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import pickle
+import random
 import unittest
 
-from pytorch_pretrained_bert.tokenization import (BertTokenizer, BasicTokenizer, WordpieceTokenizer,
-                                                  _is_whitespace, _is_control, _is_punctuation)
+import numpy as np
+import torch
+
+from pytorch_pretrained_bert.tokenization import (BertTokenizer, BasicTokenizer, WordpieceTokenizer, CompiledVocab,
+                                                  compile_vocab, load_vocab, whitespace_tokenize,
+                                                  _is_whitespace, _is_control, _is_punctuation,
+                                                  _char_class, _WHITESPACE, _CONTROL, _PUNCTUATION)
 
 
 class TokenizationTest(unittest.TestCase):
@@ -44,6 +51,96 @@ class TokenizationTest(unittest.TestCase):
         self.assertListEqual(
             tokenizer.convert_tokens_to_ids(tokens), [7, 4, 5, 10, 8, 9])
 
+    def test_full_tokenizer_with_offsets(self):
+        vocab_tokens = [
+            "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing", ",", u"\u535A"
+        ]
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+
+        tokenizer = BertTokenizer(vocab_file)
+        os.remove(vocab_file)
+
+        text = u" UNwant\u00E9d,\x00running \u535A\u63A8zz"
+        tokens, offsets = tokenizer.tokenize_with_offsets(text)
+        self.assertListEqual(tokens, tokenizer.tokenize(text))
+        self.assertListEqual(tokens, ["un", "##want", "##ed", ",", "runn", "##ing",
+                                      u"\u535A", "[UNK]", "[UNK]"])
+        self.assertListEqual([text[start:end] for (start, end) in offsets],
+                             [u"UN", u"want", u"\u00E9d", u",", u"runn", u"ing",
+                              u"\u535A", u"\u63A8", u"zz"])
+
+    def test_compiled_vocab(self):
+        vocab_tokens = [
+            "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing", ",", u"\u535A", "wa"
+        ]
+        with open("/tmp/bert_tokenizer_test.txt", "w", encoding="utf-8") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+        compiled_vocab_file = "/tmp/bert_tokenizer_test.bin"
+        compile_vocab(vocab_file, compiled_vocab_file)
+        vocab = load_vocab(vocab_file)
+        os.remove(vocab_file)
+
+        compiled_vocab = CompiledVocab(compiled_vocab_file)
+        self.assertEqual(dict(compiled_vocab), dict(vocab))
+        self.assertListEqual(list(compiled_vocab), list(vocab))
+        self.assertEqual(len(compiled_vocab), len(vocab))
+        self.assertNotIn("running", compiled_vocab)
+        self.assertEqual(compiled_vocab.ids_to_tokens[11], u"\u535A")
+        self.assertEqual(dict(pickle.loads(pickle.dumps(compiled_vocab))), dict(vocab))
+
+        tokenizer = BertTokenizer(compiled_vocab_file)
+        tokens = tokenizer.tokenize(u"UNwant\u00E9d,running")
+        self.assertListEqual(tokens, ["un", "##want", "##ed", ",", "runn", "##ing"])
+        ids = tokenizer.convert_tokens_to_ids(tokens)
+        self.assertListEqual(ids, [7, 4, 5, 10, 8, 9])
+        self.assertListEqual(tokenizer.convert_ids_to_tokens(ids), tokens)
+        del tokenizer, compiled_vocab
+        os.remove(compiled_vocab_file)
+
+    def test_batch_convert(self):
+        vocab_tokens = [
+            "[PAD]", "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing", ","
+        ]
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+        compiled_vocab_file = "/tmp/bert_tokenizer_test.bin"
+        compile_vocab(vocab_file, compiled_vocab_file)
+
+        for tokenizer in [BertTokenizer(vocab_file), BertTokenizer(compiled_vocab_file)]:
+            tokens = ["un", "##want", "##ed", ",", "runn", "##ing"]
+            ids = tokenizer.batch_convert_tokens_to_ids(tokens)
+            self.assertEqual(ids.dtype, np.int64)
+            self.assertListEqual(ids.tolist(), tokenizer.convert_tokens_to_ids(tokens))
+
+            batch = [["[CLS]", "un", "##want", "##ed", "[SEP]"], ["[CLS]", "runn", "##ing", "[SEP]"]]
+            ids = tokenizer.batch_convert_tokens_to_ids(batch, return_tensors="pt")
+            self.assertIsInstance(ids, torch.LongTensor)
+            self.assertListEqual(ids.tolist(), [[2, 8, 5, 6, 3], [2, 9, 10, 3, 0]])
+            self.assertEqual(tokenizer.batch_convert_tokens_to_ids(batch, max_len=8).shape, (2, 8))
+            with self.assertRaises(ValueError):
+                tokenizer.batch_convert_tokens_to_ids(batch, max_len=4)
+
+            self.assertListEqual(tokenizer.batch_convert_ids_to_tokens(ids, pad_id=0), batch)
+            decoded = tokenizer.batch_convert_ids_to_tokens(ids.numpy())
+            self.assertEqual(decoded.shape, (2, 5))
+            self.assertEqual(decoded[1, 4], "[PAD]")
+            self.assertListEqual(tokenizer.batch_convert_ids_to_tokens([4, 11]).tolist(), ["want", ","])
+            for bad_id in [-1, len(vocab_tokens)]:
+                with self.assertRaises(KeyError):
+                    tokenizer.convert_ids_to_tokens([4, bad_id])
+                with self.assertRaises(KeyError):
+                    tokenizer.batch_convert_ids_to_tokens([[4, bad_id]])
+            del tokenizer
+        os.remove(vocab_file)
+        os.remove(compiled_vocab_file)
+
     def test_full_tokenizer_raises_error_for_long_sequences(self):
         vocab_tokens = [
             "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
@@ -62,6 +159,65 @@ class TokenizationTest(unittest.TestCase):
         tokens = tokenizer.tokenize(u"the cat sat on the mat in the summer time .")
         self.assertRaises(ValueError, tokenizer.convert_tokens_to_ids, tokens)
 
+    def test_full_tokenizer_word_cache(self):
+        vocab_tokens = [
+            "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing", ","
+        ]
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+
+        tokenizer = BertTokenizer(vocab_file, word_cache_size=4)
+        uncached_tokenizer = BertTokenizer(vocab_file, word_cache_size=0)
+        os.remove(vocab_file)
+
+        text = u"[CLS] UNwant\u00E9d,running [SEP] running [CLS]"
+        self.assertListEqual(tokenizer.tokenize(text), uncached_tokenizer.tokenize(text))
+        self.assertListEqual(tokenizer.tokenize(text),
+                             ["[CLS]", "un", "##want", "##ed", ",", "runn", "##ing", "[SEP]",
+                              "runn", "##ing", "[CLS]"])
+        self.assertDictEqual(tokenizer.cache_info(), {"hits": 6, "misses": 4, "size": 4, "max_size": 4})
+        self.assertEqual(uncached_tokenizer.cache_info()["size"], 0)
+
+        tokenizer.clear_cache()
+        self.assertDictEqual(tokenizer.cache_info(), {"hits": 0, "misses": 0, "size": 0, "max_size": 4})
+
+    def test_batch_encode(self):
+        vocab_tokens = [
+            "[PAD]", "[UNK]", "[CLS]", "[SEP]", "want", "##want", "##ed", "wa", "un", "runn",
+            "##ing", ","
+        ]
+        with open("/tmp/bert_tokenizer_test.txt", "w") as vocab_writer:
+            vocab_writer.write("".join([x + "\n" for x in vocab_tokens]))
+            vocab_file = vocab_writer.name
+
+        tokenizer = BertTokenizer(vocab_file)
+        os.remove(vocab_file)
+
+        input_ids, input_mask, segment_ids = tokenizer.batch_encode(
+            [u"UNwant\u00E9d,running", u"running"], text_pairs=[u"want", None], max_len=8)
+        self.assertListEqual(input_ids.tolist(), [[2, 8, 5, 6, 11, 3, 4, 3],
+                                                  [2, 9, 10, 3, 0, 0, 0, 0]])
+        self.assertListEqual(input_mask.tolist(), [[1] * 8, [1, 1, 1, 1, 0, 0, 0, 0]])
+        self.assertListEqual(segment_ids.tolist(), [[0, 0, 0, 0, 0, 0, 1, 1], [0] * 8])
+
+        texts = [u"unwanted running"] * 7 + [u"want, runn"] * 6
+        pairs = [u"running wa"] * 13
+        expected = tokenizer.batch_encode(texts, pairs, max_len=10)
+        actual = tokenizer.batch_encode(texts, pairs, max_len=10, num_workers=2, chunk_size=4)
+        for expected_array, actual_array in zip(expected, actual):
+            self.assertListEqual(expected_array.tolist(), actual_array.tolist())
+
+        # The workers receive the vocab and settings, not the warmed word cache or the trie.
+        self.assertGreater(tokenizer.cache_info()["size"], 0)
+        self.assertIsNotNone(tokenizer.wordpiece_tokenizer._trie)
+        copy = pickle.loads(pickle.dumps(tokenizer))
+        self.assertEqual(copy.cache_info(), {"hits": 0, "misses": 0, "size": 0, "max_size": 100000})
+        self.assertIsNone(copy.wordpiece_tokenizer._trie)
+        self.assertGreater(tokenizer.cache_info()["size"], 0)
+        self.assertListEqual(copy.tokenize(u"unwanted running"), tokenizer.tokenize(u"unwanted running"))
+
     def test_chinese(self):
         tokenizer = BasicTokenizer()
 
@@ -69,6 +225,24 @@ class TokenizationTest(unittest.TestCase):
             tokenizer.tokenize(u"ah\u535A\u63A8zz"),
             [u"ah", u"\u535A", u"\u63A8", u"zz"])
 
+    def test_chinese_segmentation(self):
+        tokenizer = BasicTokenizer()
+        text = (u"[CLS] Who \u8FD9\u662F\u4E00\u4E2A\u6D4B\u8BD5 was Jim? \uF900\u3000\U00020001"
+                u"\U0001F600\u8BD5,\u2028ab\u00E9\u535A\u0000 [SEP]")
+        self.assertListEqual(tokenizer.split_words(text),
+                             whitespace_tokenize(tokenizer._tokenize_chinese_chars(tokenizer._clean_text(text))))
+        self.assertListEqual(
+            tokenizer.tokenize(text),
+            ["[CLS]", "who", u"\u8FD9", u"\u662F", u"\u4E00", u"\u4E2A", u"\u6D4B", u"\u8BD5", "was", "jim",
+             "?", u"\u8C48", u"\U00020001", u"\U0001F600", u"\u8BD5", ",", "abe", u"\u535A", "[SEP]"])
+
+    def test_basic_tokenizer_astral_chars(self):
+        tokenizer = BasicTokenizer(do_lower_case=False)
+
+        self.assertListEqual(
+            tokenizer.tokenize(u"a\U00020000b\U0001F600!\u3000c\U000E0001d\U00010100e"),
+            [u"a", u"\U00020000", u"b\U0001F600", u"!", u"cd", u"\U00010100", u"e"])
+
     def test_basic_tokenizer_lower(self):
         tokenizer = BasicTokenizer(do_lower_case=True)
 
@@ -77,6 +251,16 @@ class TokenizationTest(unittest.TestCase):
             ["hello", "!", "how", "are", "you", "?"])
         self.assertListEqual(tokenizer.tokenize(u"H\u00E9llo"), ["hello"])
 
+    def test_basic_tokenizer_ascii_fast_path(self):
+        tokenizer = BasicTokenizer(do_lower_case=True)
+
+        text = u"\x00[CLS] HeLLo!how\x0b\x7f are [SEP]you?\r\n[MASK] "
+        self.assertListEqual(
+            tokenizer.tokenize(text),
+            ["[CLS]", "hello", "!", "how", "are", "[", "sep", "]", "you", "?", "[MASK]"])
+        # The same text with a non-ASCII character takes the general path.
+        self.assertListEqual(tokenizer.tokenize(text + u"\u00E9"), tokenizer.tokenize(text) + [u"e"])
+
     def test_basic_tokenizer_no_lower(self):
         tokenizer = BasicTokenizer(do_lower_case=False)
 
@@ -104,6 +288,44 @@ class TokenizationTest(unittest.TestCase):
         self.assertListEqual(
             tokenizer.tokenize("unwantedX running"), ["[UNK]", "runn", "##ing"])
 
+    def test_wordpiece_tokenizer_matches_greedy_lookup(self):
+        def greedy_tokenize(vocab, word):
+            chars = list(word)
+            start = 0
+            sub_tokens = []
+            while start < len(chars):
+                end = len(chars)
+                cur_substr = None
+                while start < end:
+                    substr = "".join(chars[start:end])
+                    if start > 0:
+                        substr = "##" + substr
+                    if substr in vocab:
+                        cur_substr = substr
+                        break
+                    end -= 1
+                if cur_substr is None:
+                    return ["[UNK]"]
+                sub_tokens.append(cur_substr)
+                start = end
+            return sub_tokens
+
+        rng = random.Random(12345)
+        alphabet = "abc#"
+        vocab_tokens = ["[UNK]", "##", "####a"]
+        for _ in range(60):
+            piece = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 4)))
+            vocab_tokens.append(piece)
+            vocab_tokens.append("##" + piece)
+        vocab = {}
+        for (i, token) in enumerate(vocab_tokens):
+            vocab[token] = i
+        tokenizer = WordpieceTokenizer(vocab=vocab)
+
+        for _ in range(500):
+            word = "".join(rng.choice(alphabet) for _ in range(rng.randint(1, 10)))
+            self.assertListEqual(tokenizer.tokenize(word), greedy_tokenize(vocab, word))
+
     def test_is_whitespace(self):
         self.assertTrue(_is_whitespace(u" "))
         self.assertTrue(_is_whitespace(u"\t"))
@@ -131,6 +353,13 @@ class TokenizationTest(unittest.TestCase):
         self.assertFalse(_is_punctuation(u"A"))
         self.assertFalse(_is_punctuation(u" "))
 
+    def test_char_class(self):
+        for char in [u" ", u"\t", u"\u00A0", u"\u0005", u"A", u"-", u"$", u"\u3002", u"\u535A",
+                     u"\U00010100", u"\U000E0001", u"\U00020000"]:
+            self.assertEqual(bool(_char_class(char) & _WHITESPACE), _is_whitespace(char))
+            self.assertEqual(bool(_char_class(char) & _CONTROL), _is_control(char))
+            self.assertEqual(bool(_char_class(char) & _PUNCTUATION), _is_punctuation(char))
+
 
 if __name__ == '__main__':
     unittest.main()